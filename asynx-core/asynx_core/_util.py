@@ -1,9 +1,14 @@
 # -*- coding: utf-8 -*-
 
+import re
 from pytz import utc
 from datetime import datetime, timedelta
 
 import anyjson
+from dateutil import parser
+
+# the current time of asynx-core, see the clock module
+from .clock import utcnow  # noqa
 
 _dumps = anyjson.dumps
 _loads = anyjson.loads
@@ -40,5 +45,27 @@ def user_agent():
     return 'Asynx/4.0'
 
 
-def utcnow():
-    return utc.localize(datetime.utcnow())
+_utc_isoformat = re.compile(r'^(\d{4})-(\d\d)-(\d\d)T(\d\d):(\d\d):(\d\d)'
+                            r'(?:\.(\d{6}))?\+00:00$')
+
+
+def parse_datetime(text):
+    """parsing an isoformat datetime string
+
+    UTC timestamps in the form written by datetime.isoformat() are parsed
+    without dateutil, which is much slower.
+
+    Doctest:
+        >>> parse_datetime('2014-03-14T15:09:26.535898+00:00')
+        datetime.datetime(2014, 3, 14, 15, 9, 26, 535898, tzinfo=<UTC>)
+        >>> parse_datetime('2014-03-14T15:09:26+00:00')
+        datetime.datetime(2014, 3, 14, 15, 9, 26, tzinfo=<UTC>)
+        >>> parse_datetime('2014-03-14 23:09:26+0800') == \\
+        ...     parse_datetime('2014-03-14T15:09:26+00:00')
+        True
+
+    """
+    m = _utc_isoformat.match(text)
+    if m is None:
+        return parser.parse(text)
+    return datetime(*[int(g) for g in m.groups('0')], tzinfo=utc)
@@ -0,0 +1,2240 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import heapq
+import logging
+import bisect
+import zlib
+import random
+import sqlite3
+import threading
+from binascii import crc32
+from datetime import datetime
+from contextlib import contextmanager
+
+from pytz import utc
+from redis import WatchError, RedisError
+
+from . import clock
+from ._util import _dumps, _loads, dict_items, not_bytes, parse_datetime
+
+logger = logging.getLogger(__name__)
+
+
+# keys of the redis backend, shared by every taskqueue of a backend. Keys
+# of a taskqueue share the hash tag "{app:queue}", so they are in the same
+# slot of Redis Cluster and its transactions never cross slots
+
+
+def queue_tag(appname, queuename):
+    """the hash tag of every key of a taskqueue
+
+    Doctest:
+        >>> queue_tag('test', 'custom')
+        '{test:custom}'
+
+    """
+    return '{{{0}:{1}}}'.format(appname, queuename)
+
+
+def incr_key(appname, queuename):
+    """generating an auto-increment key per queue
+
+    Doctest:
+        >>> incr_key('test', 'custom')
+        ('AX:Q:{test:custom}', 'inc')
+
+    """
+    return 'AX:Q:' + queue_tag(appname, queuename), 'inc'
+
+
+def backlog_key(appname, queuename):
+    """generating a hash key counting tasks per queue
+
+    Doctest:
+        >>> backlog_key('test', 'custom')
+        ('AX:Q:{test:custom}', 'backlog')
+
+    """
+    return 'AX:Q:' + queue_tag(appname, queuename), 'backlog'
+
+
+def apps_key():
+    return 'AX:APPS'
+
+
+def queues_key(appname):
+    return 'AX:QUEUES:{{{0}}}'.format(appname)
+
+
+def sched_key(appname, queuename):
+    return 'AX:SC:' + queue_tag(appname, queuename)
+
+
+def meta_key(appname, queuename, idx):
+    return 'AX:META:{0}:{1}'.format(queue_tag(appname, queuename), idx)
+
+
+def compact_meta_key(appname, queuename, idx):
+    """generating the key of a task hash in the compact encoding
+
+    Doctest:
+        >>> compact_meta_key('test', 'custom', 12345)
+        'AX:M:{test:custom}:12345'
+
+    """
+    return 'AX:M:{0}:{1}'.format(queue_tag(appname, queuename), idx)
+
+
+def cname_key(appname, queuename, cname):
+    return 'AX:CNAME:{0}:{1}'.format(queue_tag(appname, queuename), cname)
+
+
+def uuid_key(appname, queuename):
+    return 'AX:UUID:' + queue_tag(appname, queuename)
+
+
+def slow_key(appname, queuename):
+    return 'AX:SLOW:' + queue_tag(appname, queuename)
+
+
+def recent_key(appname, queuename):
+    return 'AX:RECENT:' + queue_tag(appname, queuename)
+
+
+def cold_key(appname, queuename):
+    """generating a hash key of the compressed tasks in the cold tier
+
+    Doctest:
+        >>> cold_key('test', 'custom')
+        'AX:COLD:{test:custom}'
+
+    """
+    return 'AX:COLD:' + queue_tag(appname, queuename)
+
+
+def due_key(appname, queuename):
+    """generating a sorted set key of the due times of cold tasks"""
+    return 'AX:DUE:' + queue_tag(appname, queuename)
+
+
+def template_key(appname, queuename):
+    """generating a hash key of the request templates of a queue, and
+    one of their versions
+
+    Doctest:
+        >>> template_key('test', 'custom')
+        ('AX:TPL:{test:custom}', 'AX:TPLV:{test:custom}')
+
+    """
+    tag = queue_tag(appname, queuename)
+    return 'AX:TPL:' + tag, 'AX:TPLV:' + tag
+
+
+def targets_key(appname, queuename, idx):
+    """generating a list key of the targets left of a fan-out task, and
+    a hash key of the results of the ones sent
+
+    Doctest:
+        >>> targets_key('test', 'custom', 1)
+        ('AX:FAN:{test:custom}:1', 'AX:FANR:{test:custom}:1')
+
+    """
+    tag = queue_tag(appname, queuename)
+    return 'AX:FAN:{0}:{1}'.format(tag, idx), \
+        'AX:FANR:{0}:{1}'.format(tag, idx)
+
+
+def batch_key(appname, queuename, key):
+    """generating a list key of the ids of due tasks coalesced into a
+    batch, `key` identifies their endpoint
+
+    Doctest:
+        >>> batch_key('test', 'custom', 'ab12')
+        'AX:BATCH:{test:custom}:ab12'
+
+    """
+    return 'AX:BATCH:{0}:{1}'.format(queue_tag(appname, queuename), key)
+
+
+def group_key(appname, queuename, group_id):
+    """generating a hash key of a group of tasks: its body, the count of
+    its tasks not done yet, and the result of each done one
+
+    Doctest:
+        >>> group_key('test', 'custom', 'f00d')
+        'AX:GRP:{test:custom}:f00d'
+
+    """
+    return 'AX:GRP:{0}:{1}'.format(queue_tag(appname, queuename), group_id)
+
+
+def dedupe_key(appname, queuename, key):
+    """generating a key of the task inserted with an idempotency key,
+    kept for the dedupe window
+
+    Doctest:
+        >>> dedupe_key('test', 'custom', 'order-42')
+        'AX:DEDUP:{test:custom}:order-42'
+
+    """
+    return 'AX:DEDUP:{0}:{1}'.format(queue_tag(appname, queuename), key)
+
+
+# recording the result of a task of a group once, counting it done and
+# popping the group with its last task, all at once
+GROUP_DONE_SCRIPT = '''
+if redis.call('HSETNX', KEYS[1], ARGV[1], ARGV[2]) == 0 then
+    return nil
+end
+if redis.call('HINCRBY', KEYS[1], '$left', -1) > 0 then
+    return nil
+end
+local stored = redis.call('HGETALL', KEYS[1])
+redis.call('DEL', KEYS[1])
+return stored
+'''
+
+
+def pack(fields):
+    """compressing the fields of a cold task
+
+    Doctest:
+        >>> fields = {'status': '"delayed"', 'schedule': 'null'}
+        >>> unpack(pack(fields)) == fields
+        True
+
+    """
+    return zlib.compress(_dumps(fields).encode('utf-8'), 9)
+
+
+def unpack(blob):
+    return dict((str(key), value) for key, value
+                in dict_items(_loads(zlib.decompress(blob).decode('utf-8'))))
+
+
+# short names of the fields of compact task hashes, the headers and
+# payload of requests are split in fields of their own
+COMPACT_NAMES = {
+    'request': 'r', 'uuid': 'u', 'cname': 'c', 'eta': 'e', 'schedule': 's',
+    'last_run_at': 'l', 'status': 't', 'on_success': 'os',
+    'on_failure': 'of', 'on_complete': 'oc', 'template': 'tp',
+    'fanout': 'fo', 'coalesce': 'co', 'group': 'g'}
+FULL_NAMES = dict((short, name) for name, short in dict_items(COMPACT_NAMES))
+# JSON-encoded values of fields omitted from compact task hashes
+FIELD_DEFAULTS = {
+    'cname': 'null', 'eta': 'null', 'schedule': 'null', 'last_run_at': 'null',
+    'on_success': 'null', 'on_failure': '"__report__"', 'on_complete': 'null'}
+
+
+def _tight_dumps(obj):
+    return json.dumps(obj, separators=(',', ':'))
+
+
+def encode_compact(fields, defaults=True):
+    """shortening the JSON-encoded fields of a task
+
+    Fields having their default value are dropped unless `defaults`, and
+    the headers and payload of the request are stored apart, so the rest
+    of it often fits the small-hash encoding of redis.
+
+    Doctest:
+        >>> sorted(encode_compact({'status': '"new"', 'cname': 'null',
+        ...     'request': '{"url": "http://a/"}'}, False).items())
+        [('r', '{"url":"http://a/"}'), ('t', '"new"')]
+        >>> request = '{"headers":{"A":"1"},"url":"http://a/"}'
+        >>> sorted(encode_compact({'request': request}).items())
+        [('h', '{"A":"1"}'), ('r', '{"url":"http://a/"}')]
+
+    """
+    encoded = {}
+    for name, value in dict_items(fields):
+        if not defaults and FIELD_DEFAULTS.get(name) == value:
+            continue
+        if name == 'request':
+            request = _loads(value)
+            if 'headers' in request:
+                encoded['h'] = _tight_dumps(request.pop('headers'))
+            if 'payload' in request:
+                encoded['p'] = _tight_dumps(request.pop('payload'))
+            value = _tight_dumps(request)
+        encoded[COMPACT_NAMES.get(name, name)] = value
+    return encoded
+
+
+def decode_compact(stored):
+    """restoring the JSON-encoded fields of a task stored by
+    `encode_compact`
+
+    Doctest:
+        >>> fields = {'status': '"new"', 'cname': 'null', 'request':
+        ...           '{"url":"http://a/","payload":null}'}
+        >>> decoded = decode_compact(encode_compact(fields, False))
+        >>> decoded['status'], decoded['cname'], decoded['on_failure']
+        ('"new"', 'null', '"__report__"')
+        >>> _loads(decoded['request']) == _loads(fields['request'])
+        True
+
+    """
+    if not stored:
+        return stored
+    fields = dict(FIELD_DEFAULTS)
+    parts = []
+    for short, value in dict_items(stored):
+        short, value = not_bytes(short), not_bytes(value)
+        if short == 'h':
+            parts.append('"headers":' + value)
+        elif short == 'p':
+            parts.append('"payload":' + value)
+        else:
+            fields[FULL_NAMES.get(short, short)] = value
+    if parts:
+        # splicing instead of decoding the request
+        request = fields['request'][:-1]
+        if request != '{':
+            request += ','
+        fields['request'] = request + ','.join(parts) + '}'
+    return fields
+
+
+HEARTBEAT_KEY = 'AX:HEARTBEAT'
+
+_routing = threading.local()
+
+
+@contextmanager
+def reading_from(replica):
+    """routing the reads of this thread in the block to replicas, or to
+    the primary, on backends having replicas. The outermost block
+    decides, so reads in `reading_from(False)` always see the writes
+    made before
+
+    Doctest:
+        >>> with reading_from(False):
+        ...     with reading_from(True):
+        ...         _routing.replica
+        False
+
+    """
+    if getattr(_routing, 'replica', None) is not None:
+        yield
+        return
+    _routing.replica = replica
+    try:
+        yield
+    finally:
+        _routing.replica = None
+
+
+class Backend(object):
+    """storage of tasks shared by taskqueues
+
+    Every method takes the taskqueue (an object with `appname` and
+    `queuename`) it operates on. Task fields are stored JSON-encoded, as
+    returned by `Task._to_redis`, and returned as they were stored.
+
+    Backends with a cold tier set `cold_horizon`: delayed tasks due later
+    than that many seconds are stored compactly by `add_cold`, without a
+    celery message, until `pop_cold` moves them back.
+
+    Backends storing tasks apart from the broker set `durable`: their tasks
+    outlive celery messages lost with the broker, and `claim_stale` hands
+    back the ones left unsent.
+
+    """
+
+    cold_horizon = None
+    durable = False
+
+    def add(self, tq, fields, cname=None, scheduled=False):
+        """allocating an id and storing a new task, its cname and
+        schedule indexes, and counting it in the app's backlog
+
+        Returns:
+            the id, or None if a task with `cname` already exists
+
+        """
+        raise NotImplementedError
+
+    def dispatched(self, tq, task_id, fields, uuid, old_uuid=None,
+                   due=None):
+        """updating fields of a task sent to celery, and indexing it
+        by its new uuid instead of `old_uuid`, `due` is the unix timestamp
+        its message runs at"""
+        raise NotImplementedError
+
+    def get(self, tq, task_id):
+        """Returns: dict of fields, empty if not found"""
+        raise NotImplementedError
+
+    def get_many(self, tq, task_ids):
+        """Returns: a list of dicts of fields, empty if not found"""
+        raise NotImplementedError
+
+    def range(self, tq, offset, count):
+        """Returns: a list of (uuid, id) ordered by id"""
+        raise NotImplementedError
+
+    def count(self, tq):
+        raise NotImplementedError
+
+    def count_app(self, tq):
+        raise NotImplementedError
+
+    def count_all(self):
+        """Returns: a list of (appname, queuename, count) of every
+        taskqueue ever created"""
+        raise NotImplementedError
+
+    def id_by_uuid(self, tq, uuid):
+        """Returns: the id, or None"""
+        raise NotImplementedError
+
+    def id_by_cname(self, tq, cname):
+        """Returns: the id, or None"""
+        raise NotImplementedError
+
+    def delete(self, tq, task_id, uuid, cname=None, scheduled=False):
+        """deleting a task and its indexes, no-op if already deleted"""
+        raise NotImplementedError
+
+    def transition(self, tq, task_id, fields, ensure_status):
+        """compare-and-set of the status of a task: updating `fields`
+        only if the stored status (JSON-encoded) is in `ensure_status`
+
+        Returns:
+            tuple of (updated, previous status JSON-encoded)
+
+        """
+        raise NotImplementedError
+
+    def record_timeline(self, tq, slowest=None, recent=None):
+        """keeping dispatch timelines
+
+        Parameters:
+            - slowest: optional, tuple of (score, entry, limit), the
+                       entry is kept if it is one of the `limit` highest
+            - recent: optional, tuple of (entry, limit)
+
+        """
+        raise NotImplementedError
+
+    def get_timelines(self, tq):
+        """Returns: tuple of (slowest entries, slowest first,
+        recent entries, newest first)"""
+        raise NotImplementedError
+
+    @contextmanager
+    def batch(self):
+        """grouping the writes of this thread in the block, if the
+        backend is able to"""
+        yield
+
+    def add_cold(self, tq, fields, uuid, due, cname=None):
+        """storing a new task in the cold tier, indexed by `uuid` and by
+        `due`, a unix timestamp
+
+        Returns:
+            the id, or None if a task with `cname` already exists
+
+        """
+        raise NotImplementedError
+
+    def pop_cold(self, until, limit=1000):
+        """moving cold tasks due before `until` into the hot tier, they
+        stay in the due index until `promoted`, and are popped again
+        if their messages were not sent
+
+        Returns:
+            a list of (appname, queuename, id, fields)
+
+        """
+        return []
+
+    def promoted(self, tq, task_ids):
+        """dropping popped cold tasks from the due index once their
+        messages are sent"""
+        pass
+
+    def claim_stale(self, until, limit=1000):
+        """claiming the new, delayed and scheduled tasks whose messages
+        were due before `until`, a unix timestamp, they may be lost. A
+        claimed task is due again from now
+
+        Returns:
+            a list of (appname, queuename, id, fields)
+
+        """
+        return []
+
+    def set_template(self, tq, name, body):
+        """storing a new version of a request template, `body` is
+        JSON-encoded. Versions keep increasing after a deletion
+
+        Returns:
+            integer, the version
+
+        """
+        raise NotImplementedError
+
+    def get_template(self, tq, name):
+        """Returns: tuple of (version, body), or None"""
+        raise NotImplementedError
+
+    def template_version(self, tq, name):
+        """Returns: the version of a template, or None"""
+        raise NotImplementedError
+
+    def delete_template(self, tq, name):
+        """Returns: boolean, if the template existed"""
+        raise NotImplementedError
+
+    def list_templates(self, tq):
+        """Returns: list of (name, version, body) ordered by name"""
+        raise NotImplementedError
+
+    def add_targets(self, tq, task_id, targets):
+        """storing the target URLs of a fan-out task, deleted with it"""
+        raise NotImplementedError
+
+    def pop_targets(self, tq, task_id, count):
+        """taking the next targets of a fan-out task, a target is never
+        taken twice
+
+        Returns:
+            tuple of (list of at most `count` targets, count left)
+
+        """
+        raise NotImplementedError
+
+    def record_results(self, tq, task_id, results):
+        """storing the results of targets of a fan-out task, `results`
+        is a list of (target, JSON-encoded result)"""
+        raise NotImplementedError
+
+    def get_results(self, tq, task_id):
+        """Returns: dict of target => JSON-encoded result"""
+        raise NotImplementedError
+
+    def push_batch(self, tq, key, task_id):
+        """appending a due task to the batch of its endpoint
+
+        Returns:
+            integer, count of tasks in the batch
+
+        """
+        raise NotImplementedError
+
+    def pop_batch(self, tq, key, count):
+        """taking the first tasks of a batch, a task is never taken
+        twice
+
+        Returns:
+            list of at most `count` ids, in the order they were pushed
+
+        """
+        raise NotImplementedError
+
+    def add_group(self, tq, group_id, count, body):
+        """storing a group waiting for `count` tasks, `body` is
+        JSON-encoded"""
+        raise NotImplementedError
+
+    def group_done(self, tq, group_id, task_id, result):
+        """recording the JSON-encoded result of a task of a group and
+        counting it done, once per task, the group is deleted with its
+        last task
+
+        Returns:
+            None while tasks are left, else a tuple of (body, dict of
+            task id string => result), returned to one caller only
+
+        """
+        raise NotImplementedError
+
+    def get_group(self, tq, group_id):
+        """Returns: tuple of (count of tasks left, body, dict of task id
+        string => result), or None"""
+        raise NotImplementedError
+
+    def get_dedupe(self, tq, key):
+        """Returns: the string stored under an idempotency key, or None
+        once it expired"""
+        raise NotImplementedError
+
+    def claim_dedupe(self, tq, key, value, ttl):
+        """storing `value` under an idempotency key for `ttl` seconds,
+        unless one is stored already
+
+        Returns:
+            the string stored under the key, `value` if it is claimed
+
+        """
+        raise NotImplementedError
+
+
+class RedisBackend(Backend):
+
+    def __init__(self, connection, ids=None, replicas=(), max_lag=5.0,
+                 check_interval=1.0, cold_horizon=None, compact=False):
+        """the reference backend, on a redis connection
+
+        Reads in `reading_from(True)` blocks are served by a replica
+        whose lag is at most `max_lag`, or by the primary if none is.
+        From its first check of the replicas, every process runs a thread
+        writing a heartbeat (the clock of the primary, so hosts' clocks
+        don't matter) to the primary each `check_interval` seconds, read
+        or not. The lag of a replica is how old the heartbeat it has is
+        by the primary's clock, up to `check_interval` more than the
+        replication lag.
+
+        Parameters:
+            - connection: redis connection of the primary
+            - ids: optional, an id generator like `ids.SnowflakeIds`,
+                   allocating ids locally instead of a sequence per
+                   queue in redis
+            - replicas: list of redis connections of replicas
+            - max_lag: float, seconds a replica may fall behind
+            - check_interval: float, seconds between lag checks
+            - cold_horizon: optional, float, seconds beyond which delayed
+                            tasks are kept in the cold tier, a zlib blob
+                            in a hash per queue instead of a hash per task
+                            and a celery message
+            - compact: boolean, storing tasks in the compact encoding
+                       (`encode_compact`) under shorter keys, tasks in
+                       the other encoding are moved by `compact_keys`
+
+        Usage:
+            >>> import redis
+            >>> backend = RedisBackend(redis.StrictRedis())
+
+        """
+        self.redis = connection
+        self.ids = ids
+        self.cold_horizon = cold_horizon
+        self.compact = compact
+        self.replicas = list(replicas)
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self.lags = [None] * len(self.replicas)
+        self._healthy = []
+        self._checked_at = None
+        self._check_lock = threading.Lock()
+        self._beat_pid = None
+        self._stopped = threading.Event()
+        self._registered = set()
+        self._group_done = connection.register_script(GROUP_DONE_SCRIPT)
+
+    def _reader(self):
+        """the connection serving reads"""
+        if not self.replicas or not getattr(_routing, 'replica', False):
+            return self.redis
+        now = clock.now()
+        if self._checked_at is None or \
+                now - self._checked_at >= self.check_interval:
+            self.check_replicas(now)
+        healthy = self._healthy
+        return random.choice(healthy) if healthy else self.redis
+
+    def beat(self):
+        """writing the heartbeat replicas are measured by"""
+        seconds, microseconds = self.redis.time()
+        self.redis.set(HEARTBEAT_KEY, '{0:.6f}'.format(
+            seconds + microseconds / 1e6))
+
+    def _start_heartbeat(self):
+        """starting the heartbeat thread of this process"""
+        with self._check_lock:
+            if self._beat_pid == os.getpid():
+                return
+            # the thread didn't survive forking, or never started
+            self._beat_pid = os.getpid()
+        self._stopped.clear()
+        self.beat()
+        thread = threading.Thread(target=self._beat_loop,
+                                  name='asynx-heartbeat')
+        thread.daemon = True
+        thread.start()
+
+    def _beat_loop(self):
+        while True:
+            self._stopped.wait(self.check_interval)
+            if self._stopped.is_set():
+                return
+            try:
+                self.beat()
+            except RedisError:
+                logger.exception('failed to write the heartbeat')
+
+    def stop_heartbeat(self):
+        """stopping the heartbeat thread of this process"""
+        self._stopped.set()
+        self._beat_pid = None
+
+    def check_replicas(self, now=None):
+        """measuring the lag of replicas, the heartbeat thread is
+        started by the first check
+
+        Returns:
+            list of lags in seconds, None if a replica is unreachable or
+            has no heartbeat yet
+
+        """
+        now = clock.now() if now is None else now
+        if self._beat_pid != os.getpid():
+            self._start_heartbeat()
+        with self._check_lock:
+            if self._checked_at is not None and \
+                    now - self._checked_at < self.check_interval:
+                return self.lags
+            self._checked_at = now
+        seconds, microseconds = self.redis.time()
+        server_now = seconds + microseconds / 1e6
+        lags = []
+        healthy = []
+        for replica in self.replicas:
+            try:
+                beat = replica.get(HEARTBEAT_KEY)
+            except RedisError:
+                beat = None
+            lag = None if beat is None else \
+                max(0.0, server_now - float(beat))
+            if lag is not None and lag <= self.max_lag:
+                healthy.append(replica)
+            lags.append(lag)
+        self.lags = lags
+        self._healthy = healthy
+        return lags
+
+    def _meta_key(self, appname, queuename, idx):
+        if self.compact:
+            return compact_meta_key(appname, queuename, idx)
+        return meta_key(appname, queuename, idx)
+
+    def _encode(self, fields, defaults=True):
+        return encode_compact(fields, defaults) if self.compact else fields
+
+    def _decode(self, stored):
+        return decode_compact(stored) if self.compact else stored
+
+    def _register(self, appname, queuename, created=False):
+        """listing a taskqueue in the registry of apps and queues, once
+        per process, or again if its sequence was reset"""
+        if (appname, queuename) in self._registered and not created:
+            return
+        # the registry is in other slots, out of the transactions
+        with self.redis.pipeline(transaction=False) as pipe:
+            pipe.sadd(apps_key(), appname)
+            pipe.sadd(queues_key(appname), queuename)
+            pipe.execute()
+        self._registered.add((appname, queuename))
+
+    def add(self, tq, fields, cname=None, scheduled=False):
+        app, queue = tq.appname, tq.queuename
+
+        def store(pipe, idx):
+            pipe.hmset(self._meta_key(app, queue, idx),
+                       self._encode(fields, False))
+            if scheduled:
+                pipe.zadd(sched_key(app, queue), 0, idx)
+        return self._add(tq, cname, store)
+
+    def add_cold(self, tq, fields, uuid, due, cname=None):
+        app, queue = tq.appname, tq.queuename
+
+        def store(pipe, idx):
+            pipe.hset(cold_key(app, queue), idx,
+                      pack(self._encode(fields, False)))
+            pipe.zadd(due_key(app, queue), due, idx)
+            pipe.zadd(uuid_key(app, queue), idx, uuid)
+        return self._add(tq, cname, store)
+
+    def _add(self, tq, cname, store):
+        app, queue = tq.appname, tq.queuename
+        incrkey, incrhash = incr_key(app, queue)
+        backlogkey, backloghash = backlog_key(app, queue)
+        with self.redis.pipeline() as pipe:
+            try:
+                if cname:
+                    cnamekey = cname_key(app, queue, cname)
+                    pipe.watch(cnamekey)
+                    if pipe.exists(cnamekey):
+                        return None
+                    pipe.multi()
+                if self.ids is None:
+                    idx = self.redis.hincrby(incrkey, incrhash)
+                    self._register(app, queue, idx == 1)
+                else:
+                    idx = self.ids.next_id()
+                    self._register(app, queue)
+                if cname:
+                    pipe.set(cnamekey, idx)
+                store(pipe, idx)
+                pipe.hincrby(backlogkey, backloghash, 1)
+                pipe.execute()
+            except WatchError:
+                return None
+        return idx
+
+    def dispatched(self, tq, task_id, fields, uuid, old_uuid=None,
+                   due=None):
+        uuidkey = uuid_key(tq.appname, tq.queuename)
+        with self.redis.pipeline() as pipe:
+            pipe.hmset(self._meta_key(tq.appname, tq.queuename, task_id),
+                       self._encode(fields))
+            if old_uuid:
+                pipe.zrem(uuidkey, old_uuid)
+            pipe.zadd(uuidkey, task_id, uuid)
+            pipe.execute()
+
+    def get(self, tq, task_id):
+        reader = self._reader()
+        fields = reader.hgetall(
+            self._meta_key(tq.appname, tq.queuename, task_id))
+        if not fields:
+            blob = reader.hget(cold_key(tq.appname, tq.queuename), task_id)
+            if blob is not None:
+                fields = unpack(blob)
+        return self._decode(fields)
+
+    def get_many(self, tq, task_ids):
+        reader = self._reader()
+        with reader.pipeline() as pipe:
+            for idx in task_ids:
+                pipe.hgetall(self._meta_key(tq.appname, tq.queuename, idx))
+            tasks = pipe.execute()
+        missing = [i for i, fields in enumerate(tasks) if not fields]
+        if missing:
+            blobs = reader.hmget(cold_key(tq.appname, tq.queuename),
+                                 [task_ids[i] for i in missing])
+            for i, blob in zip(missing, blobs):
+                if blob is not None:
+                    tasks[i] = unpack(blob)
+        if self.compact:
+            tasks = [decode_compact(fields) for fields in tasks]
+        return tasks
+
+    def range(self, tq, offset, count):
+        return self._reader().zrange(uuid_key(tq.appname, tq.queuename),
+                                     offset, offset + count - 1,
+                                     withscores=True, score_cast_func=int)
+
+    def count(self, tq):
+        return self._reader().zcard(uuid_key(tq.appname, tq.queuename))
+
+    def count_app(self, tq):
+        reader = self._reader()
+        queues = reader.smembers(queues_key(tq.appname))
+        with reader.pipeline(transaction=False) as pipe:
+            for queuename in queues:
+                pipe.hget(*backlog_key(tq.appname, not_bytes(queuename)))
+            return sum(int(count or 0) for count in pipe.execute())
+
+    def _queues(self, reader):
+        apps = sorted(not_bytes(name)
+                      for name in reader.smembers(apps_key()))
+        with reader.pipeline(transaction=False) as pipe:
+            for appname in apps:
+                pipe.smembers(queues_key(appname))
+            queues = pipe.execute()
+        return [(appname, not_bytes(queuename))
+                for appname, names in zip(apps, queues)
+                for queuename in sorted(names)]
+
+    def count_all(self):
+        reader = self._reader()
+        names = self._queues(reader)
+        with reader.pipeline(transaction=False) as pipe:
+            for appname, queuename in names:
+                pipe.zcard(uuid_key(appname, queuename))
+            counts = pipe.execute()
+        return [(appname, queuename, count)
+                for (appname, queuename), count in zip(names, counts)]
+
+    def id_by_uuid(self, tq, uuid):
+        task_id = self._reader().zscore(uuid_key(tq.appname, tq.queuename),
+                                        uuid)
+        return int(task_id) if task_id else None
+
+    def id_by_cname(self, tq, cname):
+        task_id = self._reader().get(
+            cname_key(tq.appname, tq.queuename, cname))
+        return int(task_id) if task_id else None
+
+    def delete(self, tq, task_id, uuid, cname=None, scheduled=False):
+        app, queue = tq.appname, tq.queuename
+        metakey = self._meta_key(app, queue, task_id)
+        uuidkey = uuid_key(app, queue)
+        backlogkey, backloghash = backlog_key(app, queue)
+        cnamekey = cname_key(app, queue, cname) if cname else None
+        coldkey = cold_key(app, queue)
+        targetskeys = targets_key(app, queue, task_id)
+
+        def __delete(pipe):
+            cold = False
+            if not pipe.exists(metakey):
+                cold = pipe.hexists(coldkey, task_id)
+                if not cold:
+                    # already deleted, don't count it twice
+                    return
+            pipe.multi()
+            pipe.hincrby(backlogkey, backloghash, -1)
+            pipe.delete(metakey, *targetskeys)
+            pipe.zrem(uuidkey, uuid)
+            if cnamekey:
+                pipe.delete(cnamekey)
+            if scheduled:
+                pipe.zrem(sched_key(app, queue), task_id)
+            # a promoted task may be left in the due index
+            pipe.zrem(due_key(app, queue), task_id)
+            if cold:
+                pipe.hdel(coldkey, task_id)
+        self.redis.transaction(__delete, metakey, uuidkey, cnamekey, coldkey)
+
+    def transition(self, tq, task_id, fields, ensure_status):
+        metakey = self._meta_key(tq.appname, tq.queuename, task_id)
+        status = 't' if self.compact else 'status'
+        fields = self._encode(fields)
+
+        def __transition(pipe):
+            previous = not_bytes(pipe.hget(metakey, status))
+            if previous not in ensure_status:
+                return False, previous
+            pipe.multi()
+            pipe.hmset(metakey, fields)
+            return True, previous
+
+        return self.redis.transaction(__transition, metakey,
+                                      value_from_callable=True)
+
+    def record_timeline(self, tq, slowest=None, recent=None):
+        with self.redis.pipeline(transaction=False) as pipe:
+            if slowest:
+                score, entry, limit = slowest
+                slowkey = slow_key(tq.appname, tq.queuename)
+                pipe.zadd(slowkey, score, entry)
+                pipe.zremrangebyrank(slowkey, 0, -limit - 1)
+            if recent:
+                entry, limit = recent
+                recentkey = recent_key(tq.appname, tq.queuename)
+                pipe.lpush(recentkey, entry)
+                pipe.ltrim(recentkey, 0, limit - 1)
+            pipe.execute()
+
+    def pop_cold(self, until, limit=1000):
+        names = self._queues(self.redis)
+        with self.redis.pipeline(transaction=False) as pipe:
+            for appname, queuename in names:
+                pipe.zcount(due_key(appname, queuename), '-inf', until)
+            counts = pipe.execute()
+        popped = []
+        for (appname, queuename), count in zip(names, counts):
+            if not count:
+                continue
+            popped.extend(
+                (appname, queuename, idx, fields) for idx, fields in
+                self._pop_cold(appname, queuename, until,
+                               limit - len(popped)))
+            if len(popped) >= limit:
+                break
+        return popped
+
+    def _pop_cold(self, appname, queuename, until, limit):
+        duekey = due_key(appname, queuename)
+        coldkey = cold_key(appname, queuename)
+
+        def __pop(pipe):
+            ids = pipe.zrangebyscore(duekey, '-inf', until, 0, limit)
+            if not ids:
+                return []
+            blobs = pipe.hmget(coldkey, ids)
+            unsent = {}
+            for idx, blob in zip(ids, blobs):
+                if blob is None:
+                    # promoted before, its message may not be sent
+                    stored = self._decode(pipe.hgetall(
+                        self._meta_key(appname, queuename, int(idx))))
+                    unsent[idx] = dict((not_bytes(key), value)
+                                       for key, value in dict_items(stored))
+            pipe.multi()
+            popped = []
+            stale = []
+            for idx, blob in zip(ids, blobs):
+                if blob is None:
+                    fields = unsent[idx]
+                    status = fields.get('status')
+                    if status is None or \
+                            _loads(not_bytes(status)) != 'delayed':
+                        # deleted or already dispatched
+                        stale.append(idx)
+                        continue
+                else:
+                    fields = unpack(blob)
+                    pipe.hmset(self._meta_key(appname, queuename, int(idx)),
+                               fields)
+                    fields = self._decode(fields)
+                popped.append((int(idx), fields))
+            if stale:
+                pipe.zrem(duekey, *stale)
+            pipe.hdel(coldkey, *ids)
+            return popped
+
+        # promoters racing for the same tasks are retried, a deleted task
+        # is not promoted
+        return self.redis.transaction(__pop, duekey, coldkey,
+                                      value_from_callable=True)
+
+    def promoted(self, tq, task_ids):
+        if task_ids:
+            self.redis.zrem(due_key(tq.appname, tq.queuename), *task_ids)
+
+    def get_timelines(self, tq):
+        reader = self._reader()
+        with reader.pipeline(transaction=False) as pipe:
+            pipe.zrevrange(slow_key(tq.appname, tq.queuename), 0, -1)
+            pipe.lrange(recent_key(tq.appname, tq.queuename), 0, -1)
+            return tuple(pipe.execute())
+
+    def set_template(self, tq, name, body):
+        tplkey, versionkey = template_key(tq.appname, tq.queuename)
+        with self.redis.pipeline() as pipe:
+            pipe.hset(tplkey, name, body)
+            pipe.hincrby(versionkey, name, 1)
+            return pipe.execute()[1]
+
+    def get_template(self, tq, name):
+        tplkey, versionkey = template_key(tq.appname, tq.queuename)
+        with self.redis.pipeline() as pipe:
+            pipe.hget(tplkey, name)
+            pipe.hget(versionkey, name)
+            body, version = pipe.execute()
+        if body is None:
+            return None
+        return int(version), not_bytes(body)
+
+    def template_version(self, tq, name):
+        tplkey, versionkey = template_key(tq.appname, tq.queuename)
+        with self.redis.pipeline() as pipe:
+            pipe.hexists(tplkey, name)
+            pipe.hget(versionkey, name)
+            exists, version = pipe.execute()
+        return int(version) if exists else None
+
+    def delete_template(self, tq, name):
+        # the version is kept, a template created again never has the
+        # version of one cached before
+        return bool(self.redis.hdel(
+            template_key(tq.appname, tq.queuename)[0], name))
+
+    def list_templates(self, tq):
+        tplkey, versionkey = template_key(tq.appname, tq.queuename)
+        with self.redis.pipeline() as pipe:
+            pipe.hgetall(tplkey)
+            pipe.hgetall(versionkey)
+            bodies, versions = pipe.execute()
+        return sorted((not_bytes(name), int(versions[name]), not_bytes(body))
+                      for name, body in dict_items(bodies))
+
+    def add_targets(self, tq, task_id, targets):
+        targetskey = targets_key(tq.appname, tq.queuename, task_id)[0]
+        with self.redis.pipeline() as pipe:
+            for i in range(0, len(targets), 1000):
+                pipe.rpush(targetskey, *targets[i:i + 1000])
+            pipe.execute()
+
+    def pop_targets(self, tq, task_id, count):
+        targetskey = targets_key(tq.appname, tq.queuename, task_id)[0]
+        with self.redis.pipeline() as pipe:
+            pipe.lrange(targetskey, 0, count - 1)
+            pipe.ltrim(targetskey, count, -1)
+            pipe.llen(targetskey)
+            targets, _, left = pipe.execute()
+        return [not_bytes(target) for target in targets], left
+
+    def record_results(self, tq, task_id, results):
+        self.redis.hmset(targets_key(tq.appname, tq.queuename, task_id)[1],
+                         dict(results))
+
+    def get_results(self, tq, task_id):
+        results = self.redis.hgetall(
+            targets_key(tq.appname, tq.queuename, task_id)[1])
+        return dict((not_bytes(target), not_bytes(result))
+                    for target, result in dict_items(results))
+
+    def push_batch(self, tq, key, task_id):
+        return self.redis.rpush(batch_key(tq.appname, tq.queuename, key),
+                                task_id)
+
+    def pop_batch(self, tq, key, count):
+        batchkey = batch_key(tq.appname, tq.queuename, key)
+        with self.redis.pipeline() as pipe:
+            pipe.lrange(batchkey, 0, count - 1)
+            pipe.ltrim(batchkey, count, -1)
+            ids = pipe.execute()[0]
+        return [int(idx) for idx in ids]
+
+    def add_group(self, tq, group_id, count, body):
+        self.redis.hmset(group_key(tq.appname, tq.queuename, group_id),
+                         {'$left': count, '$body': body})
+
+    def group_done(self, tq, group_id, task_id, result):
+        stored = self._group_done(
+            keys=[group_key(tq.appname, tq.queuename, group_id)],
+            args=[task_id, result])
+        if stored is None:
+            # already counted, or tasks are left
+            return None
+        stored = self._group(dict(zip(stored[::2], stored[1::2])))
+        if stored is None:
+            # an unknown group
+            return None
+        return stored[1:]
+
+    @staticmethod
+    def _group(stored):
+        fields = dict((not_bytes(key), not_bytes(val))
+                      for key, val in dict_items(stored))
+        if '$body' not in fields:
+            return None
+        left, body = int(fields.pop('$left')), fields.pop('$body')
+        return left, body, fields
+
+    def get_group(self, tq, group_id):
+        return self._group(self._reader().hgetall(
+            group_key(tq.appname, tq.queuename, group_id)))
+
+    def get_dedupe(self, tq, key):
+        # a retry just after the insertion must see it
+        return not_bytes(self.redis.get(
+            dedupe_key(tq.appname, tq.queuename, key)))
+
+    def claim_dedupe(self, tq, key, value, ttl):
+        dedupekey = dedupe_key(tq.appname, tq.queuename, key)
+        with self.redis.pipeline() as pipe:
+            pipe.set(dedupekey, value, px=int(ttl * 1000), nx=True)
+            pipe.get(dedupekey)
+            return not_bytes(pipe.execute()[1])
+
+
+class ShardedRedisBackend(Backend):
+
+    def __init__(self, connections, ids=None, replicas=None, **options):
+        """spreading taskqueues over several redis servers, every key of
+        a taskqueue is on the server its hash tag maps to
+
+        Adding or removing a server moves taskqueues to other servers,
+        their tasks must be migrated by hand. `ids` is the same as
+        `RedisBackend`, `replicas` is a list of the replicas of every
+        server, and `options` are passed to `RedisBackend`.
+
+        Usage:
+            >>> import redis
+            >>> backend = ShardedRedisBackend([redis.StrictRedis(port=6379),
+            ...                                redis.StrictRedis(port=6380)])
+
+        """
+        if not connections:
+            raise ValueError('at least one redis connection is required')
+        replicas = replicas or [()] * len(connections)
+        self.shards = [RedisBackend(conn, ids, shard_replicas, **options)
+                       for conn, shard_replicas in zip(connections, replicas)]
+
+    def check_replicas(self):
+        """measuring the lag of the replicas of every server, in order
+
+        Returns:
+            same as `RedisBackend.check_replicas`
+
+        """
+        lags = []
+        for shard in self.shards:
+            lags.extend(shard.check_replicas())
+        return lags
+
+    def shard(self, tq):
+        """the backend of the server storing a taskqueue"""
+        return self.shard_of(tq.appname, tq.queuename)
+
+    def shard_of(self, appname, queuename):
+        tag = queue_tag(appname, queuename).encode('utf-8')
+        return self.shards[(crc32(tag) & 0xffffffff) % len(self.shards)]
+
+    def add(self, tq, fields, cname=None, scheduled=False):
+        return self.shard(tq).add(tq, fields, cname, scheduled)
+
+    def dispatched(self, tq, task_id, fields, uuid, old_uuid=None,
+                   due=None):
+        self.shard(tq).dispatched(tq, task_id, fields, uuid, old_uuid, due)
+
+    def get(self, tq, task_id):
+        return self.shard(tq).get(tq, task_id)
+
+    def get_many(self, tq, task_ids):
+        return self.shard(tq).get_many(tq, task_ids)
+
+    def range(self, tq, offset, count):
+        return self.shard(tq).range(tq, offset, count)
+
+    def count(self, tq):
+        return self.shard(tq).count(tq)
+
+    def count_app(self, tq):
+        # the queues of an app are spread over every server
+        return sum(shard.count_app(tq) for shard in self.shards)
+
+    def count_all(self):
+        return sorted(count for shard in self.shards
+                      for count in shard.count_all())
+
+    @property
+    def cold_horizon(self):
+        return self.shards[0].cold_horizon
+
+    def add_cold(self, tq, fields, uuid, due, cname=None):
+        return self.shard(tq).add_cold(tq, fields, uuid, due, cname)
+
+    def pop_cold(self, until, limit=1000):
+        popped = []
+        for shard in self.shards:
+            popped.extend(shard.pop_cold(until, limit - len(popped)))
+            if len(popped) >= limit:
+                break
+        return popped
+
+    def promoted(self, tq, task_ids):
+        return self.shard(tq).promoted(tq, task_ids)
+
+    def id_by_uuid(self, tq, uuid):
+        return self.shard(tq).id_by_uuid(tq, uuid)
+
+    def id_by_cname(self, tq, cname):
+        return self.shard(tq).id_by_cname(tq, cname)
+
+    def delete(self, tq, task_id, uuid, cname=None, scheduled=False):
+        self.shard(tq).delete(tq, task_id, uuid, cname, scheduled)
+
+    def transition(self, tq, task_id, fields, ensure_status):
+        return self.shard(tq).transition(tq, task_id, fields, ensure_status)
+
+    def record_timeline(self, tq, slowest=None, recent=None):
+        self.shard(tq).record_timeline(tq, slowest, recent)
+
+    def get_timelines(self, tq):
+        return self.shard(tq).get_timelines(tq)
+
+    def set_template(self, tq, name, body):
+        return self.shard(tq).set_template(tq, name, body)
+
+    def get_template(self, tq, name):
+        return self.shard(tq).get_template(tq, name)
+
+    def template_version(self, tq, name):
+        return self.shard(tq).template_version(tq, name)
+
+    def delete_template(self, tq, name):
+        return self.shard(tq).delete_template(tq, name)
+
+    def list_templates(self, tq):
+        return self.shard(tq).list_templates(tq)
+
+    def add_targets(self, tq, task_id, targets):
+        return self.shard(tq).add_targets(tq, task_id, targets)
+
+    def pop_targets(self, tq, task_id, count):
+        return self.shard(tq).pop_targets(tq, task_id, count)
+
+    def record_results(self, tq, task_id, results):
+        return self.shard(tq).record_results(tq, task_id, results)
+
+    def get_results(self, tq, task_id):
+        return self.shard(tq).get_results(tq, task_id)
+
+    def push_batch(self, tq, key, task_id):
+        return self.shard(tq).push_batch(tq, key, task_id)
+
+    def pop_batch(self, tq, key, count):
+        return self.shard(tq).pop_batch(tq, key, count)
+
+    def add_group(self, tq, group_id, count, body):
+        return self.shard(tq).add_group(tq, group_id, count, body)
+
+    def group_done(self, tq, group_id, task_id, result):
+        return self.shard(tq).group_done(tq, group_id, task_id, result)
+
+    def get_group(self, tq, group_id):
+        return self.shard(tq).get_group(tq, group_id)
+
+    def get_dedupe(self, tq, key):
+        return self.shard(tq).get_dedupe(tq, key)
+
+    def claim_dedupe(self, tq, key, value, ttl):
+        return self.shard(tq).claim_dedupe(tq, key, value, ttl)
+
+
+class MemoryBackend(Backend):
+
+    def __init__(self):
+        """a backend in the memory of this process, for embedded
+        single-process use, tests and benchmarks
+
+        All operations hold one lock, so it is thread-safe but shared
+        by nothing else than this process.
+
+        Usage:
+            >>> from asynx_core.taskqueue import TaskQueue
+            >>> backend = MemoryBackend()
+            >>> tq = TaskQueue('test')
+            >>> tq.bind_backend(backend)
+
+        """
+        self.lock = threading.RLock()
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            # (app, queue) => last id
+            self._ids = {}
+            # (app, queue, id) => fields
+            self._meta = {}
+            # (app, queue) => sorted ids, id => uuid, uuid => id
+            self._order = {}
+            self._uuids = {}
+            self._ids_by_uuid = {}
+            # (app, queue, cname) => id
+            self._cnames = {}
+            # (app, queue) => set of ids
+            self._sched = {}
+            # app => count
+            self._backlog = {}
+            # (app, queue) => [(score, entry)], [entry]
+            self._slowest = {}
+            self._recent = {}
+            # (app, queue, name) => [version, body or None once deleted]
+            self._templates = {}
+            # (app, queue, id) => targets left, target => result
+            self._targets = {}
+            self._results = {}
+            # (app, queue, key) => ids
+            self._batches = {}
+            # (app, queue, group id) => [count left, body, results]
+            self._groups = {}
+            # (app, queue, idempotency key) => (value, expires at)
+            self._dedupes = {}
+            # heap of (expires at, key), purged as they expire
+            self._dedupe_expiry = []
+
+    def add(self, tq, fields, cname=None, scheduled=False):
+        queue = (tq.appname, tq.queuename)
+        with self.lock:
+            if cname and queue + (cname, ) in self._cnames:
+                return None
+            idx = self._ids[queue] = self._ids.get(queue, 0) + 1
+            if cname:
+                self._cnames[queue + (cname, )] = idx
+            self._meta[queue + (idx, )] = dict(fields)
+            if scheduled:
+                self._sched.setdefault(queue, set()).add(idx)
+            self._backlog[tq.appname] = self._backlog.get(tq.appname, 0) + 1
+        return idx
+
+    def _unindex(self, queue, task_id, uuid):
+        uuids = self._uuids.get(queue, {})
+        if uuids.get(task_id) != uuid:
+            return
+        del uuids[task_id]
+        del self._ids_by_uuid[queue][uuid]
+        order = self._order[queue]
+        del order[bisect.bisect_left(order, task_id)]
+
+    def dispatched(self, tq, task_id, fields, uuid, old_uuid=None,
+                   due=None):
+        queue = (tq.appname, tq.queuename)
+        with self.lock:
+            self._meta.setdefault(queue + (task_id, ), {}).update(fields)
+            if old_uuid:
+                self._unindex(queue, task_id, old_uuid)
+            uuids = self._uuids.setdefault(queue, {})
+            if task_id in uuids:
+                # indexed by another uuid, a zadd would move it
+                self._unindex(queue, task_id, uuids[task_id])
+            uuids[task_id] = uuid
+            self._ids_by_uuid.setdefault(queue, {})[uuid] = task_id
+            bisect.insort(self._order.setdefault(queue, []), task_id)
+
+    def get(self, tq, task_id):
+        with self.lock:
+            return dict(self._meta.get(
+                (tq.appname, tq.queuename, task_id), {}))
+
+    def get_many(self, tq, task_ids):
+        with self.lock:
+            return [self.get(tq, idx) for idx in task_ids]
+
+    def range(self, tq, offset, count):
+        queue = (tq.appname, tq.queuename)
+        with self.lock:
+            uuids = self._uuids.get(queue, {})
+            return [(uuids[idx], idx) for idx in
+                    self._order.get(queue, [])[offset:offset + count]]
+
+    def count(self, tq):
+        with self.lock:
+            return len(self._order.get((tq.appname, tq.queuename), ()))
+
+    def count_app(self, tq):
+        with self.lock:
+            return self._backlog.get(tq.appname, 0)
+
+    def count_all(self):
+        with self.lock:
+            return [(appname, queuename,
+                     len(self._order.get((appname, queuename), ())))
+                    for appname, queuename in self._ids]
+
+    def id_by_uuid(self, tq, uuid):
+        with self.lock:
+            return self._ids_by_uuid.get(
+                (tq.appname, tq.queuename), {}).get(uuid)
+
+    def id_by_cname(self, tq, cname):
+        with self.lock:
+            return self._cnames.get((tq.appname, tq.queuename, cname))
+
+    def delete(self, tq, task_id, uuid, cname=None, scheduled=False):
+        queue = (tq.appname, tq.queuename)
+        with self.lock:
+            if self._meta.pop(queue + (task_id, ), None) is None:
+                return
+            self._backlog[tq.appname] -= 1
+            self._unindex(queue, task_id, uuid)
+            self._targets.pop(queue + (task_id, ), None)
+            self._results.pop(queue + (task_id, ), None)
+            if cname:
+                self._cnames.pop(queue + (cname, ), None)
+            if scheduled:
+                self._sched.get(queue, set()).discard(task_id)
+
+    def transition(self, tq, task_id, fields, ensure_status):
+        with self.lock:
+            meta = self._meta.get((tq.appname, tq.queuename, task_id), {})
+            previous = meta.get('status')
+            if previous not in ensure_status:
+                return False, previous
+            meta.update(fields)
+            return True, previous
+
+    def record_timeline(self, tq, slowest=None, recent=None):
+        queue = (tq.appname, tq.queuename)
+        with self.lock:
+            if slowest:
+                score, entry, limit = slowest
+                kept = self._slowest.setdefault(queue, [])
+                bisect.insort(kept, (score, entry))
+                del kept[:-limit]
+            if recent:
+                entry, limit = recent
+                kept = self._recent.setdefault(queue, [])
+                kept.insert(0, entry)
+                del kept[limit:]
+
+    def get_timelines(self, tq):
+        queue = (tq.appname, tq.queuename)
+        with self.lock:
+            return ([entry for _, entry in
+                     reversed(self._slowest.get(queue, []))],
+                    list(self._recent.get(queue, [])))
+
+    def set_template(self, tq, name, body):
+        key = (tq.appname, tq.queuename, name)
+        with self.lock:
+            version = self._templates.get(key, [0])[0] + 1
+            self._templates[key] = [version, body]
+            return version
+
+    def get_template(self, tq, name):
+        with self.lock:
+            version, body = self._templates.get(
+                (tq.appname, tq.queuename, name), (None, None))
+            return None if body is None else (version, body)
+
+    def template_version(self, tq, name):
+        stored = self.get_template(tq, name)
+        return stored and stored[0]
+
+    def delete_template(self, tq, name):
+        with self.lock:
+            stored = self._templates.get((tq.appname, tq.queuename, name))
+            if not stored or stored[1] is None:
+                return False
+            stored[1] = None
+            return True
+
+    def list_templates(self, tq):
+        with self.lock:
+            return sorted((name, version, body) for (app, queue, name),
+                          (version, body) in dict_items(self._templates)
+                          if (app, queue) == (tq.appname, tq.queuename) and
+                          body is not None)
+
+    def add_targets(self, tq, task_id, targets):
+        with self.lock:
+            self._targets.setdefault(
+                (tq.appname, tq.queuename, task_id), []).extend(targets)
+
+    def pop_targets(self, tq, task_id, count):
+        with self.lock:
+            left = self._targets.get((tq.appname, tq.queuename, task_id), [])
+            targets = left[:count]
+            del left[:count]
+            return targets, len(left)
+
+    def record_results(self, tq, task_id, results):
+        with self.lock:
+            self._results.setdefault(
+                (tq.appname, tq.queuename, task_id), {}).update(results)
+
+    def get_results(self, tq, task_id):
+        with self.lock:
+            return dict(self._results.get(
+                (tq.appname, tq.queuename, task_id), {}))
+
+    def push_batch(self, tq, key, task_id):
+        with self.lock:
+            ids = self._batches.setdefault((tq.appname, tq.queuename, key),
+                                           [])
+            ids.append(task_id)
+            return len(ids)
+
+    def pop_batch(self, tq, key, count):
+        with self.lock:
+            ids = self._batches.get((tq.appname, tq.queuename, key), [])
+            popped = ids[:count]
+            del ids[:count]
+            return popped
+
+    def add_group(self, tq, group_id, count, body):
+        with self.lock:
+            self._groups[(tq.appname, tq.queuename, group_id)] = \
+                [count, body, {}]
+
+    def group_done(self, tq, group_id, task_id, result):
+        key = (tq.appname, tq.queuename, group_id)
+        with self.lock:
+            group = self._groups.get(key)
+            if group is None or str(task_id) in group[2]:
+                return None
+            group[0] -= 1
+            group[2][str(task_id)] = result
+            if group[0] > 0:
+                return None
+            del self._groups[key]
+            return group[1], group[2]
+
+    def get_group(self, tq, group_id):
+        with self.lock:
+            group = self._groups.get((tq.appname, tq.queuename, group_id))
+            return group and (group[0], group[1], dict(group[2]))
+
+    def get_dedupe(self, tq, key):
+        with self.lock:
+            stored = self._dedupes.get((tq.appname, tq.queuename, key))
+            if stored is None or stored[1] <= clock.now():
+                return None
+            return stored[0]
+
+    def claim_dedupe(self, tq, key, value, ttl):
+        key = (tq.appname, tq.queuename, key)
+        now = clock.now()
+        with self.lock:
+            expiry = self._dedupe_expiry
+            while expiry and expiry[0][0] <= now:
+                expires, expired = heapq.heappop(expiry)
+                stored = self._dedupes.get(expired)
+                if stored is not None and stored[1] == expires:
+                    del self._dedupes[expired]
+            stored = self._dedupes.get(key)
+            if stored is not None and stored[1] > now:
+                return stored[0]
+            self._dedupes[key] = (value, now + ttl)
+            heapq.heappush(expiry, (now + ttl, key))
+            return value
+
+
+SQLITE_SCHEMA = (
+    '''CREATE TABLE IF NOT EXISTS ax_sequences (
+        app TEXT NOT NULL, queue TEXT NOT NULL, last_id INTEGER NOT NULL,
+        PRIMARY KEY (app, queue))''',
+    '''CREATE TABLE IF NOT EXISTS ax_backlog (
+        app TEXT NOT NULL PRIMARY KEY, count INTEGER NOT NULL)''',
+    '''CREATE TABLE IF NOT EXISTS ax_tasks (
+        app TEXT NOT NULL, queue TEXT NOT NULL, id INTEGER NOT NULL,
+        uuid TEXT, cname TEXT, status TEXT, due TEXT,
+        scheduled INTEGER NOT NULL DEFAULT 0, fields TEXT NOT NULL,
+        PRIMARY KEY (app, queue, id))''',
+    '''CREATE INDEX IF NOT EXISTS ax_tasks_uuid
+        ON ax_tasks (app, queue, uuid)''',
+    '''CREATE UNIQUE INDEX IF NOT EXISTS ax_tasks_cname
+        ON ax_tasks (app, queue, cname)''',
+    '''CREATE INDEX IF NOT EXISTS ax_tasks_status
+        ON ax_tasks (status, due)''',
+    '''CREATE TABLE IF NOT EXISTS ax_slowest (
+        app TEXT NOT NULL, queue TEXT NOT NULL, score REAL NOT NULL,
+        entry TEXT NOT NULL)''',
+    '''CREATE INDEX IF NOT EXISTS ax_slowest_queue
+        ON ax_slowest (app, queue, score)''',
+    '''CREATE TABLE IF NOT EXISTS ax_recent (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        app TEXT NOT NULL, queue TEXT NOT NULL, entry TEXT NOT NULL)''',
+    '''CREATE INDEX IF NOT EXISTS ax_recent_queue
+        ON ax_recent (app, queue, seq)''',
+    '''CREATE TABLE IF NOT EXISTS ax_templates (
+        app TEXT NOT NULL, queue TEXT NOT NULL, name TEXT NOT NULL,
+        version INTEGER NOT NULL, body TEXT,
+        PRIMARY KEY (app, queue, name))''',
+    '''CREATE TABLE IF NOT EXISTS ax_targets (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        app TEXT NOT NULL, queue TEXT NOT NULL, task_id INTEGER NOT NULL,
+        target TEXT NOT NULL, taken INTEGER NOT NULL DEFAULT 0,
+        result TEXT)''',
+    '''CREATE INDEX IF NOT EXISTS ax_targets_task
+        ON ax_targets (app, queue, task_id, taken, seq)''',
+    '''CREATE UNIQUE INDEX IF NOT EXISTS ax_targets_target
+        ON ax_targets (app, queue, task_id, target)''',
+    '''CREATE TABLE IF NOT EXISTS ax_batches (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        app TEXT NOT NULL, queue TEXT NOT NULL, key TEXT NOT NULL,
+        task_id INTEGER NOT NULL)''',
+    '''CREATE INDEX IF NOT EXISTS ax_batches_key
+        ON ax_batches (app, queue, key, seq)''',
+    '''CREATE TABLE IF NOT EXISTS ax_groups (
+        app TEXT NOT NULL, queue TEXT NOT NULL, id TEXT NOT NULL,
+        pending INTEGER NOT NULL, body TEXT NOT NULL,
+        results TEXT NOT NULL,
+        PRIMARY KEY (app, queue, id))''',
+    '''CREATE TABLE IF NOT EXISTS ax_dedupes (
+        app TEXT NOT NULL, queue TEXT NOT NULL, key TEXT NOT NULL,
+        value TEXT NOT NULL, expires REAL NOT NULL,
+        PRIMARY KEY (app, queue, key))''',
+    '''CREATE INDEX IF NOT EXISTS ax_dedupes_expires
+        ON ax_dedupes (expires)''',
+)
+
+
+def _sqlite_time(timestamp):
+    """a unix timestamp as UTC text sorting in time order, for the `due`
+    column of sqlite
+
+    Doctest:
+        >>> _sqlite_time(1394809766.5)
+        '2014-03-14 15:09:26.500000'
+
+    """
+    return datetime.utcfromtimestamp(timestamp).strftime(
+        '%Y-%m-%d %H:%M:%S.%f')
+
+
+def _sqlite_due(fields):
+    """the due time of a new task in sqlite, its eta or now
+
+    Doctest:
+        >>> _sqlite_due({'eta': '"2014-03-14T23:09:26+08:00"'})
+        '2014-03-14 15:09:26.000000'
+
+    """
+    eta = _loads(fields.get('eta') or 'null')
+    if eta is None:
+        return _sqlite_time(clock.now())
+    eta = parse_datetime(eta).astimezone(utc).replace(tzinfo=None)
+    return eta.strftime('%Y-%m-%d %H:%M:%S.%f')
+
+
+class SqliteBackend(Backend):
+
+    durable = True
+
+    def __init__(self, path, synchronous='NORMAL', timeout=30.0):
+        """a durable backend in a SQLite database in WAL mode, for
+        single-node deployments
+
+        Every thread (and every forked process) opens its own connection.
+        Writers are serialized by SQLite, readers never block them.
+
+        Parameters:
+            - path: string, the database file, created if not exists
+            - synchronous: string, PRAGMA synchronous, "NORMAL" only
+                           syncs at checkpoints, "FULL" on every commit
+            - timeout: float, seconds to wait for another writer
+
+        Usage:
+            >>> import tempfile, os.path
+            >>> path = os.path.join(tempfile.mkdtemp(), 'asynx.db')
+            >>> backend = SqliteBackend(path)
+
+        """
+        self.path = path
+        self.synchronous = synchronous
+        self.timeout = timeout
+        self._local = threading.local()
+        directory = os.path.dirname(os.path.abspath(path))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        conn = self._conn()
+        for statement in SQLITE_SCHEMA:
+            conn.execute(statement)
+
+    def _conn(self):
+        local = self._local
+        if getattr(local, 'pid', None) != os.getpid():
+            # statements are prepared once and cached per connection
+            conn = sqlite3.connect(self.path, timeout=self.timeout,
+                                   isolation_level=None,
+                                   cached_statements=64)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous={0}'.format(self.synchronous))
+            local.conn = conn
+            local.pid = os.getpid()
+            local.depth = 0
+        return local.conn
+
+    @contextmanager
+    def _write(self):
+        conn = self._conn()
+        local = self._local
+        if local.depth:
+            # in a batch, committed at its end
+            local.depth += 1
+            try:
+                yield conn
+            finally:
+                local.depth -= 1
+            return
+        conn.execute('BEGIN IMMEDIATE')
+        local.depth = 1
+        try:
+            yield conn
+        except BaseException:
+            local.depth = 0
+            conn.execute('ROLLBACK')
+            raise
+        local.depth = 0
+        conn.execute('COMMIT')
+
+    def batch(self):
+        return self._write()
+
+    def add(self, tq, fields, cname=None, scheduled=False):
+        app, queue = tq.appname, tq.queuename
+        with self._write() as conn:
+            if cname and conn.execute(
+                    'SELECT 1 FROM ax_tasks WHERE app = ? AND queue = ? '
+                    'AND cname = ?', (app, queue, cname)).fetchone():
+                return None
+            if not conn.execute(
+                    'UPDATE ax_sequences SET last_id = last_id + 1 '
+                    'WHERE app = ? AND queue = ?', (app, queue)).rowcount:
+                conn.execute('INSERT INTO ax_sequences (app, queue, last_id) '
+                             'VALUES (?, ?, 1)', (app, queue))
+            idx = conn.execute(
+                'SELECT last_id FROM ax_sequences WHERE app = ? '
+                'AND queue = ?', (app, queue)).fetchone()[0]
+            conn.execute(
+                'INSERT INTO ax_tasks (app, queue, id, cname, status, due, '
+                'scheduled, fields) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (app, queue, idx, cname, fields.get('status'),
+                 _sqlite_due(fields), int(bool(scheduled)), _dumps(fields)))
+            self._count(conn, app, 1)
+        return idx
+
+    @staticmethod
+    def _count(conn, app, delta):
+        if not conn.execute('UPDATE ax_backlog SET count = count + ? '
+                            'WHERE app = ?', (delta, app)).rowcount:
+            conn.execute('INSERT INTO ax_backlog (app, count) VALUES (?, ?)',
+                         (app, delta))
+
+    def _update(self, conn, tq, task_id, fields, uuid=None, due=None):
+        row = conn.execute(
+            'SELECT fields FROM ax_tasks WHERE app = ? AND queue = ? '
+            'AND id = ?', (tq.appname, tq.queuename, task_id)).fetchone()
+        if row is None:
+            return None
+        stored = _loads(row[0])
+        stored.update(fields)
+        if due is not None:
+            due = _sqlite_time(due)
+        conn.execute(
+            'UPDATE ax_tasks SET uuid = COALESCE(?, uuid), status = ?, '
+            'due = COALESCE(?, due), fields = ? WHERE app = ? AND queue = ? '
+            'AND id = ?', (uuid, stored.get('status'), due, _dumps(stored),
+                           tq.appname, tq.queuename, task_id))
+        return stored
+
+    def dispatched(self, tq, task_id, fields, uuid, old_uuid=None,
+                   due=None):
+        with self._write() as conn:
+            self._update(conn, tq, task_id, fields, uuid, due)
+
+    def get(self, tq, task_id):
+        row = self._conn().execute(
+            'SELECT fields FROM ax_tasks WHERE app = ? AND queue = ? '
+            'AND id = ?', (tq.appname, tq.queuename, task_id)).fetchone()
+        return _loads(row[0]) if row else {}
+
+    def get_many(self, tq, task_ids):
+        return [self.get(tq, idx) for idx in task_ids]
+
+    def range(self, tq, offset, count):
+        return self._conn().execute(
+            'SELECT uuid, id FROM ax_tasks WHERE app = ? AND queue = ? '
+            'AND uuid IS NOT NULL ORDER BY id LIMIT ? OFFSET ?',
+            (tq.appname, tq.queuename, count, offset)).fetchall()
+
+    def count(self, tq):
+        return self._conn().execute(
+            'SELECT COUNT(*) FROM ax_tasks WHERE app = ? AND queue = ? '
+            'AND uuid IS NOT NULL', (tq.appname, tq.queuename)).fetchone()[0]
+
+    def count_app(self, tq):
+        row = self._conn().execute(
+            'SELECT count FROM ax_backlog WHERE app = ?',
+            (tq.appname, )).fetchone()
+        return row[0] if row else 0
+
+    def count_all(self):
+        return [tuple(row) for row in self._conn().execute(
+            'SELECT s.app, s.queue, (SELECT COUNT(*) FROM ax_tasks t '
+            'WHERE t.app = s.app AND t.queue = s.queue '
+            'AND t.uuid IS NOT NULL) FROM ax_sequences s')]
+
+    def id_by_uuid(self, tq, uuid):
+        row = self._conn().execute(
+            'SELECT id FROM ax_tasks WHERE app = ? AND queue = ? '
+            'AND uuid = ?', (tq.appname, tq.queuename, uuid)).fetchone()
+        return row[0] if row else None
+
+    def id_by_cname(self, tq, cname):
+        row = self._conn().execute(
+            'SELECT id FROM ax_tasks WHERE app = ? AND queue = ? '
+            'AND cname = ?', (tq.appname, tq.queuename, cname)).fetchone()
+        return row[0] if row else None
+
+    def delete(self, tq, task_id, uuid, cname=None, scheduled=False):
+        with self._write() as conn:
+            if conn.execute(
+                    'DELETE FROM ax_tasks WHERE app = ? AND queue = ? '
+                    'AND id = ?',
+                    (tq.appname, tq.queuename, task_id)).rowcount:
+                self._count(conn, tq.appname, -1)
+                conn.execute('DELETE FROM ax_targets WHERE app = ? AND '
+                             'queue = ? AND task_id = ?',
+                             (tq.appname, tq.queuename, task_id))
+
+    def claim_stale(self, until, limit=1000):
+        with self._write() as conn:
+            rows = conn.execute(
+                'SELECT app, queue, id, fields FROM ax_tasks WHERE '
+                'status IN (?, ?, ?) AND due <= ? ORDER BY due LIMIT ?',
+                (_dumps('new'), _dumps('delayed'), _dumps('scheduled'),
+                 _sqlite_time(until), limit)).fetchall()
+            now = _sqlite_time(clock.now())
+            conn.executemany(
+                'UPDATE ax_tasks SET due = ? WHERE app = ? AND queue = ? '
+                'AND id = ?', [(now, app, queue, idx)
+                               for app, queue, idx, _ in rows])
+        return [(app, queue, idx, _loads(fields))
+                for app, queue, idx, fields in rows]
+
+    def transition(self, tq, task_id, fields, ensure_status):
+        with self._write() as conn:
+            row = conn.execute(
+                'SELECT status FROM ax_tasks WHERE app = ? AND queue = ? '
+                'AND id = ?', (tq.appname, tq.queuename, task_id)).fetchone()
+            previous = row[0] if row else None
+            if previous not in ensure_status:
+                return False, previous
+            self._update(conn, tq, task_id, fields)
+            return True, previous
+
+    def record_timeline(self, tq, slowest=None, recent=None):
+        app, queue = tq.appname, tq.queuename
+        with self._write() as conn:
+            if slowest:
+                score, entry, limit = slowest
+                conn.execute('INSERT INTO ax_slowest (app, queue, score, '
+                             'entry) VALUES (?, ?, ?, ?)',
+                             (app, queue, score, entry))
+                conn.execute(
+                    'DELETE FROM ax_slowest WHERE app = ? AND queue = ? '
+                    'AND rowid NOT IN (SELECT rowid FROM ax_slowest '
+                    'WHERE app = ? AND queue = ? ORDER BY score DESC '
+                    'LIMIT ?)', (app, queue, app, queue, limit))
+            if recent:
+                entry, limit = recent
+                conn.execute('INSERT INTO ax_recent (app, queue, entry) '
+                             'VALUES (?, ?, ?)', (app, queue, entry))
+                conn.execute(
+                    'DELETE FROM ax_recent WHERE app = ? AND queue = ? '
+                    'AND seq <= (SELECT seq FROM ax_recent WHERE app = ? '
+                    'AND queue = ? ORDER BY seq DESC LIMIT 1 OFFSET ?)',
+                    (app, queue, app, queue, limit))
+
+    def get_timelines(self, tq):
+        conn = self._conn()
+        args = (tq.appname, tq.queuename)
+        slowest = conn.execute(
+            'SELECT entry FROM ax_slowest WHERE app = ? AND queue = ? '
+            'ORDER BY score DESC', args).fetchall()
+        recent = conn.execute(
+            'SELECT entry FROM ax_recent WHERE app = ? AND queue = ? '
+            'ORDER BY seq DESC', args).fetchall()
+        return [r[0] for r in slowest], [r[0] for r in recent]
+
+    def set_template(self, tq, name, body):
+        args = (tq.appname, tq.queuename, name)
+        with self._write() as conn:
+            if not conn.execute(
+                    'UPDATE ax_templates SET version = version + 1, '
+                    'body = ? WHERE app = ? AND queue = ? AND name = ?',
+                    (body, ) + args).rowcount:
+                conn.execute('INSERT INTO ax_templates (app, queue, name, '
+                             'version, body) VALUES (?, ?, ?, 1, ?)',
+                             args + (body, ))
+            return conn.execute(
+                'SELECT version FROM ax_templates WHERE app = ? '
+                'AND queue = ? AND name = ?', args).fetchone()[0]
+
+    def get_template(self, tq, name):
+        row = self._conn().execute(
+            'SELECT version, body FROM ax_templates WHERE app = ? '
+            'AND queue = ? AND name = ? AND body IS NOT NULL',
+            (tq.appname, tq.queuename, name)).fetchone()
+        return tuple(row) if row else None
+
+    def template_version(self, tq, name):
+        row = self._conn().execute(
+            'SELECT version FROM ax_templates WHERE app = ? '
+            'AND queue = ? AND name = ? AND body IS NOT NULL',
+            (tq.appname, tq.queuename, name)).fetchone()
+        return row[0] if row else None
+
+    def delete_template(self, tq, name):
+        with self._write() as conn:
+            return bool(conn.execute(
+                'UPDATE ax_templates SET body = NULL WHERE app = ? '
+                'AND queue = ? AND name = ? AND body IS NOT NULL',
+                (tq.appname, tq.queuename, name)).rowcount)
+
+    def list_templates(self, tq):
+        return [tuple(row) for row in self._conn().execute(
+            'SELECT name, version, body FROM ax_templates WHERE app = ? '
+            'AND queue = ? AND body IS NOT NULL ORDER BY name',
+            (tq.appname, tq.queuename))]
+
+    def add_targets(self, tq, task_id, targets):
+        args = (tq.appname, tq.queuename, task_id)
+        with self._write() as conn:
+            conn.executemany('INSERT INTO ax_targets (app, queue, task_id, '
+                             'target) VALUES (?, ?, ?, ?)',
+                             [args + (target, ) for target in targets])
+
+    def pop_targets(self, tq, task_id, count):
+        args = (tq.appname, tq.queuename, task_id)
+        with self._write() as conn:
+            rows = conn.execute(
+                'SELECT seq, target FROM ax_targets WHERE app = ? AND '
+                'queue = ? AND task_id = ? AND taken = 0 ORDER BY seq '
+                'LIMIT ?', args + (count, )).fetchall()
+            if rows:
+                conn.execute('UPDATE ax_targets SET taken = 1 WHERE seq '
+                             'BETWEEN ? AND ? AND taken = 0 AND app = ? AND '
+                             'queue = ? AND task_id = ?',
+                             (rows[0][0], rows[-1][0]) + args)
+            left = conn.execute(
+                'SELECT COUNT(*) FROM ax_targets WHERE app = ? AND '
+                'queue = ? AND task_id = ? AND taken = 0',
+                args).fetchone()[0]
+        return [row[1] for row in rows], left
+
+    def record_results(self, tq, task_id, results):
+        args = (tq.appname, tq.queuename, task_id)
+        with self._write() as conn:
+            conn.executemany('UPDATE ax_targets SET result = ? WHERE app = ? '
+                             'AND queue = ? AND task_id = ? AND target = ?',
+                             [(result, ) + args + (target, )
+                              for target, result in results])
+
+    def get_results(self, tq, task_id):
+        return dict(self._conn().execute(
+            'SELECT target, result FROM ax_targets WHERE app = ? AND '
+            'queue = ? AND task_id = ? AND result IS NOT NULL',
+            (tq.appname, tq.queuename, task_id)).fetchall())
+
+    def push_batch(self, tq, key, task_id):
+        args = (tq.appname, tq.queuename, key)
+        with self._write() as conn:
+            conn.execute('INSERT INTO ax_batches (app, queue, key, task_id) '
+                         'VALUES (?, ?, ?, ?)', args + (task_id, ))
+            return conn.execute(
+                'SELECT COUNT(*) FROM ax_batches WHERE app = ? AND '
+                'queue = ? AND key = ?', args).fetchone()[0]
+
+    def pop_batch(self, tq, key, count):
+        args = (tq.appname, tq.queuename, key)
+        with self._write() as conn:
+            rows = conn.execute(
+                'SELECT seq, task_id FROM ax_batches WHERE app = ? AND '
+                'queue = ? AND key = ? ORDER BY seq LIMIT ?',
+                args + (count, )).fetchall()
+            if rows:
+                conn.execute('DELETE FROM ax_batches WHERE app = ? AND '
+                             'queue = ? AND key = ? AND seq <= ?',
+                             args + (rows[-1][0], ))
+        return [row[1] for row in rows]
+
+    def add_group(self, tq, group_id, count, body):
+        with self._write() as conn:
+            conn.execute('INSERT INTO ax_groups (app, queue, id, pending, '
+                         'body, results) VALUES (?, ?, ?, ?, ?, ?)',
+                         (tq.appname, tq.queuename, group_id, count, body,
+                          '{}'))
+
+    def group_done(self, tq, group_id, task_id, result):
+        args = (tq.appname, tq.queuename, group_id)
+        with self._write() as conn:
+            row = conn.execute('SELECT pending, body, results FROM ax_groups '
+                               'WHERE app = ? AND queue = ? AND id = ?',
+                               args).fetchone()
+            if row is None:
+                return None
+            left, body, results = row[0] - 1, row[1], _loads(row[2])
+            if str(task_id) in results:
+                return None
+            results[str(task_id)] = result
+            if left > 0:
+                conn.execute('UPDATE ax_groups SET pending = ?, results = ? '
+                             'WHERE app = ? AND queue = ? AND id = ?',
+                             (left, _dumps(results)) + args)
+                return None
+            conn.execute('DELETE FROM ax_groups WHERE app = ? AND queue = ? '
+                         'AND id = ?', args)
+            return body, results
+
+    def get_group(self, tq, group_id):
+        row = self._conn().execute(
+            'SELECT pending, body, results FROM ax_groups WHERE app = ? AND '
+            'queue = ? AND id = ?',
+            (tq.appname, tq.queuename, group_id)).fetchone()
+        return row and (row[0], row[1], _loads(row[2]))
+
+    def get_dedupe(self, tq, key):
+        row = self._conn().execute(
+            'SELECT value FROM ax_dedupes WHERE app = ? AND queue = ? AND '
+            'key = ? AND expires > ?',
+            (tq.appname, tq.queuename, key, clock.now())).fetchone()
+        return row and row[0]
+
+    def claim_dedupe(self, tq, key, value, ttl):
+        args = (tq.appname, tq.queuename, key)
+        now = clock.now()
+        with self._write() as conn:
+            # every expired key, not only this one
+            conn.execute('DELETE FROM ax_dedupes WHERE expires <= ?',
+                         (now, ))
+            conn.execute('INSERT OR IGNORE INTO ax_dedupes (app, queue, key, '
+                         'value, expires) VALUES (?, ?, ?, ?, ?)',
+                         args + (value, now + ttl))
+            return conn.execute(
+                'SELECT value FROM ax_dedupes WHERE app = ? AND queue = ? '
+                'AND key = ?', args).fetchone()[0]
+
+
+def as_backend(obj):
+    """a backend, or a RedisBackend of a redis connection
+
+    Doctest:
+        >>> backend = MemoryBackend()
+        >>> as_backend(backend) is backend
+        True
+
+    """
+    if isinstance(obj, Backend):
+        return obj
+    return RedisBackend(obj)
+
+
+def _same_server(conn1, conn2):
+    kwargs1 = conn1.connection_pool.connection_kwargs
+    kwargs2 = conn2.connection_pool.connection_kwargs
+    return all(kwargs1.get(key) == kwargs2.get(key)
+               for key in ('host', 'port', 'path', 'db'))
+
+
+def migrate_keys(connection, backend=None):
+    """moving tasks of a redis database from the key layout without hash
+    tags (a global "AX:INC" and "AX:BACKLOG") to the current one
+
+    Run it with asynxd and celery stopped, on the redis server before
+    moving it to a cluster.
+
+    Parameters:
+        - connection: redis connection of the server with the old keys
+        - backend: optional, a ShardedRedisBackend, every queue is moved
+                   to the server of its shard, default they stay on
+                   `connection`
+
+    Returns:
+        a list of (appname, queuename) migrated
+
+    """
+    r = connection
+    migrated = []
+    for name, last_id in sorted(r.hgetall('AX:INC').items()):
+        name = not_bytes(name)
+        appname, _, queuename = name.partition(':')
+        dest = r
+        if backend is not None:
+            dest = backend.shard_of(appname, queuename).redis
+            if _same_server(dest, r):
+                dest = r
+        renames = [('AX:{0}:{1}'.format(kind, name), new(appname, queuename))
+                   for kind, new in (('SC', sched_key), ('UUID', uuid_key),
+                                     ('SLOW', slow_key),
+                                     ('RECENT', recent_key))]
+        with r.pipeline(transaction=False) as pipe:
+            for old, _ in renames:
+                pipe.exists(old)
+            renames = [pair for pair, exists
+                       in zip(renames, pipe.execute()) if exists]
+        backlog = 0
+        for kind, new in (('META', meta_key), ('CNAME', cname_key)):
+            prefix = 'AX:{0}:{1}:'.format(kind, name)
+            for key in r.scan_iter(match=prefix + '*', count=1000):
+                key = not_bytes(key)
+                suffix = key[len(prefix):]
+                if kind == 'META':
+                    if not suffix.isdigit():
+                        # a task of another queue named "queue:..."
+                        continue
+                    backlog += 1
+                renames.append((key, new(appname, queuename, suffix)))
+        incrkey, incrhash = incr_key(appname, queuename)
+        backlogkey, backloghash = backlog_key(appname, queuename)
+        if dest is not r:
+            # to another server, the keys are copied then deleted
+            with r.pipeline(transaction=False) as pipe:
+                for old, _ in renames:
+                    pipe.dump(old)
+                dumps = pipe.execute()
+            with dest.pipeline(transaction=False) as pipe:
+                for (_, new), dumped in zip(renames, dumps):
+                    pipe.restore(new, 0, dumped)
+                pipe.execute()
+            if renames:
+                r.delete(*[old for old, _ in renames])
+            renames = []
+        with dest.pipeline(transaction=False) as pipe:
+            for old, new in renames:
+                pipe.rename(old, new)
+            pipe.hset(incrkey, incrhash, last_id)
+            pipe.hset(backlogkey, backloghash, backlog)
+            pipe.sadd(apps_key(), appname)
+            pipe.sadd(queues_key(appname), queuename)
+            pipe.execute()
+        r.hdel('AX:INC', name)
+        migrated.append((appname, queuename))
+    r.delete('AX:BACKLOG')
+    return migrated
+
+
+def compact_keys(connection, compact=True):
+    """moving the tasks of a redis database to the compact encoding and
+    its shorter keys, or back if not `compact`
+
+    Run it with asynxd and celery stopped, then restart them with the
+    encoding changed.
+
+    Returns:
+        a list of (appname, queuename, moved)
+
+    """
+    r = connection
+    source, target = meta_key, compact_meta_key
+    if not compact:
+        source, target = target, source
+    migrated = []
+    for appname, queuename in RedisBackend(r)._queues(r):
+        prefix = source(appname, queuename, '')
+        moved = 0
+        for key in r.scan_iter(match=prefix + '*', count=1000):
+            key = not_bytes(key)
+            idx = key[len(prefix):]
+            if not idx.isdigit():
+                continue
+            fields = r.hgetall(key)
+            if compact:
+                fields = encode_compact(dict(
+                    (not_bytes(name), not_bytes(value))
+                    for name, value in dict_items(fields)), False)
+            else:
+                fields = decode_compact(fields)
+            with r.pipeline() as pipe:
+                pipe.hmset(target(appname, queuename, idx), fields)
+                pipe.delete(key)
+                pipe.execute()
+            moved += 1
+        coldkey = cold_key(appname, queuename)
+        for idx, blob in r.hscan_iter(coldkey, count=1000):
+            fields = unpack(blob)
+            if compact and 'request' in fields:
+                fields = encode_compact(fields, False)
+            elif not compact and 'r' in fields:
+                fields = decode_compact(fields)
+            r.hset(coldkey, idx, pack(fields))
+        migrated.append((appname, queuename, moved))
+    return migrated
+
+
+def memory_report(connection, samples=500):
+    """sampling the memory used by the task hashes of a redis database
+    with MEMORY USAGE (redis >= 4.0)
+
+    Returns:
+        a dict by encoding, "full" or "compact", of the count of hashes
+        sampled, their mean bytes and a dict counting the object encodings
+        of redis, plus "cold" for the mean bytes of cold tasks
+
+    """
+    r = connection
+    report = {}
+    for name, prefix in (('full', 'AX:META:'), ('compact', 'AX:M:')):
+        sizes = []
+        encodings = {}
+        for key in r.scan_iter(match=prefix + '*', count=1000):
+            if len(sizes) >= samples:
+                break
+            with r.pipeline(transaction=False) as pipe:
+                pipe.execute_command('MEMORY', 'USAGE', key, 'SAMPLES', 0)
+                pipe.object('encoding', key)
+                size, encoding = pipe.execute()
+            if size is None:
+                continue  # expired or deleted meanwhile
+            sizes.append(size)
+            encoding = not_bytes(encoding)
+            encodings[encoding] = encodings.get(encoding, 0) + 1
+        report[name] = {
+            'sampled': len(sizes),
+            'bytes_per_task': sum(sizes) / float(len(sizes)) if sizes else 0,
+            'encodings': encodings}
+    tasks = size = 0
+    for key in r.scan_iter(match='AX:COLD:*', count=1000):
+        with r.pipeline(transaction=False) as pipe:
+            pipe.hlen(key)
+            # estimated from a sample of the entries of large hashes
+            pipe.execute_command('MEMORY', 'USAGE', key)
+            count, usage = pipe.execute()
+        tasks += count
+        size += usage or 0
+    report['cold'] = {'tasks': tasks,
+                      'bytes_per_task': size / float(tasks) if tasks else 0}
+    return report
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+
+import time
+import threading
+from datetime import datetime
+
+from pytz import utc
+
+
+class SystemClock(object):
+    """the wall clock"""
+
+    def time(self):
+        return time.time()
+
+    def utcnow(self):
+        return utc.localize(datetime.utcnow())
+
+
+class VirtualClock(SystemClock):
+
+    def __init__(self, start=None):
+        """a clock which only moves when told, for simulations and tests
+
+        Parameters:
+            - start: optional, float, unix timestamp, default now
+
+        Doctest:
+            >>> clock = VirtualClock(0)
+            >>> clock.advance(90)
+            >>> clock.time()
+            90.0
+            >>> clock.utcnow()
+            datetime.datetime(1970, 1, 1, 0, 1, 30, tzinfo=<UTC>)
+
+        """
+        self._now = float(time.time() if start is None else start)
+        self._lock = threading.Lock()
+
+    def time(self):
+        return self._now
+
+    def utcnow(self):
+        return utc.localize(datetime.utcfromtimestamp(self._now))
+
+    def advance(self, seconds):
+        with self._lock:
+            self._now += seconds
+
+    def set(self, timestamp):
+        """moving the clock to `timestamp`, never backwards"""
+        with self._lock:
+            self._now = max(self._now, float(timestamp))
+
+
+_clock = SystemClock()
+
+
+def get_clock():
+    return _clock
+
+
+def set_clock(clock):
+    """replacing the clock of asynx-core, returning the previous one
+
+    Usage:
+        >>> previous = set_clock(VirtualClock(0))
+        >>> get_clock().time()
+        0.0
+        >>> clock = set_clock(previous)
+
+    """
+    global _clock
+    previous, _clock = _clock, clock
+    return previous
+
+
+def now():
+    """unix timestamp of the current clock"""
+    return _clock.time()
+
+
+def utcnow():
+    """timezone-aware UTC datetime of the current clock"""
+    return _clock.utcnow()
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+
+import zlib
+import base64
+
+from ._util import basestring
+
+try:
+    import zstandard
+except ImportError:
+    # optional, only required by the "zstd" codec
+    zstandard = None
+
+# key of the dict replacing a compressed payload, payloads are strings
+MARKER = '$compressed'
+
+
+def compress_payload(payload, threshold, codec='zlib'):
+    """compressing a payload at least `threshold` bytes long
+
+    Parameters:
+        - payload: the payload of a request
+        - threshold: integer, bytes from which payloads are compressed
+        - codec: "zlib", or "zstd" which requires the zstandard
+                 package wherever the payload is read
+
+    Returns:
+        the payload, or a dict of the codec as MARKER and the base64 of
+        the compressed payload as "data" if it is smaller
+
+    Doctest:
+        >>> compressed = compress_payload('{"a": 1}' * 100, 100, 'zlib')
+        >>> compressed[MARKER], len(compressed['data']) < 800
+        ('zlib', True)
+        >>> decompress_payload(compressed) == '{"a": 1}' * 100
+        True
+        >>> compress_payload('{"a": 1}', 100)
+        '{"a": 1}'
+
+    """
+    if not isinstance(payload, basestring) or len(payload) < threshold:
+        return payload
+    if codec == 'zstd' and zstandard is None:
+        raise RuntimeError('the zstandard package is required to '
+                           'compress payloads with zstd')
+    raw = payload if isinstance(payload, bytes) else payload.encode('utf-8')
+    if codec == 'zstd':
+        data = zstandard.ZstdCompressor().compress(raw)
+    else:
+        data = zlib.compress(raw, 6)
+    data = base64.b64encode(data).decode('ascii')
+    if len(data) >= len(payload):
+        return payload
+    return {MARKER: codec, 'data': data}
+
+
+def is_compressed(payload):
+    return isinstance(payload, dict) and MARKER in payload
+
+
+def decompress_payload(payload):
+    """the original of a payload returned by `compress_payload`"""
+    if not is_compressed(payload):
+        return payload
+    data = base64.b64decode(payload['data'])
+    if payload[MARKER] == 'zstd':
+        if zstandard is None:
+            raise RuntimeError('the zstandard package is required to read '
+                               'payloads compressed with zstd')
+        data = zstandard.ZstdDecompressor().decompress(data)
+    else:
+        data = zlib.decompress(data)
+    return data.decode('utf-8')
+
+
+def compress_request(request, threshold, codec='zlib'):
+    """a copy of a request with its payload compressed, or the request
+    if it is not"""
+    payload = request.get('payload')
+    compressed = compress_payload(payload, threshold, codec)
+    if compressed is payload:
+        return request
+    request = dict(request)
+    request['payload'] = compressed
+    return request
+
+
+def expand_request(request):
+    """a copy of a request with its payload decompressed, or the request
+    if it is not compressed"""
+    if not isinstance(request, dict) or \
+            not is_compressed(request.get('payload')):
+        return request
+    request = dict(request)
+    request['payload'] = decompress_payload(request['payload'])
+    return request
@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+
+import os
+import re
+import time
+import socket
+import logging
+import cProfile
+import functools
+import itertools
+
+logger = logging.getLogger(__name__)
+
+# registered hooks, wrappers check it's empty before anything else
+_hooks = []
+
+
+class Event(object):
+    """a lifecycle step passed to hooks
+
+    Attributes:
+        - step: string, one of:
+            "add_task", inserting a task
+            "dispatch_task", sending a task to celery
+            "dispatch", running a task, from its status update to
+                        its deletion
+            "request", the HTTP request of a task, until the response
+                       headers are read
+            "callback", a callback of a task
+        - taskqueue: the TaskQueue object, or None
+        - task: the Task object, for "add_task" the inserted one once
+                the step ended, None before or if it failed
+        - start: float, unix timestamp when the step started
+        - elapsed: float, seconds of the step, None before it ended
+        - exception: the exception raised by the step, or None
+        - result: the return value of the step, for "add_task" the dict
+                  of the JSON-encoded fields of the inserted task
+        - data: dict, for hooks keeping states between before and after
+
+    """
+
+    __slots__ = ('step', 'taskqueue', 'task', 'start', 'elapsed',
+                 'exception', 'result', 'data')
+
+    def __init__(self, step, taskqueue, task):
+        self.step = step
+        self.taskqueue = taskqueue
+        self.task = task
+        self.start = time.time()
+        self.elapsed = None
+        self.exception = None
+        self.result = None
+        self.data = {}
+
+
+class Hook(object):
+    """base class of hooks, override `before` and/or `after`"""
+
+    def before(self, event):
+        pass
+
+    def after(self, event):
+        pass
+
+
+def register(hook):
+    """registering a hook, which is called around every lifecycle step
+    in the order of registration (`after` in the reverse order)
+
+    Usage:
+        >>> class Printer(Hook):
+        ...     def after(self, event):
+        ...         print(event.step)
+        >>> hook = register(Printer())
+        >>> unregister(hook)
+
+    """
+    _hooks.append(hook)
+    return hook
+
+
+def unregister(hook):
+    _hooks.remove(hook)
+
+
+def clear():
+    del _hooks[:]
+
+
+def _call(method, event):
+    try:
+        method(event)
+    except Exception:
+        logger.exception('hook %r failed on step "%s"',
+                         getattr(method, '__self__', method), event.step)
+
+
+def _event(step, obj, args):
+    if hasattr(obj, '_taskqueue'):
+        # a Task
+        task = obj
+        try:
+            taskqueue = obj.taskqueue
+        except RuntimeError:
+            taskqueue = None
+    else:
+        taskqueue = obj
+        task = args[0] if args and hasattr(args[0], '_taskqueue') else None
+    return Event(step, taskqueue, task)
+
+
+def hooked(step, returns_task=False):
+    """decorating a method of TaskQueue or Task as a lifecycle step,
+    `returns_task` if it returns a tuple of a Task and its fields, which
+    are passed to hooks as the event's task and result"""
+
+    def decorator(func):
+
+        @functools.wraps(func)
+        def wrapper(obj, *args, **kwargs):
+            if not _hooks:
+                return func(obj, *args, **kwargs)
+            hooks = list(_hooks)
+            event = _event(step, obj, args)
+            for hook in hooks:
+                _call(hook.before, event)
+            try:
+                result = func(obj, *args, **kwargs)
+                if returns_task:
+                    event.task, event.result = result
+                else:
+                    event.result = result
+                return result
+            except Exception as e:
+                event.exception = e
+                raise
+            finally:
+                event.elapsed = time.time() - event.start
+                for hook in reversed(hooks):
+                    _call(hook.after, event)
+        return wrapper
+    return decorator
+
+
+_unsafe = re.compile(r'[^A-Za-z0-9_-]')
+
+
+class StatsdHook(Hook):
+
+    def __init__(self, host='127.0.0.1', port=8125, prefix='asynx',
+                 steps=None):
+        """sending the timing of steps to statsd over UDP
+
+        Metrics are named "{prefix}.{app}.{queue}.{step}", failed steps
+        also increase the counter "{prefix}.{app}.{queue}.{step}.error".
+
+        Parameters:
+            - host: string, statsd host
+            - port: integer, statsd port
+            - prefix: string, prefix of metric names
+            - steps: optional, a collection of steps to be sent,
+                     default all
+
+        """
+        self.address = (host, port)
+        self.prefix = prefix
+        self.steps = steps
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._sock.setblocking(False)
+
+    def _name(self, event):
+        tq = event.taskqueue
+        if tq is None:
+            parts = ('-', '-')
+        else:
+            parts = (_unsafe.sub('_', tq.appname),
+                     _unsafe.sub('_', tq.queuename))
+        return '{0}.{1}.{2}.{3}'.format(self.prefix, parts[0], parts[1],
+                                        event.step)
+
+    def after(self, event):
+        if self.steps is not None and event.step not in self.steps:
+            return
+        name = self._name(event)
+        packet = '{0}:{1:.3f}|ms'.format(name, event.elapsed * 1000)
+        if event.exception is not None:
+            packet += '\n{0}.error:1|c'.format(name)
+        try:
+            self._sock.sendto(packet.encode('utf-8'), self.address)
+        except socket.error:
+            pass  # never block or fail a task for statsd
+
+
+class ProfileHook(Hook):
+
+    def __init__(self, every=100, directory='/tmp/asynx-profile',
+                 step='dispatch'):
+        """profiling every Nth step with cProfile
+
+        Profiles are dumped in `directory` as
+        "{app}-{queue}-{task id}-{timestamp}.prof", readable by pstats.
+
+        Parameters:
+            - every: integer, profiles one of every `every` steps
+            - directory: string, where the profiles are dumped
+            - step: string, the step to be profiled
+
+        """
+        self.every = every
+        self.directory = directory
+        self.step = step
+        self._counter = itertools.count(1)
+        try:
+            os.makedirs(directory)
+        except OSError:
+            pass
+
+    def before(self, event):
+        if event.step != self.step or next(self._counter) % self.every:
+            return
+        profile = cProfile.Profile()
+        event.data['profile'] = profile
+        profile.enable()
+
+    def after(self, event):
+        profile = event.data.pop('profile', None)
+        if profile is None:
+            return
+        profile.disable()
+        tq, task = event.taskqueue, event.task
+        filename = '{0}-{1}-{2}-{3:.6f}.prof'.format(
+            _unsafe.sub('_', tq.appname) if tq else '-',
+            _unsafe.sub('_', tq.queuename) if tq else '-',
+            task.id if task else '-', event.start)
+        profile.dump_stats(os.path.join(self.directory, filename))
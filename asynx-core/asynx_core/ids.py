@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+
+import os
+import atexit
+import random
+import threading
+from uuid import uuid4
+
+from celery.signals import worker_process_shutdown
+
+from . import clock
+
+# 2015-01-01 00:00:00 UTC, in milliseconds
+EPOCH = 1420070400000
+# ids are scores of the AX:UUID sorted sets, doubles are exact up to 2^53
+TIME_BITS = 41
+WORKER_BITS = 7
+SEQUENCE_BITS = 5
+
+LEASE_KEY = 'AX:WORKERID:{0}'
+
+RENEW_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+class WorkerIdExhausted(RuntimeError):
+    pass
+
+
+class SnowflakeIds(object):
+
+    def __init__(self, connection=None, worker_id=None, ttl=60):
+        """time-ordered task ids allocated without a round trip
+
+        An id is made of the milliseconds since 2015 (41 bits, until
+        2084), a worker id (7 bits) and a sequence in the millisecond
+        (5 bits). It fits 53 bits, so ids stay exact as scores of sorted
+        sets and in JavaScript. More than 32 ids in a millisecond borrow
+        the next millisecond instead of waiting.
+
+        The worker id is leased from redis on the first id of a process
+        and renewed every `ttl` / 3 seconds while ids are allocated. A
+        lease lost in between is replaced by a new one. It is released at
+        exit, or when a celery pool process shuts down (they exit without
+        running atexit), and else expires after `ttl` seconds.
+
+        Parameters:
+            - connection: redis connection leasing worker ids
+            - worker_id: optional, integer, a fixed worker id instead
+            - ttl: integer, seconds a lease lasts without renewal
+
+        Doctest:
+            >>> ids = SnowflakeIds(worker_id=3)
+            >>> first, second = ids.next_id(), ids.next_id()
+            >>> first < second < 2 ** 53
+            True
+            >>> ids.worker_of(first)
+            3
+
+        """
+        if connection is None and worker_id is None:
+            raise ValueError('either a redis connection or a worker id '
+                             'is required')
+        if worker_id is not None and not 0 <= worker_id < 2 ** WORKER_BITS:
+            raise ValueError('worker id must be in [0, {0})'
+                             .format(2 ** WORKER_BITS))
+        self.redis = connection
+        self.ttl = ttl
+        self._fixed = worker_id
+        self._lock = threading.Lock()
+        self._pid = None
+        self._token = None
+        self._leased_at = None
+        self.worker_id = worker_id
+        self._last = -1
+        self._sequence = 0
+        if connection is not None:
+            self._renew_script = connection.register_script(RENEW_SCRIPT)
+            self._release_script = connection.register_script(RELEASE_SCRIPT)
+            atexit.register(self.release)
+            # celery pool processes exit with os._exit, skipping atexit
+            worker_process_shutdown.connect(self._process_shutdown,
+                                            weak=False)
+
+    def _lease(self):
+        token = uuid4().hex
+        size = 2 ** WORKER_BITS
+        start = random.randrange(size)
+        for i in range(size):
+            worker_id = (start + i) % size
+            if self.redis.set(LEASE_KEY.format(worker_id), token,
+                              nx=True, ex=self.ttl):
+                self.worker_id = worker_id
+                self._token = token
+                self._pid = os.getpid()
+                self._leased_at = clock.now()
+                return worker_id
+        raise WorkerIdExhausted('all {0} worker ids are leased'.format(size))
+
+    def _ensure_lease(self):
+        if self._fixed is not None:
+            return
+        if self._pid != os.getpid():
+            # never share the lease of the parent process
+            self._lease()
+        elif clock.now() - self._leased_at > self.ttl / 3.0:
+            if self._renew_script(keys=[LEASE_KEY.format(self.worker_id)],
+                                  args=[self._token, self.ttl]):
+                self._leased_at = clock.now()
+            else:
+                self._lease()
+
+    def _process_shutdown(self, **kwargs):
+        self.release()
+
+    def release(self):
+        """giving the leased worker id back, called at exit"""
+        if self._token is None or self._pid != os.getpid():
+            return
+        self._release_script(keys=[LEASE_KEY.format(self.worker_id)],
+                             args=[self._token])
+        self._token = None
+        self._pid = None
+
+    def next_id(self):
+        with self._lock:
+            self._ensure_lease()
+            now = int(clock.now() * 1000) - EPOCH
+            if now > self._last:
+                self._last = now
+                self._sequence = 0
+            else:
+                self._sequence += 1
+                if self._sequence >= 2 ** SEQUENCE_BITS:
+                    self._last += 1
+                    self._sequence = 0
+            return ((self._last << (WORKER_BITS + SEQUENCE_BITS)) |
+                    (self.worker_id << SEQUENCE_BITS) | self._sequence)
+
+    @staticmethod
+    def worker_of(task_id):
+        return (task_id >> SEQUENCE_BITS) & (2 ** WORKER_BITS - 1)
+
+    @staticmethod
+    def timestamp_of(task_id):
+        """Returns: float, unix timestamp the id was allocated at"""
+        return ((task_id >> (WORKER_BITS + SEQUENCE_BITS)) + EPOCH) / 1000.0
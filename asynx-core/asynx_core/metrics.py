@@ -0,0 +1,420 @@
+# -*- coding: utf-8 -*-
+
+import os
+import re
+import math
+import time
+import atexit
+import functools
+import threading
+from bisect import bisect_left
+
+from redis import RedisError
+
+from . import clock
+from ._util import dict_items, not_bytes
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+LAG_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0,
+               300.0, 900.0, 3600.0, 14400.0)
+
+# name: (type, help, buckets)
+METRICS = {
+    'asynx_operation_seconds': (
+        'histogram', 'Latency of taskqueue operations', LATENCY_BUCKETS),
+    'asynx_redis_roundtrips_total': (
+        'counter', 'Redis round trips of taskqueue operations', None),
+    'asynx_dispatch_seconds': (
+        'histogram', 'Latency of dispatched HTTP requests', LATENCY_BUCKETS),
+    'asynx_dispatch_lag_seconds': (
+        'histogram', 'Delay between the expected and the actual start '
+        'of tasks', LAG_BUCKETS),
+    'asynx_deduplicated_total': (
+        'counter', 'Task insertions returning the task inserted first with '
+        'the same idempotency key', None),
+    'asynx_backlog_tasks': (
+        'gauge', 'Tasks waiting in a taskqueue', None),
+    'asynx_replica_lag_seconds': (
+        'gauge', 'Replication lag of redis replicas serving reads, -1 if '
+        'unknown', None),
+}
+
+_sample = re.compile(r'^([a-z_]+?)(_bucket|_sum|_count)?(?:\{(.*)\})?$')
+_le = re.compile(r',?le="([^"]*)"$')
+_suffix_order = {None: 0, '_bucket': 0, '_sum': 1, '_count': 2}
+_local = threading.local()
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"') \
+                     .replace('\n', r'\n')
+
+
+def sample_name(name, labels=()):
+    """formatting a sample in the Prometheus text format
+
+    Doctest:
+        >>> sample_name('asynx_backlog_tasks', (('app', 'a"b'), ))
+        'asynx_backlog_tasks{app="a\\\\"b"}'
+        >>> sample_name('asynx_redis_roundtrips_total')
+        'asynx_redis_roundtrips_total'
+
+    """
+    if not labels:
+        return name
+    return '{0}{{{1}}}'.format(name, ','.join(
+        ['{0}="{1}"'.format(key, _escape(val)) for key, val in labels]))
+
+
+def _sort_key(sample):
+    name, suffix, labels = _sample.match(sample).groups()
+    labels = labels or ''
+    le = _le.search(labels)
+    if le is None:
+        return name, labels, _suffix_order[suffix], 0
+    bound = float(le.group(1))
+    return name, _le.sub('', labels), _suffix_order[suffix], bound
+
+
+def _roundtrips():
+    return getattr(_local, 'roundtrips', 0)
+
+
+def _counting_connection(cls):
+    """subclassing a redis connection class to count round trips, every
+    command or pipeline is sent by one `send_packed_command` call"""
+
+    def send_packed_command(self, command):
+        _local.roundtrips = getattr(_local, 'roundtrips', 0) + 1
+        return cls.send_packed_command(self, command)
+
+    return type('Counting' + cls.__name__, (cls, ),
+                {'send_packed_command': send_packed_command})
+
+
+def instrument_redis(connection):
+    """counting round trips of the connections created from now on
+
+    Parameters:
+        - connection: a StrictRedis object or a Flask-And-Redis object
+
+    """
+    pool = getattr(connection, 'connection_pool', None)
+    if pool is None:
+        # Flask-And-Redis wraps the connection
+        pool = connection.connection.connection_pool
+    if not getattr(pool, '_asynx_instrumented', False):
+        pool.connection_class = _counting_connection(pool.connection_class)
+        pool._asynx_instrumented = True
+
+
+class Registry(object):
+
+    def __init__(self, key='AX:METRICS', flush_interval=5.0):
+        """Metrics accumulated in process and flushed to redis
+
+        Counters and histograms are added up in memory and flushed with
+        one pipeline into a redis hash every `flush_interval` seconds, so
+        the processes of gunicorn and celery are aggregated in redis.
+
+        Nothing is recorded until a redis connection is bound.
+
+        Parameters:
+            - key: string, the redis hash key of metrics
+            - flush_interval: float, seconds between flushes
+
+        Usage:
+            >>> import redis
+            >>> registry = Registry()
+            >>> registry.bind_redis(redis.StrictRedis())
+            >>> registry.inc('asynx_redis_roundtrips_total', 3,
+            ...              (('op', 'add_task'), ))
+            >>> registry.flush()
+
+        """
+        self.key = key
+        self.flush_interval = flush_interval
+        self._redis = None
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._flushed_at = time.time()
+        self._counters = {}
+        self._histograms = {}
+
+    @property
+    def enabled(self):
+        return self._redis is not None
+
+    def bind_redis(self, connection):
+        """Binding redis connection, and counting its round trips"""
+        instrument_redis(connection)
+        self._redis = connection
+
+    def inc(self, name, value=1, labels=()):
+        """increasing a counter
+
+        Parameters:
+            - name: string, metric's name
+            - value: number to add
+            - labels: tuple of (name, value) pairs
+
+        """
+        if self._redis is None:
+            return
+        with self._lock:
+            self._check_fork()
+            key = (name, labels)
+            self._counters[key] = self._counters.get(key, 0) + value
+        self._maybe_flush()
+
+    def observe(self, name, value, labels=()):
+        """observing a value into a histogram
+
+        Parameters:
+            - name: string, metric's name
+            - value: number to observe
+            - labels: tuple of (name, value) pairs
+
+        """
+        if self._redis is None:
+            return
+        buckets = METRICS[name][2]
+        with self._lock:
+            self._check_fork()
+            key = (name, labels)
+            hist = self._histograms.get(key)
+            if hist is None:
+                hist = self._histograms[key] = [[0] * (len(buckets) + 1), 0]
+            hist[0][bisect_left(buckets, value)] += 1
+            hist[1] += value
+        self._maybe_flush()
+
+    def _check_fork(self):
+        # a forked worker inherits what its parent didn't flush
+        if self._pid != os.getpid():
+            self._reset()
+
+    def _maybe_flush(self):
+        if time.time() - self._flushed_at >= self.flush_interval:
+            try:
+                self.flush()
+            except RedisError:
+                pass
+
+    def _pop(self):
+        with self._lock:
+            self._check_fork()
+            counters, histograms = self._counters, self._histograms
+            self._counters, self._histograms = {}, {}
+            self._flushed_at = time.time()
+        return counters, histograms
+
+    def _restore(self, counters, histograms):
+        with self._lock:
+            for key, value in dict_items(counters):
+                self._counters[key] = self._counters.get(key, 0) + value
+            for key, (counts, total) in dict_items(histograms):
+                hist = self._histograms.get(key)
+                if hist is None:
+                    self._histograms[key] = [counts, total]
+                    continue
+                hist[0] = [a + b for a, b in zip(hist[0], counts)]
+                hist[1] += total
+
+    def flush(self):
+        """flushing metrics accumulated in this process into redis"""
+        if self._redis is None:
+            return
+        counters, histograms = self._pop()
+        if not counters and not histograms:
+            return
+        saved = _roundtrips()
+        try:
+            with self._redis.pipeline(transaction=False) as pipe:
+                for (name, labels), value in dict_items(counters):
+                    pipe.hincrbyfloat(self.key,
+                                      sample_name(name, labels), value)
+                for (name, labels), (counts, total) in \
+                        dict_items(histograms):
+                    bounds = METRICS[name][2] + ('+Inf', )
+                    cumulative = 0
+                    # every bucket, even empty, so that the series of
+                    # all processes have the same buckets for
+                    # histogram_quantile
+                    for bound, count in zip(bounds, counts):
+                        cumulative += count
+                        pipe.hincrbyfloat(self.key, sample_name(
+                            name + '_bucket', labels + (('le', bound), )),
+                            cumulative)
+                    pipe.hincrbyfloat(
+                        self.key, sample_name(name + '_sum', labels), total)
+                    pipe.hincrbyfloat(
+                        self.key, sample_name(name + '_count', labels),
+                        cumulative)
+                pipe.execute()
+        except RedisError:
+            self._restore(counters, histograms)
+            raise
+        finally:
+            # flushing is not a round trip of the measured operation
+            _local.roundtrips = saved
+
+    def collect(self):
+        """reading metrics of all processes from redis
+
+        Returns:
+            a dict mapping samples to string values
+
+        """
+        samples = {}
+        if self._redis is None:
+            return samples
+        for key, val in dict_items(self._redis.hgetall(self.key)):
+            samples[not_bytes(key)] = not_bytes(val)
+        return samples
+
+    def render(self, gauges=None):
+        """rendering metrics in the Prometheus text format
+
+        Parameters:
+            - gauges: optional, a dict mapping metric names to
+                      lists of (labels, value)
+
+        Returns:
+            string
+
+        """
+        families = {}
+        for sample, value in dict_items(self.collect()):
+            name = _sample.match(sample).group(1)
+            families.setdefault(name, []).append((sample, value))
+        for name, values in dict_items(gauges or {}):
+            families[name] = [(sample_name(name, labels), str(value))
+                              for labels, value in values]
+        lines = []
+        for name in sorted(families):
+            if name in METRICS:
+                lines.append('# HELP {0} {1}'.format(name, METRICS[name][1]))
+                lines.append('# TYPE {0} {1}'.format(name, METRICS[name][0]))
+            for sample, value in sorted(families[name],
+                                        key=lambda s: _sort_key(s[0])):
+                lines.append('{0} {1}'.format(sample, value))
+        lines.append('')
+        return '\n'.join(lines)
+
+
+class Timeline(object):
+    """phase timestamps of dispatching a task
+
+    Marks, in order: enqueued, due, picked_up, status_cas, request_start,
+    first_byte, body_done, callbacks, deleted
+
+    Doctest:
+        >>> timeline = Timeline(due=10.0, picked_up=10.5)
+        >>> timeline.mark('status_cas', 10.75)
+        >>> sorted(timeline.phases().items())
+        [('fetch', 0.25), ('queue', 0.5)]
+        >>> timeline.total()
+        0.75
+
+    """
+
+    __slots__ = ('marks', )
+
+    # phase, from mark, to mark
+    PHASES = (('queue', 'due', 'picked_up'),
+              ('fetch', 'picked_up', 'status_cas'),
+              ('prepare', 'status_cas', 'request_start'),
+              ('first_byte', 'request_start', 'first_byte'),
+              ('body', 'first_byte', 'body_done'),
+              ('callbacks', 'body_done', 'callbacks'),
+              ('finish', 'callbacks', 'deleted'))
+
+    def __init__(self, **marks):
+        self.marks = {}
+        for name, at in dict_items(marks):
+            if at is not None:
+                self.marks[name] = at
+
+    def mark(self, name, at=None):
+        self.marks[name] = clock.now() if at is None else at
+
+    def phases(self):
+        """returning seconds spent in each phase that has both marks"""
+        marks = self.marks
+        phases = {}
+        for phase, start, end in self.PHASES:
+            if start in marks and end in marks:
+                phases[phase] = marks[end] - marks[start]
+        return phases
+
+    def total(self):
+        """returning seconds from the due time (or the pick up) to
+        the last mark"""
+        marks = self.marks
+        start = marks.get('due', marks.get('picked_up'))
+        if start is None:
+            return None
+        return max(marks.values()) - start
+
+
+def percentiles(values, points=(50, 95, 99)):
+    """computing nearest-rank percentiles
+
+    Doctest:
+        >>> sorted(percentiles(list(range(1, 101))).items())
+        [('p50', 50), ('p95', 95), ('p99', 99)]
+        >>> percentiles([])
+        {}
+
+    """
+    if not values:
+        return {}
+    values = sorted(values)
+    result = {}
+    for point in points:
+        rank = max(int(math.ceil(point / 100.0 * len(values))), 1)
+        result['p{0}'.format(point)] = values[rank - 1]
+    return result
+
+
+registry = Registry()
+
+
+@atexit.register
+def _flush_at_exit():
+    try:
+        registry.flush()
+    except RedisError:
+        pass
+
+
+def measured(op):
+    """decorating a taskqueue operation to record its latency and
+    redis round trips, nested operations are counted in the outermost"""
+
+    def decorator(func):
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if registry._redis is None or getattr(_local, 'op', None):
+                return func(*args, **kwargs)
+            _local.op = op
+            roundtrips = _roundtrips()
+            start = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                elapsed = time.time() - start
+                roundtrips = _roundtrips() - roundtrips
+                _local.op = None
+                labels = (('op', op), )
+                registry.observe('asynx_operation_seconds', elapsed, labels)
+                registry.inc('asynx_redis_roundtrips_total',
+                             roundtrips, labels)
+        return wrapper
+    return decorator
@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+
+import heapq
+import random
+import itertools
+from uuid import uuid4
+from collections import namedtuple, defaultdict
+from timeit import default_timer
+
+from celery import schedules
+
+from . import clock, metrics
+from .backends import as_backend
+from .taskqueue import (TaskQueue, Task, TaskNotFound,
+                        TaskStatusNotMatched)
+from ._util import basestring, get_total_seconds
+
+_Sent = namedtuple('_Sent', 'id')
+
+
+class SimulatedTaskQueue(TaskQueue):
+    """a TaskQueue whose tasks are queued in the simulator instead of
+    celery"""
+
+    def __init__(self, appname, queuename='default', simulator=None):
+        super(SimulatedTaskQueue, self).__init__(appname, queuename)
+        self.simulator = simulator
+
+    def _send_task(self, args, kwargs, countdown=None, task_id=None):
+        return self.simulator._enqueue(args[3], kwargs['due_at'], task_id)
+
+
+class Reservoir(object):
+
+    def __init__(self, size=100000, rnd=random):
+        """a uniform sample of a stream too long to be kept
+
+        Doctest:
+            >>> reservoir = Reservoir(10)
+            >>> for i in range(1000):
+            ...     reservoir.add(i)
+            >>> len(reservoir.values), reservoir.count, reservoir.max
+            (10, 1000, 999)
+
+        """
+        self.size = size
+        self.values = []
+        self.count = 0
+        self.max = None
+        self._random = rnd
+
+    def add(self, value):
+        self.count += 1
+        if self.max is None or value > self.max:
+            self.max = value
+        if len(self.values) < self.size:
+            self.values.append(value)
+        else:
+            idx = self._random.randint(0, self.count - 1)
+            if idx < self.size:
+                self.values[idx] = value
+
+
+class Simulator(object):
+
+    def __init__(self, storage, appname='asynx-sim', queuename='default',
+                 start=None, latency=0.0, jitter=0.0, seed=None):
+        """running scheduled and delayed tasks on a virtual clock
+
+        Tasks are stored in the backend like in production, the messages
+        to celery are kept in a heap ordered by their due time, so a
+        simulated week takes as long as the redis operations of its runs.
+        The HTTP requests of tasks are not sent.
+
+        Parameters:
+            - storage: storage backend, or a redis connection whose
+                       database is written
+            - appname: string, application of the simulated tasks
+            - queuename: string, taskqueue of the simulated tasks
+            - start: optional, float, unix timestamp the simulation
+                     starts at, default now
+            - latency: float, seconds from a task is due to its run,
+                       the time a worker takes to pick it up
+            - jitter: float, maximum random seconds added to latency
+            - seed: optional, seed of the random jitter
+
+        """
+        self.backend = as_backend(storage)
+        self.redis = getattr(self.backend, 'redis', None)
+        if self.redis is not None:
+            metrics.instrument_redis(self.redis)
+            # connections opened before aren't counted, replacing them
+            self.redis.connection_pool.reset()
+        self.clock = clock.VirtualClock(start)
+        self.start = self.clock.time()
+        self.latency = latency
+        self.jitter = jitter
+        self.random = random.Random(seed)
+        self.taskqueue = SimulatedTaskQueue(appname, queuename, self)
+        self.taskqueue.bind_backend(self.backend)
+        self._events = []
+        self._seq = itertools.count()
+        self._names = itertools.count()
+        self._runs = {}
+        self._anchors = {}
+        self.drifts = Reservoir(rnd=self.random)
+        self.fires_per_second = defaultdict(int)
+        self.roundtrips_per_second = defaultdict(int)
+
+    def _enqueue(self, task_id, due_at, uuid=None):
+        uuid = uuid or uuid4().hex
+        heapq.heappush(self._events, (due_at, next(self._seq), task_id, uuid))
+        return _Sent(uuid)
+
+    def _installed(self, func, *args):
+        previous = clock.set_clock(self.clock)
+        try:
+            return func(*args)
+        finally:
+            clock.set_clock(previous)
+
+    def add_tasks(self, count, schedule=None, countdown=None, spread=0.0,
+                  url='http://127.0.0.1/'):
+        """adding tasks at the current virtual time
+
+        Parameters:
+            - count: integer, how many tasks
+            - schedule: optional, celery schedule/crontab object, or a
+                        string like "every 60 seconds" or "*/5 * * * *"
+            - countdown: optional, float, or a tuple of a range, for
+                         delayed tasks
+            - spread: float, seconds the insertions are spread over
+
+        """
+        if isinstance(schedule, basestring):
+            schedule = Task._schedule_from_string(schedule)
+        return self._installed(self._add_tasks, count, schedule, countdown,
+                               spread, url)
+
+    def _add_tasks(self, count, schedule, countdown, spread, url):
+        start = self.clock.time()
+        tq = self.taskqueue
+        for i in range(count):
+            self.clock.set(start + spread * i / float(count))
+            kwargs = {}
+            if schedule is not None:
+                kwargs['schedule'] = schedule
+                kwargs['cname'] = 'sim-{0}'.format(next(self._names))
+            if isinstance(countdown, tuple):
+                kwargs['countdown'] = self.random.uniform(*countdown)
+            elif countdown:
+                kwargs['countdown'] = countdown
+            tq.add_task({'method': 'GET', 'url': url}, **kwargs)
+
+    def _ideal(self, task, due_at):
+        """when a run should happen if nothing was late"""
+        sched = task.schedule
+        if sched is None:
+            # the message is due at the eta of a delayed task
+            return due_at
+        if isinstance(sched, schedules.crontab):
+            # crontab runs at whole minutes
+            return due_at - due_at % 60
+        # fixed intervals from the first run
+        runs = self._runs.get(task.id, 0)
+        anchor = self._anchors.setdefault(task.id, due_at)
+        return anchor + runs * get_total_seconds(sched.run_every)
+
+    def _fire(self, due_at, task_id, uuid):
+        tq = self.taskqueue
+        delay = self.latency
+        if self.jitter:
+            delay += self.random.uniform(0, self.jitter)
+        self.clock.set(due_at + delay)
+        roundtrips = metrics._roundtrips()
+        try:
+            task = tq._get_task(task_id)
+        except TaskNotFound:
+            return False
+        if task.uuid != uuid:
+            # superseded message
+            return False
+        now = self.clock.time()
+        drift = now - self._ideal(task, due_at)
+        try:
+            last_run_at = tq._update_status(
+                task.id, 'running', 'new', 'scheduled', 'delayed')
+        except TaskStatusNotMatched:
+            return False
+        task.status = 'running'
+        task.last_run_at = last_run_at
+        if task.schedule:
+            self._runs[task.id] = self._runs.get(task.id, 0) + 1
+            tq._dispatch_task(task)
+        else:
+            tq._delete_task(task)
+        self.drifts.add(drift)
+        second = int(now)
+        self.fires_per_second[second] += 1
+        self.roundtrips_per_second[second] += \
+            metrics._roundtrips() - roundtrips
+        return True
+
+    def run(self, seconds):
+        """running every message due in the next `seconds`
+
+        Returns:
+            dict of the report
+
+        """
+        return self._installed(self._run, seconds)
+
+    def _run(self, seconds):
+        end = self.clock.time() + seconds
+        events = self._events
+        commands = self._commands()
+        roundtrips = metrics._roundtrips()
+        wall = default_timer()
+        fires = 0
+        while events and events[0][0] <= end:
+            due_at, _, task_id, uuid = heapq.heappop(events)
+            if self._fire(due_at, task_id, uuid):
+                fires += 1
+        self.clock.set(end)
+        wall = default_timer() - wall
+        roundtrips = metrics._roundtrips() - roundtrips
+        commands = self._commands() - commands
+        # seconds without any run are not counted
+        per_second = list(self.fires_per_second.values())
+        drifts = self.drifts
+        return {
+            'simulated_seconds': seconds,
+            'wall_seconds': wall,
+            'fires': fires,
+            'pending': len(events),
+            'drift': dict(metrics.percentiles(drifts.values),
+                          max=drifts.max),
+            'peak_fires_per_second': max(per_second) if per_second else 0,
+            'fires_per_second': metrics.percentiles(per_second),
+            'redis_roundtrips': roundtrips,
+            'redis_commands': commands,
+            'roundtrips_per_fire': roundtrips / float(fires) if fires else 0,
+            'peak_roundtrips_per_second': max(
+                self.roundtrips_per_second.values()) if per_second else 0}
+
+    def _commands(self):
+        if self.redis is None:
+            return 0
+        return self.redis.info('stats')['total_commands_processed']
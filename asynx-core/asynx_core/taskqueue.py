@@ -2,21 +2,32 @@
 
 import re
 import copy
+import json
+import hashlib
 import weakref
 import inspect
+import functools
+from uuid import uuid4
+from contextlib import contextmanager
 from itertools import islice
 from datetime import timedelta
 
 import celery
 import requests
 from pytz import utc
-from dateutil import parser
 from tzlocal import get_localzone
 from celery import schedules
-from redis import WatchError
+from celery.result import AsyncResult
 
 from ._util import (_dumps, _loads, dict_items, basestring, utcnow,
-                    get_total_seconds, not_bytes, user_agent)
+                    get_total_seconds, not_bytes, user_agent, parse_datetime)
+from . import clock
+from .backends import (RedisBackend, as_backend, reading_from, incr_key,
+                       backlog_key, sched_key, meta_key, cname_key, uuid_key,
+                       slow_key, recent_key)
+from .metrics import registry, measured, percentiles, Timeline
+from .compression import MARKER, compress_request, expand_request
+from .hooks import hooked
 
 
 class TaskAlreadyExists(Exception):
@@ -35,19 +46,221 @@ class TaskCNameRequired(Exception):
     pass
 
 
+class TemplateNotFound(Exception):
+    pass
+
+
+class GroupNotFound(Exception):
+    pass
+
+
+class BatchItemResponse(object):
+
+    def __init__(self, response, item):
+        """the part of the response to a batch of coalesced tasks
+        passed to the callbacks of one of them
+
+        Parameters:
+            - response: the response to the batch request
+            - item: the element of the JSON array answered for the task,
+                    its "status" replaces the status code if it has one
+
+        Doctest:
+            >>> class Response(object):
+            ...     url, status_code, reason = 'http://a/', 200, 'OK'
+            ...     headers, history = {}, []
+            >>> item = BatchItemResponse(Response(), {'status': 404})
+            >>> item.status_code, item.content
+            (404, '{"status": 404}')
+
+        """
+        status = item.get('status') if isinstance(item, dict) else None
+        self.url = response.url
+        self.status_code = status if isinstance(status, int) \
+            else response.status_code
+        self.reason = response.reason
+        self.headers = response.headers
+        self.history = response.history
+        self.content = _dumps(item)
+
+
+def batch_hash(request):
+    """identifying the endpoint of a request, coalesced tasks are
+    batched with the ones having the same
+
+    Doctest:
+        >>> key = batch_hash({'method': 'POST', 'url': 'http://a/'})
+        >>> key == batch_hash({'url': 'http://a/', 'method': 'POST',
+        ...                    'payload': '{"id": 1}'})
+        True
+
+    """
+    endpoint = [request.get(key) for key in
+                ('method', 'url', 'headers', 'timeout', 'allow_redirects')]
+    return hashlib.sha1(json.dumps(endpoint, sort_keys=True)
+                        .encode('utf-8')).hexdigest()
+
+
+def content_hash(fields):
+    """identifying a task by its content, the insertions of the same
+    task are deduplicated if the queue's `dedupe_content` is on
+
+    Doctest:
+        >>> key = content_hash({'request': {'url': 'http://a/'}})
+        >>> key == content_hash({'request': {'url': 'http://a/'}})
+        True
+        >>> key == content_hash({'request': {'url': 'http://b/'}})
+        False
+
+    """
+    return 'content:' + hashlib.sha1(json.dumps(
+        fields, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+class AggregateResponse(object):
+
+    def __init__(self, url, results, total):
+        """the outcome of the requests of a fan-out task once all its
+        targets are sent, or of the tasks of a group once all are done,
+        passed to callbacks like the response of a task
+
+        A request succeeded if its status code is from 200 to 302, the
+        aggregate did if all of them did.
+
+        Parameters:
+            - url: the url of the task's request if any
+            - results: dict of target or task id => status code, or the
+                       name of the exception raised sending it
+            - total: integer, count of targets or tasks
+
+        Doctest:
+            >>> response = AggregateResponse(None, {'http://a/': 200,
+            ...                                     'http://b/': 'Timeout'}, 2)
+            >>> response.status_code, response.reason
+            (500, '1 of 2 failed')
+
+        """
+        failed = 0
+        for result in results.values():
+            if not isinstance(result, int) or not 200 <= result < 303:
+                failed += 1
+        self.url = url
+        self.status_code = 500 if failed else 200
+        self.reason = '{0} of {1} failed'.format(failed, total)
+        self.headers = {'Content-Type': 'application/json'}
+        self.history = []
+        self.content = _dumps({'total': total,
+                               'succeeded': len(results) - failed,
+                               'failed': failed,
+                               'results': results})
+
+
+# (backend id, appname, queuename, name) => (version, template dict,
+# checked at), shared by the taskqueues of a process
+_templates = {}
+
+
+def merge_request(template, overrides):
+    """the request of a task referencing a template, its headers are
+    merged with the template's, other arguments replace them
+
+    Doctest:
+        >>> request = merge_request(
+        ...     {'method': 'POST', 'url': 'http://a/', 'headers': {'A': '1'}},
+        ...     {'url': 'http://b/', 'headers': {'B': '2'}})
+        >>> request['method'], request['url'], sorted(request['headers'])
+        ('POST', 'http://b/', ['A', 'B'])
+
+    """
+    request = dict(template)
+    for key, val in dict_items(overrides):
+        if key == 'headers' and request.get('headers'):
+            headers = dict(request['headers'])
+            headers.update(val or {})
+            val = headers
+        request[key] = val
+    return request
+
+
+def replica_read(func):
+    """routing the reads of a read-only taskqueue method to replicas if
+    the taskqueue's `replica_reads` is on, generators are routed on
+    every step only"""
+
+    if inspect.isgeneratorfunction(func):
+        @functools.wraps(func)
+        def generator(self, *args, **kwargs):
+            items = func(self, *args, **kwargs)
+            while 1:
+                with reading_from(self.replica_reads):
+                    try:
+                        item = next(items)
+                    except StopIteration:
+                        return
+                yield item
+        return generator
+
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        with reading_from(self.replica_reads):
+            return func(self, *args, **kwargs)
+    return wrapper
+
+
 @celery.shared_task()
-def request_task(tq_class, appname, queuename, task_id):
+def request_task(tq_class, appname, queuename, task_id,
+                 enqueued_at=None, due_at=None):
     """Dispatch an HTTP request task."""
+    timeline = Timeline(enqueued=enqueued_at, due=due_at,
+                        picked_up=clock.now())
     tq = tq_class(appname, queuename)
     try:
         task = tq._get_task(task_id)
     except TaskNotFound:
         return
-    task.dispatch()
+    if task.coalesce:
+        tq._coalesce(task)
+    else:
+        task.dispatch(timeline)
+
+
+@celery.shared_task()
+def flush_batch(tq_class, appname, queuename, key):
+    """Dispatch a batch of coalesced tasks in one HTTP request."""
+    tq_class(appname, queuename).flush_batch(key)
 
 
 class TaskQueue(object):
 
+    # how many dispatch timelines are kept per queue: the slowest ones,
+    # and the most recent ones for percentiles. 0 disables keeping them
+    slow_timelines = 0
+    recent_timelines = 0
+    # reads of listing, getting and counting tasks are served by replicas
+    # of the backend, if it has
+    replica_reads = False
+    # request payloads of at least this many bytes are stored compressed,
+    # including the responses passed to chained callbacks. None disables
+    compress_threshold = None
+    # "zlib", or "zstd" if every process reading tasks has zstandard
+    compress_codec = 'zlib'
+    # seconds a cached request template is used before checking its
+    # version, the process updating it drops it at once
+    template_ttl = 5.0
+    # targets of a fan-out task sent by one message, the next ones are
+    # sent by another message
+    fanout_chunk = 100
+    # seconds a due coalesced task waits for others to the same endpoint,
+    # and the most tasks sent by one request
+    coalesce_linger = 1.0
+    coalesce_max = 100
+    # seconds an idempotency key is kept, an insertion with the same key
+    # in the meantime returns the task inserted first
+    dedupe_window = 600.0
+    # deduplicating the tasks inserted without an idempotency key by a
+    # hash of their content, but the scheduled ones and the ones of groups
+    dedupe_content = False
+
     def __init__(self, appname, queuename='default', localzone=None):
         """Initialize a TaskQueue object
 
@@ -67,15 +280,51 @@ class TaskQueue(object):
         self.appname = appname
         self.queuename = queuename
         self.localzone = localzone or get_localzone()
-        self._redis = None
+        self._backend = None
+        self._deferred = None
+
+    @property
+    def backend(self):
+        """The bound storage backend"""
+        if self._backend is None:
+            raise RuntimeError('taskqueue is not bound '
+                               'with a storage backend')
+        return self._backend
 
     @property
     def redis(self):
-        """The bound redis connection"""
-        if self._redis is None:
+        """The redis connection of the bound backend"""
+        connection = getattr(self._backend, 'redis', None)
+        if connection is None:
             raise RuntimeError('taskqueue is not bound '
                                'with a redis connection')
-        return self._redis
+        return connection
+
+    def bind_backend(self, backend):
+        """Binding a storage backend
+
+        Usage:
+            >>> from asynx_core.backends import MemoryBackend
+            >>> tq = TaskQueue('test')
+            >>> tq.bind_backend(MemoryBackend())
+
+        """
+        self._backend = backend
+
+    def primary_reads(self):
+        """reading from the primary in the block, for reading the writes
+        just made when `replica_reads` is on
+
+        Usage:
+            >>> from asynx_core.backends import MemoryBackend
+            >>> tq = TaskQueue('test')
+            >>> tq.bind_backend(MemoryBackend())
+            >>> with tq.primary_reads():
+            ...     tq.count_tasks()
+            0
+
+        """
+        return reading_from(False)
 
     def bind_redis(self, connection):
         """Binding redis connection
@@ -94,7 +343,7 @@ class TaskQueue(object):
             RuntimeError: taskqueue is not bound with a redis connection
 
         """
-        self._redis = connection
+        self.bind_backend(RedisBackend(connection))
 
     def __hincrkey(self):
         """generating an auto-increment key per queue for every app
@@ -102,11 +351,21 @@ class TaskQueue(object):
         Doctest:
             >>> tq = TaskQueue('test', 'custom')
             >>> tq._TaskQueue__hincrkey()
-            ('AX:INC', 'test:custom')
+            ('AX:Q:{test:custom}', 'inc')
 
         """
+        return incr_key(self.appname, self.queuename)
+
+    def __backlogkey(self):
+        """generating a hash key counting tasks per queue
+
+        Doctest:
+            >>> tq = TaskQueue('test', 'custom')
+            >>> tq._TaskQueue__backlogkey()
+            ('AX:Q:{test:custom}', 'backlog')
 
-        return 'AX:INC', '{0}:{1}'.format(self.appname, self.queuename)
+        """
+        return backlog_key(self.appname, self.queuename)
 
     def __schedkey(self):
         """generates a key listing all scheduled tasks
@@ -114,10 +373,10 @@ class TaskQueue(object):
         Doctest:
             >>> tq = TaskQueue('test', 'custom')
             >>> tq._TaskQueue__schedkey()
-            'AX:SC:test:custom'
+            'AX:SC:{test:custom}'
 
         """
-        return 'AX:SC:{0}:{1}'.format(self.appname, self.queuename)
+        return sched_key(self.appname, self.queuename)
 
     def __metakey(self, idx):
         """generating a metakey to store task's metadata
@@ -125,10 +384,10 @@ class TaskQueue(object):
         Doctest:
             >>> tq = TaskQueue('test', 'custom')
             >>> tq._TaskQueue__metakey(12345)
-            'AX:META:test:custom:12345'
+            'AX:META:{test:custom}:12345'
 
         """
-        return 'AX:META:{0}:{1}:{2}'.format(self.appname, self.queuename, idx)
+        return meta_key(self.appname, self.queuename, idx)
 
     def __cnamekey(self, cname):
         """generating a cname key mapping a task
@@ -136,12 +395,10 @@ class TaskQueue(object):
         Doctest:
             >>> tq = TaskQueue('test', 'custom')
             >>> tq._TaskQueue__cnamekey('task001')
-            'AX:CNAME:test:custom:task001'
+            'AX:CNAME:{test:custom}:task001'
 
         """
-        return 'AX:CNAME:{0}:{1}:{2}'.format(self.appname,
-                                             self.queuename,
-                                             cname)
+        return cname_key(self.appname, self.queuename, cname)
 
     def __uuidkey(self):
         """generating a sorted set key mapping uuid to task
@@ -149,46 +406,124 @@ class TaskQueue(object):
         Doctest:
             >>> tq = TaskQueue('test', 'custom')
             >>> tq._TaskQueue__uuidkey()
-            'AX:UUID:test:custom'
+            'AX:UUID:{test:custom}'
+
+        """
+        return uuid_key(self.appname, self.queuename)
+
+    def __slowkey(self):
+        """generating a sorted set key keeping the slowest timelines
+
+        Doctest:
+            >>> tq = TaskQueue('test', 'custom')
+            >>> tq._TaskQueue__slowkey()
+            'AX:SLOW:{test:custom}'
+
+        """
+        return slow_key(self.appname, self.queuename)
+
+    def __recentkey(self):
+        """generating a list key keeping the recent timelines
+
+        Doctest:
+            >>> tq = TaskQueue('test', 'custom')
+            >>> tq._TaskQueue__recentkey()
+            'AX:RECENT:{test:custom}'
 
         """
-        return 'AX:UUID:{0}:{1}'.format(self.appname, self.queuename)
+        return recent_key(self.appname, self.queuename)
+
+    def _send_task(self, args, kwargs, countdown=None, task_id=None):
+        """sending a request_task message to celery
+
+        Override it to dispatch tasks by other means, the simulator
+        queues them in memory on a virtual clock for example.
+
+        Parameters:
+            - task_id: optional, the uuid of the message, a new one if
+                       not given
 
-    def _dispatch_task(self, task):
+        Returns:
+            an object with the uuid of the message as `id`, normally
+            a celery AsyncResult
+
+        """
+        if self._deferred is not None:
+            # sent once the batch is committed, so workers never pick up
+            # a task that isn't stored yet
+            task_id = task_id or str(uuid4())
+            self._deferred.append((args, kwargs, countdown, task_id))
+            return AsyncResult(task_id)
+        return request_task.apply_async(args, kwargs, countdown=countdown,
+                                        task_id=task_id)
+
+    @contextmanager
+    def batch(self):
+        """grouping the writes in the block into one transaction
+
+        Backends without transactions write as usual. Messages to celery
+        are sent after the block, none of them if it raises.
+
+        Usage:
+            >>> from asynx_core.backends import MemoryBackend
+            >>> tq = TaskQueue('test')
+            >>> tq.bind_backend(MemoryBackend())
+            >>> with tq.batch():
+            ...     pass
+
+        """
+        if self._deferred is not None:
+            yield
+            return
+        self._deferred = deferred = []
+        try:
+            with self.backend.batch():
+                yield
+        finally:
+            self._deferred = None
+        for args, kwargs, countdown, task_id in deferred:
+            request_task.apply_async(args, kwargs, countdown=countdown,
+                                     task_id=task_id)
+
+    @hooked('dispatch_task')
+    def _dispatch_task(self, task, keep_uuid=False):
         """dispatching a "new" task into celery queue
 
         Parameters:
             - task: a Task object with status == 'new'
+            - keep_uuid: boolean, sending the message with the uuid the
+                         task already has, for cold tasks
+
+        Returns:
+            dict of the JSON-encoded fields updated in redis
 
         """
         old_uuid = task.uuid
-        task.apply_async(task.last_run_at or utcnow())
+        due = task.apply_async(task.last_run_at or utcnow(),
+                               task_id=old_uuid if keep_uuid else None)
         update_fields = {
             'uuid': task.uuid,
             'status': task.status
         }
         for key, val in dict_items(update_fields):
             update_fields[key] = _dumps(val)
-        uuidkey = self.__uuidkey()
-        metakey = self.__metakey(task.id)
-        with self.redis.pipeline() as pipe:
-            pipe.hmset(metakey, update_fields)
-            if old_uuid:
-                pipe.zrem(uuidkey, old_uuid)
-            pipe.zadd(uuidkey, task.id, task.uuid)
-            pipe.execute()
+        self.backend.dispatched(self, task.id, update_fields,
+                                task.uuid, old_uuid, due)
+        return update_fields
 
     def add_task(self, request, cname=None,
                  countdown=None, eta=None,
                  schedule=None, on_success=None,
                  on_failure='__report__',
-                 on_complete=None):
+                 on_complete=None, template=None, targets=None,
+                 coalesce=False, idempotency_key=None):
         """adding and dispatch task
 
         Parameters:
             - request: a dict contains request arguments:
                 method, url, headers(dict), payload(string),
-                timeout, allow_redirects(bool)
+                timeout, allow_redirects(bool), only the ones
+                overriding the template if any
             - cname: optional, string, custom task name
             - countdown: optional, int/float in seconds
             - eta: optional, datatime object
@@ -197,51 +532,328 @@ class TaskQueue(object):
                           a url, an internal method or subtask dict
             - on_failure: callback when failure
             - on_complete: callback when complete
+            - template: optional, string, name of a request template of
+                        the queue, see `set_template`
+            - targets: optional, a list of URLs the request is sent to
+                       instead of its url, by chunks of `fanout_chunk`.
+                       The callbacks are called once with a
+                       AggregateResponse when every target is sent
+            - coalesce: boolean, once due the task is batched with the
+                        other due coalesced tasks to the same endpoint,
+                        see `flush_batch`
+            - idempotency_key: optional, string, the insertions with the
+                               same key within `dedupe_window` seconds
+                               return the task inserted first, even if
+                               it is already done, without adding any
 
         Returns:
             task dict
 
+        """
+        task, _ = self._add_task(request, cname, countdown, eta, schedule,
+                                 on_success, on_failure, on_complete,
+                                 template, targets, coalesce,
+                                 idempotency_key=idempotency_key)
+        return task.to_dict()
+
+    def add_task_json(self, *args, **kwargs):
+        """adding and dispatch task
+
+        Parameters:
+            same as add_task
+
+        Returns:
+            task in a JSON string, spliced from the JSON-encoded
+            fields written into redis instead of encoding the task again
+
+        """
+        task, task_dict = self._add_task(*args, **kwargs)
+        return Task._json_from_redis(task.id, task_dict)
+
+    def add_group(self, tasks, on_success=None, on_failure='__report__',
+                  on_complete=None):
+        """adding tasks whose group callbacks are called once all of
+        them are done
+
+        Every task keeps its own callbacks. When the last task of the
+        group is done, the group callbacks are called once with an
+        AggregateResponse of the status code of each task, the name of
+        the exception raised sending it, or "cancelled" if it was
+        deleted.
+
+        Parameters:
+            - tasks: list of dicts of the arguments of add_task, they
+                     can not be scheduled nor have an idempotency_key
+            - on_success: callback when every task succeeded, same as
+                          the ones of add_task
+            - on_failure: callback when any task failed
+            - on_complete: callback when the group is done
+
+        Returns:
+            dict of the group id as "group" and the task dicts as "tasks"
+
+        """
+        group_id, added = self._add_group(tasks, on_success, on_failure,
+                                          on_complete)
+        return {'group': group_id,
+                'tasks': [task.to_dict() for task, _ in added]}
+
+    def add_group_json(self, *args, **kwargs):
+        """adding a group of tasks
+
+        Parameters:
+            same as add_group
+
+        Returns:
+            the group in a JSON string, the tasks spliced from their
+            JSON-encoded fields like add_task_json
+
+        """
+        group_id, added = self._add_group(*args, **kwargs)
+        return '{{"group":{0},"tasks":[{1}]}}'.format(
+            _dumps(group_id), ','.join(
+                Task._json_from_redis(task.id, task_dict)
+                for task, task_dict in added))
+
+    def _add_group(self, tasks, on_success=None, on_failure='__report__',
+                   on_complete=None):
+        if not tasks:
+            raise ValueError('a group needs at least one task')
+        group_id = uuid4().hex
+        body = _dumps({'total': len(tasks), 'on_success': on_success,
+                       'on_failure': on_failure, 'on_complete': on_complete})
+        added = []
+        # the messages are sent once the group is stored
+        with self.batch():
+            try:
+                for kwargs in tasks:
+                    added.append(self._add_task(group=group_id, **kwargs))
+            except Exception:
+                for task, _ in added:
+                    self._delete_task(task)
+                raise
+            self.backend.add_group(self, group_id, len(added), body)
+        return group_id, added
+
+    def get_group(self, group_id):
+        """getting the progress of a group of tasks, a group is deleted
+        once its callbacks are called
+
+        Returns:
+            dict of the group id as "group", "total", "left" the count
+            of tasks not done yet, and the "results" of the done ones
+
+        """
+        stored = self.backend.get_group(self, group_id)
+        if stored is None:
+            raise GroupNotFound('group "{0}" is not found'.format(group_id))
+        left, body, results = stored
+        for task_id, result in dict_items(results):
+            results[task_id] = _loads(result)
+        return {'group': group_id, 'total': _loads(body)['total'],
+                'left': left, 'results': results}
+
+    def _group_done(self, task, result):
+        """counting a task of a group done, the last one calls the
+        callbacks of the group"""
+        done = self.backend.group_done(self, task.group, task.id,
+                                       _dumps(result))
+        if done is None:
+            return
+        body, results = _loads(done[0]), done[1]
+        for task_id, val in dict_items(results):
+            results[task_id] = _loads(val)
+        response = AggregateResponse(None, results, body['total'])
+        if response.status_code == 200:
+            task._dispatch_callback(body['on_success'], response)
+        else:
+            task._dispatch_callback(body['on_failure'], response)
+        task._dispatch_callback(body['on_complete'], response)
+
+    @measured('add_task')
+    @hooked('add_task', returns_task=True)
+    def _add_task(self, request, cname=None,
+                  countdown=None, eta=None,
+                  schedule=None, on_success=None,
+                  on_failure='__report__',
+                  on_complete=None, template=None, targets=None,
+                  coalesce=False, group=None, idempotency_key=None):
+        """adding and dispatch task
+
+        Do not use this method directly, use add_task instead
+
+        Returns:
+            tuple of Task object and its JSON-encoded fields in redis
+
         """
         if eta and eta.tzinfo is None:
             # a naive timestamp, localize it
             eta = self.localzone.localize(eta)
         if schedule and not cname:
             raise TaskCNameRequired('Scheduled task must have a custom name')
+        if template is not None:
+            self._template(template)
+        if targets is not None:
+            if schedule:
+                raise ValueError('fan-out task can not be scheduled')
+            # each target once, in order
+            seen = set()
+            targets = [url for url in targets
+                       if url not in seen and not seen.add(url)]
+            if not targets:
+                raise ValueError('fan-out task must have targets')
+        if coalesce and (schedule or targets is not None):
+            raise ValueError('scheduled or fan-out task can not be '
+                             'coalesced')
+        if group is not None and schedule:
+            raise ValueError('scheduled task can not be in a group')
+        if group is not None and idempotency_key is not None:
+            # the task returned for a used key never reports to the group
+            raise ValueError('task of a group can not have an '
+                             'idempotency key')
         task = Task(request=request, cname=cname,
                     countdown=countdown, eta=eta,
                     schedule=schedule,
                     on_success=on_success,
                     on_failure=on_failure,
-                    on_complete=on_complete)
-        incrkey, incrhash = self.__hincrkey()
-        with self.redis.pipeline() as pipe:
-            try:
-                if task.cname:
-                    cname = task.cname
-                    cnamekey = self.__cnamekey(cname)
-                    pipe.watch(cnamekey)
-                    exists = pipe.exists(cnamekey)
-                    if exists:
-                        raise TaskAlreadyExists(
-                            'task "{0}" is already exists (1)'.format(cname))
-                    pipe.multi()
-                task.id = idx = self.redis.hincrby(incrkey, incrhash)
-                if task.cname:
-                    pipe.set(cnamekey, idx)
-                metakey = self.__metakey(idx)
-                _, task_dict = task._to_redis()
-                pipe.hmset(metakey, task_dict)
-                if task.schedule:
-                    schedkey = self.__schedkey()
-                    pipe.zadd(schedkey, 0, idx)
-                pipe.execute()
-            except WatchError:
-                raise TaskAlreadyExists(
-                    'task "{0}" is already exists (2)'.format(cname))
+                    on_complete=on_complete,
+                    template=template,
+                    fanout=len(targets) if targets else None,
+                    coalesce=coalesce or None,
+                    group=group)
+        if idempotency_key is None and self.dedupe_content and \
+                not schedule and group is None:
+            idempotency_key = content_hash({
+                'request': request, 'cname': cname,
+                'countdown': countdown, 'eta': eta,
+                'on_success': on_success, 'on_failure': on_failure,
+                'on_complete': on_complete, 'template': template,
+                'targets': targets, 'coalesce': coalesce})
+        if self.compress_threshold:
+            task.request = compress_request(task.request,
+                                            self.compress_threshold,
+                                            self.compress_codec)
+        if idempotency_key is None:
+            return self._insert_task(task, targets)
+        stored = self.backend.get_dedupe(self, idempotency_key)
+        if stored is None:
+            # its message is sent once the key is claimed
+            with self.batch():
+                task, task_dict = self._insert_task(task, targets)
+                value = _dumps([task.id, task_dict])
+                stored = self.backend.claim_dedupe(
+                    self, idempotency_key, value, self.dedupe_window)
+                if stored == value:
+                    return task, task_dict
+                # a concurrent duplicate claimed it first, the message
+                # of this one will find no task
+                self._delete_task(task)
+        registry.inc('asynx_deduplicated_total', 1,
+                     (('app', self.appname), ('queue', self.queuename)))
+        task_id, task_dict = _loads(stored)
+        task = Task._from_redis(task_id, task_dict)
         task.bind_taskqueue(self)
-        self._dispatch_task(task)
-        return task.to_dict()
+        return task, task_dict
+
+    def _insert_task(self, task, targets=None):
+        """storing a new task and sending its message, or storing it in
+        the cold tier if due beyond the cold horizon"""
+        horizon = self.backend.cold_horizon
+        if horizon and task.schedule is None and task.eta is not None and \
+                task.countdown > horizon:
+            return self._add_cold_task(task, targets)
+        _, task_dict = task._to_redis()
+        task.id = self.backend.add(self, task_dict, task.cname,
+                                   bool(task.schedule))
+        if task.id is None:
+            raise TaskAlreadyExists(
+                'task "{0}" is already exists'.format(task.cname))
+        if targets:
+            self.backend.add_targets(self, task.id, targets)
+        task.bind_taskqueue(self)
+        task_dict.update(self._dispatch_task(task))
+        return task, task_dict
+
+    def _add_cold_task(self, task, targets=None):
+        """storing a task due beyond the cold horizon without sending it
+        to celery, its uuid is the one of the message sent when it is
+        promoted"""
+        task.uuid = str(uuid4())
+        task.status = 'delayed'
+        _, task_dict = task._to_redis()
+        due = clock.now() + task.countdown
+        task.id = self.backend.add_cold(self, task_dict, task.uuid, due,
+                                        task.cname)
+        if task.id is None:
+            raise TaskAlreadyExists(
+                'task "{0}" is already exists'.format(task.cname))
+        if targets:
+            self.backend.add_targets(self, task.id, targets)
+        task.bind_taskqueue(self)
+        return task, task_dict
+
+    @classmethod
+    def promote_cold_tasks(cls, backend, limit=1000):
+        """moving the cold tasks due within the cold horizon of the
+        backend into the hot tier, and sending them to celery
+
+        Parameters:
+            - backend: storage backend
+            - limit: integer, maximum tasks promoted
+
+        Returns:
+            integer, count of promoted tasks
+
+        """
+        horizon = backend.cold_horizon
+        if not horizon:
+            return 0
+        popped = backend.pop_cold(clock.now() + horizon, limit)
+        sent = {}
+        try:
+            for appname, queuename, task_id, task_dict in popped:
+                tq = cls(appname, queuename)
+                tq.bind_backend(backend)
+                task = Task._from_redis(task_id, task_dict)
+                task.bind_taskqueue(tq)
+                tq._dispatch_task(task, keep_uuid=True)
+                sent.setdefault((appname, queuename), (tq, []))[1].append(
+                    task_id)
+        finally:
+            # the unsent ones are popped again, with the same uuid
+            for tq, task_ids in sent.values():
+                backend.promoted(tq, task_ids)
+        return len(popped)
+
+    @classmethod
+    def recover_tasks(cls, backend, grace=600, limit=1000):
+        """sending again the messages of the new, delayed and scheduled
+        tasks of a durable backend due more than `grace` seconds ago, they
+        may be lost with the broker. A message still in the broker is run
+        first, the second finds its task no longer waiting
 
+        Parameters:
+            - backend: storage backend
+            - grace: float, seconds a task may wait in the broker
+            - limit: integer, maximum tasks recovered
+
+        Returns:
+            integer, count of recovered tasks
+
+        """
+        if not backend.durable:
+            return 0
+        stale = backend.claim_stale(clock.now() - grace, limit)
+        for appname, queuename, task_id, task_dict in stale:
+            tq = cls(appname, queuename)
+            tq.bind_backend(backend)
+            task = Task._from_redis(task_id, task_dict)
+            task.bind_taskqueue(tq)
+            # no uuid if its message was never sent
+            tq._dispatch_task(task, keep_uuid=task.uuid is not None)
+        return len(stale)
+
+    @replica_read
     def iter_tasks(self, offset=0, per_pipeline=50):
         """iterating tasks start from offset
 
@@ -253,27 +865,41 @@ class TaskQueue(object):
             a generator iterating dict of tasks
 
         """
-        uuidkey = self.__uuidkey()
+        for idx, task_dict in self._iter_stored(offset, per_pipeline):
+            yield Task._from_redis(idx, task_dict).to_dict()
+
+    @replica_read
+    def iter_tasks_json(self, offset=0, per_pipeline=50):
+        """iterating tasks in JSON start from offset
+
+        Parameters:
+            same as iter_tasks
+
+        Returns:
+            a generator iterating JSON strings of tasks, spliced from the
+            JSON-encoded fields stored in redis without decoding them
+
+        """
+        for idx, task_dict in self._iter_stored(offset, per_pipeline):
+            yield Task._json_from_redis(idx, task_dict)
+
+    def _iter_stored(self, offset, per_pipeline):
+        backend = self.backend
         while 1:
-            result = self.redis.zrange(uuidkey, offset,
-                                       offset + per_pipeline - 1,
-                                       withscores=True, score_cast_func=int)
+            result = backend.range(self, offset, per_pipeline)
             if not result:
                 break
-            with self.redis.pipeline() as pipe:
-                for uuid, idx in result:
-                    metakey = self.__metakey(idx)
-                    pipe.hgetall(metakey)
-                tasks = pipe.execute()
+            tasks = backend.get_many(self, [idx for _, idx in result])
             for uuid_idx, task_dict in zip(result, tasks):
-                if task_dict is None:
-                    continue  # wtf?!
+                if not task_dict:
+                    continue  # deleted after zrange
                 uuid, idx = uuid_idx
-                yield Task._from_redis(idx, task_dict).to_dict()
+                yield idx, task_dict
             if len(result) < per_pipeline:
                 break
             offset += per_pipeline
 
+    @replica_read
     def count_tasks(self):
         """counting tasks
 
@@ -281,9 +907,33 @@ class TaskQueue(object):
             integer, count of all tasks in the queue
 
         """
-        uuidkey = self.__uuidkey()
-        return self.redis.zcard(uuidkey)
+        return self.backend.count(self)
+
+    @classmethod
+    def count_all_tasks(cls, connection):
+        """counting tasks of every taskqueue ever created
+
+        Parameters:
+            - connection: storage backend or redis connection
+
+        Returns:
+            a list of (appname, queuename, count)
 
+        """
+        return as_backend(connection).count_all()
+
+    @replica_read
+    def count_app_tasks(self):
+        """counting tasks of the app across all queues
+
+        Returns:
+            integer, count of all tasks in the app's queues
+
+        """
+        return self.backend.count_app(self)
+
+    @measured('list_tasks')
+    @replica_read
     def list_tasks(self, offset=0, limit=50):
         """listing tasks with offset and limit
 
@@ -299,6 +949,29 @@ class TaskQueue(object):
         tasks = self.iter_tasks(offset, per_pipeline)
         return list(islice(tasks, 0, limit))
 
+    @measured('list_tasks')
+    @replica_read
+    def list_tasks_json(self, offset=0, limit=50):
+        """listing tasks in JSON with offset and limit
+
+        Parameters:
+            same as list_tasks
+
+        Returns:
+            a list of tasks (JSON string)
+
+        """
+        per_pipeline = min(limit + 10, 100)
+        tasks = self.iter_tasks_json(offset, per_pipeline)
+        return list(islice(tasks, 0, limit))
+
+    def _get_stored(self, task_id):
+        task_dict = self.backend.get(self, task_id)
+        if not task_dict:
+            raise TaskNotFound('task "{0}" is not exist (r)'
+                               .format(task_id))
+        return task_dict
+
     def _get_task(self, task_id):
         """retrieving task by task_id
 
@@ -307,15 +980,12 @@ class TaskQueue(object):
         returns Task object
 
         """
-        metakey = self.__metakey(task_id)
-        task_dict = self.redis.hgetall(metakey)
-        if not task_dict:
-            raise TaskNotFound('task "{0}" is not exist (r)'
-                               .format(task_id))
-        task = Task._from_redis(task_id, task_dict)
+        task = Task._from_redis(task_id, self._get_stored(task_id))
         task.bind_taskqueue(self)
         return task
 
+    @measured('get_task')
+    @replica_read
     def get_task(self, task_id):
         """retrieving task by task id
 
@@ -328,14 +998,32 @@ class TaskQueue(object):
         """
         return self._get_task(task_id).to_dict()
 
-    def _get_task_by_uuid(self, uuid):
-        uuidkey = self.__uuidkey()
-        task_id = self.redis.zscore(uuidkey, uuid)
+    @measured('get_task')
+    @replica_read
+    def get_task_json(self, task_id):
+        """retrieving task in JSON by task id
+
+        Parameters:
+            - task_id: integer, task id
+
+        Returns:
+            task in a JSON string
+
+        """
+        return Task._json_from_redis(task_id, self._get_stored(task_id))
+
+    def _task_id_by_uuid(self, uuid):
+        task_id = self.backend.id_by_uuid(self, uuid)
         if not task_id:
             raise TaskNotFound('task with uuid "{0}" is not found'
                                .format(uuid))
-        return self._get_task(int(task_id))
+        return task_id
+
+    def _get_task_by_uuid(self, uuid):
+        return self._get_task(self._task_id_by_uuid(uuid))
 
+    @measured('get_task')
+    @replica_read
     def get_task_by_uuid(self, uuid):
         """retrieving task by task uuid
 
@@ -348,14 +1036,32 @@ class TaskQueue(object):
         """
         return self._get_task_by_uuid(uuid).to_dict()
 
-    def _get_task_by_cname(self, cname):
-        cnamekey = self.__cnamekey(cname)
-        task_id = self.redis.get(cnamekey)
+    @measured('get_task')
+    @replica_read
+    def get_task_by_uuid_json(self, uuid):
+        """retrieving task in JSON by task uuid
+
+        Parameters:
+            - uuid: string, task's uuid
+
+        Returns:
+            task in a JSON string
+
+        """
+        return self.get_task_json(self._task_id_by_uuid(uuid))
+
+    def _task_id_by_cname(self, cname):
+        task_id = self.backend.id_by_cname(self, cname)
         if not task_id:
             raise TaskNotFound('task with cname "{0}" is not found'
                                .format(cname))
-        return self._get_task(int(task_id))
+        return task_id
+
+    def _get_task_by_cname(self, cname):
+        return self._get_task(self._task_id_by_cname(cname))
 
+    @measured('get_task')
+    @replica_read
     def get_task_by_cname(self, cname):
         """retrieving task by task cname
 
@@ -368,31 +1074,33 @@ class TaskQueue(object):
         """
         return self._get_task_by_cname(cname).to_dict()
 
-    def _delete_task(self, task):
+    @measured('get_task')
+    @replica_read
+    def get_task_by_cname_json(self, cname):
+        """retrieving task in JSON by task cname
+
+        Parameters:
+            - cname: string, task's cname
+
+        Returns:
+            task in a JSON string
+
+        """
+        return self.get_task_json(self._task_id_by_cname(cname))
+
+    def _delete_task(self, task, cancelled=False):
         """deleting task
 
         Do not use this method directly, use delete_task instead
 
         """
-        metakey = self.__metakey(task.id)
-        uuidkey = self.__uuidkey()
-        cnamekey = None
-        schedkey = None
-        if task.cname:
-            cnamekey = self.__cnamekey(task.cname)
-        if task.schedule:
-            schedkey = self.__schedkey()
-
-        def __delete_task(pipe):
-            pipe.multi()
-            pipe.delete(metakey)
-            pipe.zrem(uuidkey, task.uuid)
-            if cnamekey:
-                pipe.delete(cnamekey)
-            if schedkey:
-                pipe.zrem(schedkey, task.id)
-        self.redis.transaction(__delete_task, metakey, uuidkey, cnamekey)
+        self.backend.delete(self, task.id, task.uuid, task.cname,
+                            bool(task.schedule))
+        if cancelled and task.group is not None:
+            # its group doesn't wait for it
+            self._group_done(task, 'cancelled')
 
+    @measured('delete_task')
     def delete_task(self, task_id):
         """deleting task by task id
 
@@ -404,8 +1112,9 @@ class TaskQueue(object):
         if task.status == 'running':
             raise TaskStatusNotMatched('task "{0}" can not be deleted '
                                        'because it is running'.format(task.id))
-        self._delete_task(task)
+        self._delete_task(task, cancelled=True)
 
+    @measured('delete_task')
     def delete_task_by_uuid(self, uuid):
         """deleting task by task uuid
 
@@ -414,8 +1123,9 @@ class TaskQueue(object):
 
         """
         task = self._get_task_by_uuid(uuid)
-        self._delete_task(task)
+        self._delete_task(task, cancelled=True)
 
+    @measured('delete_task')
     def delete_task_by_cname(self, cname):
         """deleting task by task cname
 
@@ -424,41 +1134,328 @@ class TaskQueue(object):
 
         """
         task = self._get_task_by_cname(cname)
-        self._delete_task(task)
+        self._delete_task(task, cancelled=True)
+
+    def _send_flush(self, key, countdown=None):
+        """sending a flush_batch message to celery"""
+        return flush_batch.apply_async(
+            [self.__class__, self.appname, self.queuename, key],
+            countdown=countdown)
+
+    def _coalesce(self, task):
+        """adding a due task to the batch of its endpoint, flushed
+        `coalesce_linger` seconds after its first task was added, or
+        as soon as it has `coalesce_max` tasks"""
+        if task.template is not None:
+            task._apply_template(self._template(task.template)[1])
+        key = batch_hash(task.request)
+        count = self.backend.push_batch(self, key, task.id)
+        if count == 1:
+            self._send_flush(key, self.coalesce_linger)
+        elif count % self.coalesce_max == 0:
+            self._send_flush(key)
+
+    @measured('dispatch')
+    def flush_batch(self, key):
+        """sending the first `coalesce_max` tasks of a batch in one
+        request, then their callbacks and deleting them
+
+        The body of the request is a JSON array of the payloads of the
+        tasks, decoded if they are JSON. If the response is a JSON array
+        as long, each task gets its element as the content of its
+        BatchItemResponse, else every task gets the whole response. The
+        header X-Asynx-TaskUUIDs lists the uuids of the tasks, in the
+        order of the array, instead of the headers of a single task.
 
-    def _update_status(self, task_id, next_status,
-                       *ensure_previous):
+        Parameters:
+            - key: string, the batch_hash of the tasks' request
 
-        def __update_status(pipe):
-            previous = not_bytes(pipe.hget(metakey, 'status'))
-            previous = _loads(previous)
-            if previous not in ensure_previous:
-                raise TaskStatusNotMatched(
-                    'status of task "{0}" is not matched ({1} not in {2})'
-                    .format(task_id, previous, ensure_previous))
-            pipe.multi()
-            now = utcnow()
-            pipe.hmset(metakey, {
-                'status': _dumps(next_status),
-                'last_run_at': _dumps(now.isoformat())
-            })
-            return now
+        Returns:
+            integer, count of tasks sent
 
-        metakey = self.__metakey(task_id)
-        self.redis.transaction(__update_status, metakey,
-                               value_from_callable=True)
+        """
+        ids = self.backend.pop_batch(self, key, self.coalesce_max)
+        labels = (('app', self.appname), ('queue', self.queuename))
+        tasks = []
+        timelines = []
+        for task_id, task_dict in zip(ids, self.backend.get_many(self, ids)):
+            if not task_dict:
+                # deleted while waiting
+                continue
+            timeline = Timeline(picked_up=clock.now())
+            try:
+                last_run_at = self._update_status(
+                    task_id, 'running', 'new', 'delayed')
+            except TaskStatusNotMatched:
+                continue
+            timeline.mark('status_cas')
+            task = Task._from_redis(task_id, task_dict)
+            task.bind_taskqueue(self)
+            previous_run_at = task.last_run_at
+            task.status = 'running'
+            task.last_run_at = last_run_at
+            task._observe_lag(timeline, previous_run_at, labels)
+            if task.template is not None:
+                task._apply_template(self._template(task.template)[1])
+            tasks.append(task)
+            timelines.append(timeline)
+        if tasks:
+            self._dispatch_batch(tasks, timelines)
+        return len(tasks)
+
+    def _dispatch_batch(self, tasks, timelines):
+        labels = (('app', self.appname), ('queue', self.queuename))
+        request = expand_request(tasks[0].request)
+        payloads = []
+        for task in tasks:
+            payload = expand_request(task.request).get('payload')
+            try:
+                payload = _loads(payload)
+            except (TypeError, ValueError):
+                pass
+            payloads.append(payload)
+        headers = dict(request.get('headers') or {})
+        headers.update({'Content-Type': 'application/json',
+                        'X-Asynx-Batch-Size': str(len(tasks))})
+        request_start = clock.now()
+        for timeline in timelines:
+            timeline.mark('request_start', request_start)
+        try:
+            response = tasks[0]._dispatch(batch=tasks, **dict(
+                request, headers=headers, payload=_dumps(payloads)))
+            first_byte = clock.now()
+            response.content  # reading the streamed body
+            body_done = clock.now()
+        except Exception as e:
+            elapsed = clock.now() - request_start
+            for task, timeline in zip(tasks, timelines):
+                registry.observe('asynx_dispatch_seconds', elapsed,
+                                 labels + (('status', 'error'), ))
+                self._record_timeline(task, timeline,
+                                      error=type(e).__name__)
+                if task.group is not None:
+                    self._group_done(task, type(e).__name__)
+            raise
+        items = None
+        try:
+            items = _loads(not_bytes(response.content))
+        except (TypeError, ValueError):
+            pass
+        if not isinstance(items, list) or len(items) != len(tasks):
+            items = None
+        for i, task in enumerate(tasks):
+            timeline = timelines[i]
+            timeline.mark('first_byte', first_byte)
+            timeline.mark('body_done', body_done)
+            item = response if items is None else \
+                BatchItemResponse(response, items[i])
+            registry.observe('asynx_dispatch_seconds',
+                             body_done - request_start,
+                             labels + (('status', '{0}xx'.format(
+                                 item.status_code // 100)), ))
+            if 200 <= item.status_code < 303:
+                task._dispatch_callback(task.on_success, item)
+            else:
+                task._dispatch_callback(task.on_failure, item)
+            task._dispatch_callback(task.on_complete, item)
+            timeline.mark('callbacks')
+            self._delete_task(task)
+            timeline.mark('deleted')
+            if task.group is not None:
+                self._group_done(task, item.status_code)
+            self._record_timeline(task, timeline, item.status_code)
+
+    def get_fanout_results(self, task_id):
+        """getting the results of the targets of a fan-out task sent
+        so far, they are deleted with the task
+
+        Parameters:
+            - task_id: integer, task id
+
+        Returns:
+            dict of target => status code, or the name of the exception
+            raised sending it
+
+        """
+        results = self.backend.get_results(self, task_id)
+        for target, result in dict_items(results):
+            results[target] = _loads(result)
+        return results
+
+    def _record_timeline(self, task, timeline, status_code=None,
+                         error=None):
+        """keeping a dispatch timeline if it is one of the slowest,
+        and its phases in the recent ones"""
+        if not self.slow_timelines and not self.recent_timelines:
+            return
+        phases = timeline.phases()
+        total = timeline.total()
+        slowest = recent = None
+        if self.slow_timelines:
+            slowest = (total, _dumps({
+                'id': task.id,
+                'uuid': task.uuid,
+                'cname': task.cname,
+                'url': task.request.get('url'),
+                'status_code': status_code,
+                'error': error,
+                'marks': timeline.marks,
+                'phases': phases,
+                'total': total}), self.slow_timelines)
+        if self.recent_timelines:
+            phases['total'] = total
+            recent = (_dumps(phases), self.recent_timelines)
+        self.backend.record_timeline(self, slowest, recent)
+
+    @replica_read
+    def get_timelines(self):
+        """retrieving the kept dispatch timelines
+
+        Returns:
+            a dict contains:
+                - slowest: list of the slowest timelines, slowest first
+                - percentiles: dict of p50, p95 and p99 seconds of every
+                               phase in the recent timelines
+                - samples: integer, count of the recent timelines
+
+        """
+        slowest, recent = self.backend.get_timelines(self)
+        values = {}
+        for phases in recent:
+            for phase, seconds in dict_items(_loads(not_bytes(phases))):
+                values.setdefault(phase, []).append(seconds)
+        result = {}
+        for phase, seconds in dict_items(values):
+            result[phase] = percentiles(seconds)
+        return {
+            'slowest': [_loads(not_bytes(t)) for t in slowest],
+            'percentiles': result,
+            'samples': len(recent)}
+
+    def set_template(self, name, request, on_success=None,
+                     on_failure=None, on_complete=None):
+        """storing a new version of a named request template
+
+        Tasks referencing the template store only the arguments they
+        override, and are merged with its current version when they are
+        dispatched. Callbacks of the template apply to tasks keeping the
+        default ones.
+
+        Parameters:
+            - name: string, template's name
+            - request: a dict of request arguments, like add_task
+            - on_success, on_failure, on_complete: optional callbacks
+
+        Returns:
+            template dict
+
+        """
+        body = {'request': request}
+        for key, val in (('on_success', on_success),
+                         ('on_failure', on_failure),
+                         ('on_complete', on_complete)):
+            if val is not None:
+                body[key] = val
+        version = self.backend.set_template(self, name, _dumps(body))
+        self._forget_template(name)
+        body.update(name=name, version=version)
+        return body
+
+    def _forget_template(self, name):
+        _templates.pop((id(self.backend), self.appname, self.queuename,
+                        name), None)
+
+    def _template(self, name):
+        """the current version of a template, cached for `template_ttl`
+        seconds, then only its version is read again unless it changed
+
+        Returns:
+            tuple of (version, template dict)
+
+        """
+        key = (id(self.backend), self.appname, self.queuename, name)
+        cached = _templates.get(key)
+        now = clock.now()
+        if cached is not None:
+            version, body, checked_at = cached
+            if now - checked_at < self.template_ttl or \
+                    self.backend.template_version(self, name) == version:
+                _templates[key] = (version, body, now)
+                return version, body
+        stored = self.backend.get_template(self, name)
+        if stored is None:
+            _templates.pop(key, None)
+            raise TemplateNotFound(
+                'template "{0}" is not found'.format(name))
+        version, body = stored[0], _loads(not_bytes(stored[1]))
+        _templates[key] = (version, body, now)
+        return version, body
+
+    def get_template(self, name):
+        """getting a request template
+
+        Returns:
+            template dict
+
+        """
+        stored = self.backend.get_template(self, name)
+        if stored is None:
+            raise TemplateNotFound(
+                'template "{0}" is not found'.format(name))
+        body = _loads(not_bytes(stored[1]))
+        body.update(name=name, version=stored[0])
+        return body
+
+    def list_templates(self):
+        """listing the request templates of the queue
+
+        Returns:
+            list of template dicts, ordered by name
+
+        """
+        templates = []
+        for name, version, body in self.backend.list_templates(self):
+            body = _loads(not_bytes(body))
+            body.update(name=name, version=version)
+            templates.append(body)
+        return templates
+
+    def delete_template(self, name):
+        """deleting a request template, the tasks still referencing it
+        fail when dispatched"""
+        self._forget_template(name)
+        if not self.backend.delete_template(self, name):
+            raise TemplateNotFound(
+                'template "{0}" is not found'.format(name))
+
+    def _update_status(self, task_id, next_status,
+                       *ensure_previous):
+        now = utcnow()
+        updated, previous = self.backend.transition(
+            self, task_id,
+            {'status': _dumps(next_status),
+             'last_run_at': _dumps(now.isoformat())},
+            [_dumps(status) for status in ensure_previous])
+        if not updated:
+            raise TaskStatusNotMatched(
+                'status of task "{0}" is not matched ({1} not in {2})'
+                .format(task_id, previous and _loads(previous),
+                        ensure_previous))
+        return now
 
 
 class Task(object):
 
     __slots__ = ('request', 'id', 'uuid', 'cname',
                  '_eta', 'schedule', '_last_run_at', 'status',
-                 'on_success', 'on_failure', 'on_complete', '_taskqueue')
+                 'on_success', 'on_failure', 'on_complete', 'template',
+                 'fanout', 'coalesce', 'group', '_taskqueue')
 
     def __init__(self, request, id=None, uuid=None, cname=None,
                  countdown=None, eta=None, schedule=None,
                  last_run_at=None, status='new', on_success=None,
-                 on_failure='__report__', on_complete=None):
+                 on_failure='__report__', on_complete=None, template=None,
+                 fanout=None, coalesce=None, group=None):
         self.id = id
         self.request = request
         self.uuid = uuid
@@ -466,6 +1463,11 @@ class Task(object):
         self.countdown = countdown
         if countdown is None:
             self.eta = eta
+        if schedule is not None and schedule.nowfun is None:
+            # celery schedules tell if they are due by the asynx-core
+            # clock, the caller's one is left as it is
+            schedule = copy.copy(schedule)
+            schedule.nowfun = utcnow
         self.schedule = schedule
         self.last_run_at = last_run_at
         # valid status: new, scheduled, delayed, running
@@ -473,6 +1475,12 @@ class Task(object):
         self.on_success = on_success
         self.on_failure = on_failure
         self.on_complete = on_complete
+        self.template = template
+        # count of targets of a fan-out task
+        self.fanout = fanout
+        self.coalesce = coalesce
+        # id of the group of tasks it is in
+        self.group = group
         self._taskqueue = None
 
     __init_args = inspect.getargspec(__init__).args
@@ -559,6 +1567,7 @@ class Task(object):
     def _report_response(self, response):
         pass
 
+    @hooked('callback')
     def _dispatch_callback(self, method, response):
         if method == '__report__':
             return self._report_response(response)
@@ -571,12 +1580,13 @@ class Task(object):
                             'url': method}
             }
         if isinstance(method, dict):
-            # chained task
-            kwargs = copy.deepcopy(method)
-            if 'headers' not in kwargs['request']:
-                kwargs['request']['headers'] = {}
+            # chained task, copying only what is changed
+            kwargs = dict(method)
+            kwargs['request'] = dict(method.get('request') or {})
+            kwargs['request']['headers'] = dict(
+                kwargs['request'].get('headers') or {})
             kwargs['request']['headers'].update({
-                'X-Asynx-Chained': self.request['url'],
+                'X-Asynx-Chained': self.request.get('url') or '-',
                 'X-Asynx-Chained-TaskUUID': self.uuid,
                 'X-Asynx-Chained-TaskETA': (self.eta.isoformat()
                                             if self.eta else '-'),
@@ -588,53 +1598,159 @@ class Task(object):
             kwargs['request']['payload'] = payload
             return self.taskqueue.add_task(**kwargs)
 
-    def apply_async(self, last_run_at):
+    def apply_async(self, last_run_at, task_id=None):
+        """sending the message of this task
+
+        Returns:
+            float, unix timestamp the message is due at
+
+        """
         tq = self.taskqueue
         args = [tq.__class__, tq.appname, tq.queuename, self.id]
+        countdown = None
         if self.schedule is not None:
             # scheduled task
             is_due, remaining_s = self.schedule.is_due(last_run_at)
-            if is_due:
-                # apply immediately, no time to set up status
-                result = request_task.apply_async(args)
-            else:
-                result = request_task.apply_async(
-                    args, countdown=remaining_s)
+            if not is_due:
+                # else apply immediately, no time to set up status
+                countdown = remaining_s
                 if remaining_s > 0.5:
                     self.status = 'scheduled'
-        elif self.eta is None or self.countdown <= 0:
-            # apply async immediately
-            result = request_task.apply_async(args)
-        else:
-            result = request_task.apply_async(
-                args, countdown=self.countdown)
-            if self.countdown > 0.5:
+        elif self.eta is not None and self.countdown > 0:
+            countdown = self.countdown
+            if countdown > 0.5:
                 self.status = 'delayed'
+        # else apply async immediately
+        now = clock.now()
+        kwargs = {'enqueued_at': now, 'due_at': now + (countdown or 0)}
+        result = tq._send_task(args, kwargs, countdown, task_id)
         self.uuid = result.id
-        return result
+        return kwargs['due_at']
+
+    def _expected_run_at(self, previous_run_at):
+        if self.schedule is not None:
+            if previous_run_at is None:
+                return None
+            return previous_run_at + \
+                self.schedule.remaining_estimate(previous_run_at)
+        return self.eta
+
+    def _observe_lag(self, timeline, previous_run_at, labels):
+        if not registry.enabled:
+            return
+        marks = timeline.marks
+        if 'due' in marks:
+            lag = marks['status_cas'] - marks['due']
+        else:
+            # dispatched by a message without timestamps
+            expected = self._expected_run_at(previous_run_at)
+            if not expected:
+                return
+            lag = get_total_seconds(self.last_run_at - expected)
+        registry.observe('asynx_dispatch_lag_seconds', max(lag, 0), labels)
+
+    @measured('dispatch')
+    @hooked('dispatch')
+    def dispatch(self, timeline=None):
+        """dispatching the HTTP request, then the callbacks
 
-    def dispatch(self):
-        last_run_at = self.taskqueue._update_status(
+        Parameters:
+            - timeline: optional, a Timeline marked by request_task
+
+        """
+        if timeline is None:
+            timeline = Timeline(picked_up=clock.now())
+        tq = self.taskqueue
+        previous_run_at = self.last_run_at
+        last_run_at = tq._update_status(
             self.id, 'running', 'new', 'scheduled', 'delayed')
+        timeline.mark('status_cas')
         self.status = 'running'
         self.last_run_at = last_run_at
-        response = self._dispatch(**self.request)
+        labels = (('app', tq.appname), ('queue', tq.queuename))
+        self._observe_lag(timeline, previous_run_at, labels)
+        timeline.mark('request_start')
+        try:
+            if self.template is not None:
+                self._apply_template(tq._template(self.template)[1])
+            if self.fanout is not None:
+                response = self._dispatch_fanout()
+            else:
+                # decompressed only when sent
+                response = self._dispatch(**expand_request(self.request))
+            timeline.mark('first_byte')
+            if response is not None:
+                response.content  # reading the streamed body
+            timeline.mark('body_done')
+        except Exception as e:
+            registry.observe('asynx_dispatch_seconds',
+                             clock.now() - timeline.marks['request_start'],
+                             labels + (('status', 'error'), ))
+            tq._record_timeline(self, timeline, error=type(e).__name__)
+            if self.group is not None:
+                tq._group_done(self, type(e).__name__)
+            raise
+        if response is None:
+            # targets are left, sent by the next message
+            self.status = 'new'
+            tq._dispatch_task(self)
+            return
         status_code = response.status_code
+        registry.observe('asynx_dispatch_seconds',
+                         timeline.marks['body_done'] -
+                         timeline.marks['request_start'],
+                         labels + (('status', '{0}xx'.format(
+                             status_code // 100)), ))
         if status_code >= 200 and status_code < 303:
             self._dispatch_callback(self.on_success, response)
         else:
             self._dispatch_callback(self.on_failure, response)
         self._dispatch_callback(self.on_complete, response)
+        timeline.mark('callbacks')
         if self.schedule:
             # schedule next running
-            self.taskqueue._dispatch_task(self)
+            tq._dispatch_task(self)
         else:
             # afterward, delete the task whatever
-            self.taskqueue._delete_task(self)
+            tq._delete_task(self)
+        timeline.mark('deleted')
+        if self.group is not None:
+            tq._group_done(self, status_code)
+        tq._record_timeline(self, timeline, status_code)
+
+    def _dispatch_fanout(self):
+        """sending the request to the next chunk of targets
 
+        Returns:
+            an AggregateResponse once every target is sent, else None
+
+        """
+        tq = self.taskqueue
+        targets, left = tq.backend.pop_targets(tq, self.id, tq.fanout_chunk)
+        request = expand_request(self.request)
+        results = []
+        for url in targets:
+            # _dispatch adds its headers to the ones given
+            kwargs = dict(request, url=url,
+                          headers=dict(request.get('headers') or {}))
+            try:
+                response = self._dispatch(**kwargs)
+                response.content
+                result = response.status_code
+            except requests.RequestException as e:
+                result = type(e).__name__
+            results.append((url, _dumps(result)))
+        if results:
+            tq.backend.record_results(tq, self.id, results)
+        if left:
+            return None
+        return AggregateResponse(self.request.get('url'),
+                                 tq.get_fanout_results(self.id), self.fanout)
+
+    @hooked('request')
     def _dispatch(self, method, url, headers=None,
                   payload=None, timeout=None,
-                  allow_redirects=None):
+                  allow_redirects=None, batch=None):
         options = {}
         if headers:
             options['headers'] = headers
@@ -650,19 +1766,41 @@ class Task(object):
             options['allow_redirects'] = True
         elif method in ('HEAD', ):
             options['allow_redirects'] = False
+        # returning once the headers are read, to time the first byte
+        options['stream'] = True
+        headers['X-Asynx-QueueName'] = self.taskqueue.queuename
+        headers.setdefault('User-Agent', user_agent())
+        if batch is not None:
+            # one request for the tasks of a coalesced batch
+            headers['X-Asynx-TaskUUIDs'] = ','.join(
+                task.uuid for task in batch)
+            return requests.request(method, url, **options)
         headers.update({
-            'X-Asynx-QueueName': self.taskqueue.queuename,
             'X-Asynx-TaskUUID': self.uuid,
             'X-Asynx-TaskETA': self.eta.isoformat() if self.eta else '-',
         })
-        headers.setdefault('User-Agent', user_agent())
         if self.cname:
             headers['X-Asynx-TaskCName'] = self.cname
         return requests.request(method, url, **options)
 
+    _default_callbacks = (('on_success', None),
+                          ('on_failure', '__report__'),
+                          ('on_complete', None))
+
+    def _apply_template(self, template):
+        """merging the template into the request and the default
+        callbacks of this task, for dispatching it"""
+        self.request = merge_request(template['request'], self.request)
+        for key, default in self._default_callbacks:
+            if key in template and getattr(self, key) == default:
+                setattr(self, key, template[key])
+
+    # fields stored only by the tasks using them
+    _optional_fields = ('template', 'fanout', 'coalesce', 'group')
+
     def to_dict(self):
         return {
-            'request': self.request,
+            'request': expand_request(self.request),
             'id': self.id,
             'uuid': self.uuid,
             'cname': self.cname,
@@ -673,11 +1811,20 @@ class Task(object):
             'status': self.status,
             'on_success': self.on_success,
             'on_failure': self.on_failure,
-            'on_complete': self.on_complete}
+            'on_complete': self.on_complete,
+            'template': self.template,
+            'fanout': self.fanout,
+            'coalesce': self.coalesce,
+            'group': self.group}
 
     def _to_redis(self):
         task = self.to_dict()
         task_id = task.pop('id')
+        task['request'] = self.request
+        for key in self._optional_fields:
+            if task[key] is None:
+                # stored only by the tasks using them
+                del task[key]
         # don't store relative countdown in redis
         task.pop('countdown')
         if task['eta']:
@@ -690,6 +1837,39 @@ class Task(object):
             task[key] = _dumps(val)
         return task_id, task
 
+    @staticmethod
+    def _json_from_redis(task_id, task_dict):
+        """splicing JSON-encoded fields into a JSON object of task
+
+        Only the relative countdown is computed, from the eta field.
+
+        Doctest:
+            >>> task = _loads(Task._json_from_redis(7, {'eta': 'null',
+            ...                                         'fanout': '2'}))
+            >>> task['id'], task['countdown'], task['fanout'], task['coalesce']
+            (7, None, 2, None)
+
+        """
+        fields = []
+        countdown = None
+        optional = dict.fromkeys(Task._optional_fields, 'null')
+        for key, val in dict_items(task_dict):
+            key, val = not_bytes(key), not_bytes(val)
+            if key == 'eta' and val != 'null':
+                delta = parse_datetime(val[1:-1]) - utcnow()
+                countdown = get_total_seconds(delta)
+            elif key == 'request' and MARKER in val:
+                val = _dumps(expand_request(_loads(val)))
+            elif key in optional:
+                optional[key] = val
+                continue
+            fields.append('"{0}":{1}'.format(key, val))
+        fields.append('"id":{0}'.format(_dumps(task_id)))
+        fields.append('"countdown":{0}'.format(_dumps(countdown)))
+        for key in Task._optional_fields:
+            fields.append('"{0}":{1}'.format(key, optional[key]))
+        return '{' + ','.join(fields) + '}'
+
     @classmethod
     def from_dict(cls, task_dict):
         task_dict = dict([
@@ -705,10 +1885,11 @@ class Task(object):
         task_dict = task_dict_tmp
         task_dict['id'] = task_id
         if task_dict['eta'] is not None:
-            task_dict['eta'] = parser.parse(task_dict['eta'])
+            task_dict['eta'] = parse_datetime(task_dict['eta'])
         if task_dict['schedule'] is not None:
             task_dict['schedule'] = \
                 cls._schedule_from_string(task_dict['schedule'])
         if task_dict['last_run_at'] is not None:
-            task_dict['last_run_at'] = parser.parse(task_dict['last_run_at'])
+            task_dict['last_run_at'] = parse_datetime(
+                task_dict['last_run_at'])
         return cls.from_dict(task_dict)
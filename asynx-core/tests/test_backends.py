@@ -0,0 +1,820 @@
+# -*- coding: utf-8 -*-
+
+import shutil
+import time
+import os.path
+import tempfile
+import threading
+from unittest import TestCase
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+
+import redis
+from celery import Celery, schedules
+
+from asynx_core import clock
+from asynx_core.backends import (RedisBackend, ShardedRedisBackend,
+                                 MemoryBackend, SqliteBackend, migrate_keys,
+                                 compact_keys, memory_report, HEARTBEAT_KEY)
+from asynx_core.metrics import Timeline
+from asynx_core._util import _dumps, _loads
+from asynx_core.taskqueue import (TaskQueue, Task, TaskAlreadyExists,
+                                  TaskNotFound, TaskStatusNotMatched,
+                                  TemplateNotFound, GroupNotFound,
+                                  batch_hash)
+
+
+class BackendTests(object):
+    """the same behaviours expected from every backend"""
+
+    def setUp(self):
+        self.conn0 = redis.StrictRedis()
+        self.conn0.delete('celery')
+        self.app = Celery(broker='redis://')
+        # countdowns computed by different calls are equal
+        self.clock = clock.set_clock(clock.VirtualClock())
+        self.backend = self.make_backend()
+        self.tq = TaskQueue('test')
+        self.tq.bind_backend(self.backend)
+
+    def tearDown(self):
+        clock.set_clock(self.clock)
+        self.conn0.delete('celery')
+
+    def test_add_get_delete(self):
+        tq = self.tq
+        task = tq.add_task({'url': 'http://httpbin.org/get'},
+                           cname='task1', countdown=100)
+        self.assertEqual(task['id'], 1)
+        self.assertEqual(task['status'], 'delayed')
+        self.assertEqual(tq.get_task(1), tq.get_task_by_cname('task1'))
+        self.assertEqual(tq.get_task(1), tq.get_task_by_uuid(task['uuid']))
+        self.assertRaises(TaskAlreadyExists, tq.add_task,
+                          {'url': 'http://httpbin.org/get'}, cname='task1')
+        tq.add_task({'url': 'http://httpbin.org/get'},
+                    cname='sched', schedule=schedules.schedule(60))
+        self.assertEqual(tq.count_tasks(), 2)
+        self.assertEqual(tq.count_app_tasks(), 2)
+        self.assertEqual(TaskQueue.count_all_tasks(self.backend),
+                         [('test', 'default', 2)])
+        tq.delete_task_by_cname('task1')
+        self.assertRaises(TaskNotFound, tq.get_task, 1)
+        self.assertRaises(TaskNotFound, tq.get_task_by_cname, 'task1')
+        self.assertRaises(TaskNotFound, tq.get_task_by_uuid, task['uuid'])
+        tq.delete_task(2)
+        self.assertEqual(tq.count_tasks(), 0)
+        self.assertEqual(tq.count_app_tasks(), 0)
+        # ids are never reused
+        task = tq.add_task({'url': 'http://httpbin.org/get'}, cname='task1')
+        self.assertEqual(task['id'], 3)
+
+    def test_list_tasks(self):
+        tq = self.tq
+        for i in range(25):
+            tq.add_task({'url': 'http://httpbin.org/get'}, countdown=100)
+        tasks = tq.list_tasks(offset=5, limit=10)
+        self.assertEqual([t['id'] for t in tasks], list(range(6, 16)))
+        self.assertEqual(len(list(tq.iter_tasks(per_pipeline=7))), 25)
+        self.assertEqual(len(tq.list_tasks_json(limit=100)), 25)
+
+    def test_templates(self):
+        tq = self.tq
+        self.assertRaises(TemplateNotFound, tq.add_task,
+                          {'url': 'http://httpbin.org/get'}, template='hook')
+        request = {'method': 'POST', 'url': 'http://httpbin.org/post',
+                   'headers': {'Authorization': 'Bearer 1'}}
+        template = tq.set_template('hook', request,
+                                   on_failure='http://httpbin.org/post')
+        self.assertEqual(template['version'], 1)
+        self.assertEqual(tq.get_template('hook'), template)
+        task = tq.add_task({'url': 'http://httpbin.org/anything',
+                            'headers': {'X-Index': '1'}},
+                           countdown=100, template='hook')
+        self.assertEqual(task['template'], 'hook')
+        self.assertEqual(_loads(tq.get_task_json(task['id']))['template'],
+                         'hook')
+        stored = tq._get_task(task['id'])
+        self.assertEqual(stored.request, {'url': 'http://httpbin.org/anything',
+                                          'headers': {'X-Index': '1'}})
+        stored._apply_template(tq._template('hook')[1])
+        self.assertEqual(stored.request['method'], 'POST')
+        self.assertEqual(stored.request['url'],
+                         'http://httpbin.org/anything')
+        self.assertEqual(stored.request['headers'],
+                         {'Authorization': 'Bearer 1', 'X-Index': '1'})
+        self.assertEqual(stored.on_failure, 'http://httpbin.org/post')
+        # updated by another process, seen once the cache expired
+        request['headers']['Authorization'] = 'Bearer 2'
+        self.backend.set_template(tq, 'hook', _dumps({'request': request}))
+        self.assertEqual(tq._template('hook')[0], 1)
+        clock.get_clock().advance(tq.template_ttl)
+        version, template = tq._template('hook')
+        self.assertEqual(version, 2)
+        self.assertEqual(template['request']['headers']['Authorization'],
+                         'Bearer 2')
+        tq.set_template('other', {'url': 'http://httpbin.org/get'})
+        self.assertEqual([t['name'] for t in tq.list_templates()],
+                         ['hook', 'other'])
+        tq.delete_template('hook')
+        self.assertRaises(TemplateNotFound, tq.get_template, 'hook')
+        self.assertRaises(TemplateNotFound, tq.delete_template, 'hook')
+        self.assertRaises(TemplateNotFound, tq._template, 'hook')
+        # versions are never reused
+        self.assertEqual(tq.set_template('hook', request)['version'], 3)
+
+    def test_fanout(self):
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers['Content-Length']))
+                self.send_response(200 if self.path == '/ok' else 404)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        server = HTTPServer(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        base = 'http://127.0.0.1:{0}/'.format(server.server_port)
+        targets = [base + 'ok', base + 'missing', base + 'ok', base + 'a/ok']
+        tq = self.tq
+        tq.fanout_chunk = 2
+        self.assertRaises(ValueError, tq.add_task, {'method': 'POST'},
+                          targets=[])
+        try:
+            task = tq.add_task({'method': 'POST', 'payload': '{"event": 1}'},
+                               targets=targets,
+                               on_failure='http://httpbin.org/post')
+            self.assertEqual(task['fanout'], 3)
+            tq._get_task(task['id']).dispatch()
+            # the last target is sent by the next message
+            self.assertEqual(tq.get_task(task['id'])['status'], 'new')
+            self.assertEqual(tq.get_fanout_results(task['id']),
+                             {base + 'ok': 200, base + 'missing': 404})
+            tq._get_task(task['id']).dispatch()
+        finally:
+            server.shutdown()
+            server.server_close()
+        self.assertRaises(TaskNotFound, tq.get_task, task['id'])
+        self.assertEqual(tq.get_fanout_results(task['id']), {})
+        self.assertEqual(self.backend.pop_targets(tq, task['id'], 10),
+                         ([], 0))
+        # the aggregated failure callback
+        callback = tq.get_task(task['id'] + 1)
+        self.assertEqual(callback['request']['url'], 'http://httpbin.org/post')
+        summary = _loads(_loads(callback['request']['payload'])['content'])
+        self.assertEqual((summary['total'], summary['succeeded'],
+                          summary['failed']), (3, 1, 2))
+        self.assertEqual(summary['results'][base + 'a/ok'], 404)
+
+    def test_coalesce(self):
+        received = []
+        uuids = []
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers['Content-Length']))
+                received.append((self.headers['X-Asynx-Batch-Size'],
+                                 _loads(body.decode('utf-8'))))
+                uuids.append((self.headers['X-Asynx-TaskUUIDs'],
+                              self.headers.get('X-Asynx-TaskUUID')))
+                content = _dumps([{'status': 200}, {'status': 503},
+                                  {'status': 200}]).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, *args):
+                pass
+
+        server = HTTPServer(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        url = 'http://127.0.0.1:{0}/events'.format(server.server_port)
+        tq = self.tq
+        tq.recent_timelines = 10
+        self.assertRaises(ValueError, tq.add_task, {'url': url},
+                          cname='sched', schedule=schedules.schedule(30),
+                          coalesce=True)
+        ids = []
+        sent = []
+        for payload in ('{"id": 1}', '{"id": 2}', 'plain', None):
+            task = tq.add_task({'method': 'POST', 'url': url,
+                                'payload': payload}, countdown=100,
+                               on_failure='http://httpbin.org/post',
+                               coalesce=True)
+            self.assertTrue(task['coalesce'])
+            ids.append(task['id'])
+            sent.append(task['uuid'])
+        other = tq.add_task({'method': 'POST', 'url': url,
+                             'headers': {'X-Other': '1'}}, coalesce=True)
+        self.conn0.delete('celery')
+        # their messages came
+        for task_id in ids + [other['id']]:
+            tq._coalesce(tq._get_task(task_id))
+        self.assertEqual(self.conn0.llen('celery'), 2)
+        tq.delete_task(ids.pop())
+        key = batch_hash({'method': 'POST', 'url': url})
+        try:
+            self.assertEqual(tq.flush_batch(key), 3)
+        finally:
+            server.shutdown()
+            server.server_close()
+        self.assertEqual(received, [('3', [{'id': 1}, {'id': 2}, 'plain'])])
+        self.assertEqual(uuids, [(','.join(sent[:3]), None)])
+        # a timeline for each task
+        self.assertEqual(tq.get_timelines()['samples'], 3)
+        for task_id in ids:
+            self.assertRaises(TaskNotFound, tq.get_task, task_id)
+        self.assertEqual(tq.flush_batch(key), 0)
+        # the second task failed
+        callback = tq.get_task(other['id'] + 1)
+        self.assertEqual(_loads(callback['request']['payload'])['content'],
+                         '{"status": 503}')
+        self.assertEqual(tq.get_task(other['id'])['status'], 'new')
+
+    def test_group(self):
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                self.send_response(200 if self.path == '/ok' else 500)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        server = HTTPServer(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        base = 'http://127.0.0.1:{0}/'.format(server.server_port)
+        tq = self.tq
+        get = {'method': 'GET'}
+        self.assertRaises(ValueError, tq.add_group, [])
+        self.assertRaises(ValueError, tq.add_group, [
+            {'request': dict(get, url=base + 'ok')},
+            {'request': dict(get, url=base + 'ok'), 'cname': 'sched',
+             'schedule': schedules.schedule(30)}])
+        # the tasks added before are deleted
+        self.assertEqual(tq.list_tasks(), [])
+        # a used key would return a task of another group
+        tq.add_task({'url': base + 'ok'}, idempotency_key='o-42')
+        self.assertRaises(ValueError, tq.add_group, [
+            {'request': dict(get, url=base + 'ok')},
+            {'request': dict(get, url=base + 'ok'),
+             'idempotency_key': 'o-42'}])
+        self.assertEqual(len(tq.list_tasks()), 1)
+        tq.delete_task(tq.list_tasks()[0]['id'])
+        group = tq.add_group([{'request': dict(get, url=base + 'ok')},
+                              {'request': dict(get, url=base + 'fail')},
+                              {'request': dict(get, url=base + 'ok'),
+                               'countdown': 100}],
+                             on_failure='http://httpbin.org/post')
+        ids = [task['id'] for task in group['tasks']]
+        self.assertEqual([task['group'] for task in group['tasks']],
+                         [group['group']] * 3)
+        self.assertEqual(tq.get_group(group['group']),
+                         {'group': group['group'], 'total': 3, 'left': 3,
+                          'results': {}})
+        try:
+            tq._get_task(ids[0]).dispatch()
+            tq.delete_task(ids[2])
+            self.assertEqual(tq.get_group(group['group'])['results'],
+                             {str(ids[0]): 200, str(ids[2]): 'cancelled'})
+            tq._get_task(ids[1]).dispatch()
+        finally:
+            server.shutdown()
+            server.server_close()
+        self.assertRaises(GroupNotFound, tq.get_group, group['group'])
+        # counted once
+        self.assertEqual(self.backend.group_done(
+            tq, group['group'], ids[1], '500'), None)
+        callback = tq.get_task(ids[2] + 1)
+        self.assertEqual(callback['request']['url'], 'http://httpbin.org/post')
+        summary = _loads(_loads(callback['request']['payload'])['content'])
+        self.assertEqual((summary['total'], summary['succeeded'],
+                          summary['failed']), (3, 1, 2))
+        self.assertEqual(summary['results'][str(ids[1])], 500)
+        # the JSON string
+        group = _loads(tq.add_group_json([{'request': dict(get, url=base)}]))
+        self.assertEqual(group['tasks'][0]['group'], group['group'])
+        self.assertEqual(tq.get_group(group['group'])['left'], 1)
+
+    def test_idempotency(self):
+        tq = self.tq
+        request = {'method': 'POST', 'url': 'http://httpbin.org/post',
+                   'payload': '{"order": 42}'}
+        task = tq.add_task(request, countdown=100, idempotency_key='o-42')
+        self.assertEqual(self.conn0.llen('celery'), 1)
+        # a retry, even with another content
+        self.assertEqual(tq.add_task(dict(request, payload='{}'),
+                                     countdown=100,
+                                     idempotency_key='o-42'), task)
+        self.assertEqual(_loads(tq.add_task_json(
+            request, countdown=100, idempotency_key='o-42'))['id'],
+            task['id'])
+        self.assertEqual(self.conn0.llen('celery'), 1)
+        # the first task is returned once it is done
+        tq.delete_task(task['id'])
+        self.assertEqual(tq.add_task(request, idempotency_key='o-42')['id'],
+                         task['id'])
+        self.assertEqual(tq.list_tasks(), [])
+        # a concurrent duplicate claimed the key first
+        winner = tq.add_task(request, countdown=100, idempotency_key='race')
+        get_dedupe = self.backend.get_dedupe
+        self.backend.get_dedupe = lambda tq, key: None
+        try:
+            self.assertEqual(tq.add_task(request, countdown=100,
+                                         idempotency_key='race'), winner)
+        finally:
+            self.backend.get_dedupe = get_dedupe
+        self.assertEqual([t['id'] for t in tq.list_tasks()], [winner['id']])
+        # by content
+        tq.dedupe_content = True
+        task = tq.add_task(request, countdown=100)
+        self.assertEqual(tq.add_task(request, countdown=100), task)
+        self.assertNotEqual(tq.add_task(request, countdown=50), task)
+        # named tasks differ by their names
+        one = tq.add_task(request, cname='one', countdown=100)
+        two = tq.add_task(request, cname='two', countdown=100)
+        self.assertEqual((one['cname'], two['cname']), ('one', 'two'))
+        self.assertEqual(len(tq.list_tasks()), 5)
+
+    def test_update_status(self):
+        tq = self.tq
+        tq.add_task({'url': 'http://httpbin.org/get'}, countdown=100)
+        last_run_at = tq._update_status(1, 'running', 'new', 'delayed')
+        task = tq.get_task(1)
+        self.assertEqual(task['status'], 'running')
+        self.assertEqual(task['last_run_at'], last_run_at)
+        self.assertRaises(TaskStatusNotMatched, tq._update_status,
+                          1, 'running', 'new', 'delayed')
+        self.assertRaises(TaskStatusNotMatched, tq._update_status,
+                          100, 'running', 'new')
+
+    def test_timelines(self):
+        tq = self.tq
+        tq.slow_timelines = 2
+        tq.recent_timelines = 3
+        task = tq._add_task({'url': 'http://httpbin.org/get'})[0]
+        for total in (3, 1, 2, 4):
+            timeline = Timeline(picked_up=0, status_cas=0, deleted=total)
+            tq._record_timeline(task, timeline, 200)
+        timelines = tq.get_timelines()
+        self.assertEqual([t['total'] for t in timelines['slowest']], [4, 3])
+        self.assertEqual(timelines['samples'], 3)
+
+
+class RedisBackendTestCase(BackendTests, TestCase):
+
+    def make_backend(self):
+        conn1 = redis.StrictRedis(db=1)
+        conn1.flushdb()
+        self.addCleanup(conn1.flushdb)
+        return RedisBackend(conn1)
+
+
+class CompactRedisBackendTestCase(BackendTests, TestCase):
+
+    def make_backend(self):
+        conn1 = redis.StrictRedis(db=1)
+        conn1.flushdb()
+        self.addCleanup(conn1.flushdb)
+        return RedisBackend(conn1, compact=True)
+
+    def test_encoding(self):
+        request = {'method': 'POST', 'url': 'http://httpbin.org/post',
+                   'headers': {'Content-Type': 'application/json'},
+                   'payload': '{"a": 1}'}
+        task = self.tq.add_task(request, countdown=100)
+        conn1 = self.backend.redis
+        stored = conn1.hgetall('AX:M:{test:default}:1')
+        self.assertEqual(sorted(k.decode('utf-8') for k in stored),
+                         ['e', 'h', 'p', 'r', 't', 'u'])
+        # "listpack" since redis 7
+        self.assertTrue(conn1.object('encoding', 'AX:M:{test:default}:1')
+                        in (b'ziplist', b'listpack'))
+        self.assertEqual(self.tq.get_task(1), task)
+        self.assertEqual(self.tq.list_tasks(), [task])
+        # the defaults are stored again once changed
+        self.tq._update_status(1, 'running', 'delayed')
+        self.assertEqual(self.tq.get_task(1)['status'], 'running')
+
+    def test_compact_keys(self):
+        conn1 = self.backend.redis
+        tq = TaskQueue('test')
+        tq.bind_redis(conn1)
+        tasks = [tq.add_task({'url': 'http://httpbin.org/get',
+                              'headers': {'X-Index': str(i)}},
+                             countdown=100) for i in range(10)]
+        full = memory_report(conn1)['full']
+        self.assertEqual(full['sampled'], 10)
+        self.assertEqual(compact_keys(conn1), [('test', 'default', 10)])
+        report = memory_report(conn1)
+        self.assertEqual(report['full']['sampled'], 0)
+        self.assertEqual(report['compact']['sampled'], 10)
+        self.assertTrue(report['compact']['bytes_per_task'] <
+                        full['bytes_per_task'])
+        self.assertEqual(self.tq.list_tasks(), tasks)
+        self.assertEqual(compact_keys(conn1, False),
+                         [('test', 'default', 10)])
+        self.assertEqual(tq.list_tasks(), tasks)
+
+
+class ShardedRedisBackendTestCase(BackendTests, TestCase):
+
+    def make_backend(self):
+        shards = [redis.StrictRedis(db=1), redis.StrictRedis(db=2)]
+        for conn in shards:
+            conn.flushdb()
+            self.addCleanup(conn.flushdb)
+        return ShardedRedisBackend(shards)
+
+    def test_spread(self):
+        counts = {}
+        for i in range(20):
+            tq = TaskQueue('test', 'queue{0}'.format(i))
+            tq.bind_backend(self.backend)
+            tq.add_task({'url': 'http://httpbin.org/get'}, countdown=100)
+            counts[self.backend.shard(tq)] = 1 + counts.get(
+                self.backend.shard(tq), 0)
+        self.assertEqual(sorted(counts.values()), [10, 10])
+        self.assertEqual(self.tq.count_app_tasks(), 20)
+        self.assertEqual(len(TaskQueue.count_all_tasks(self.backend)), 20)
+
+
+class ReplicaReadsTestCase(TestCase):
+
+    def setUp(self):
+        self.app = Celery(broker='redis://')
+        self.clock = clock.set_clock(clock.VirtualClock())
+        self.conn1 = redis.StrictRedis(db=1)
+        # a replica not replicating, its lag is set by hand
+        self.conn2 = redis.StrictRedis(db=2)
+        for conn in (self.conn1, self.conn2):
+            conn.flushdb()
+        self.backend = RedisBackend(self.conn1, replicas=[self.conn2],
+                                    max_lag=5, check_interval=1)
+        self.tq = TaskQueue('test')
+        self.tq.bind_backend(self.backend)
+        self.tq.replica_reads = True
+
+    def tearDown(self):
+        self.backend.stop_heartbeat()
+        clock.set_clock(self.clock)
+        for conn in (self.conn1, self.conn2):
+            conn.flushdb()
+        redis.StrictRedis().delete('celery')
+
+    def test_heartbeat(self):
+        self.backend.check_interval = 0.05
+        self.backend.check_replicas()
+        beat = float(self.conn1.get(HEARTBEAT_KEY))
+        # written on a timer, without reads
+        time.sleep(0.3)
+        self.assertTrue(float(self.conn1.get(HEARTBEAT_KEY)) > beat)
+        self.backend.stop_heartbeat()
+        time.sleep(0.1)
+        beat = self.conn1.get(HEARTBEAT_KEY)
+        time.sleep(0.2)
+        self.assertEqual(self.conn1.get(HEARTBEAT_KEY), beat)
+
+    def test_routing(self):
+        tq = self.tq
+        task = tq.add_task({'url': 'http://httpbin.org/get'}, countdown=100)
+        # no heartbeat on the replica yet
+        self.assertEqual(tq.get_task(task['id'])['id'], task['id'])
+        self.assertEqual(self.backend.lags, [None])
+        self.assertTrue(self.conn1.exists(HEARTBEAT_KEY))
+
+        # heartbeats are by the clock of the primary
+        self.conn2.set(HEARTBEAT_KEY, self.server_now() - 2)
+        clock.get_clock().advance(2)
+        self.assertRaises(TaskNotFound, tq.get_task, task['id'])
+        self.assertEqual(tq.count_tasks(), 0)
+        self.assertEqual(tq.list_tasks(), [])
+        self.assertEqual([int(lag) for lag in self.backend.lags], [2])
+        with tq.primary_reads():
+            self.assertEqual(tq.get_task(task['id'])['id'], task['id'])
+            self.assertEqual(len(list(tq.iter_tasks())), 1)
+        # writes read the primary
+        tq.delete_task_by_uuid(task['uuid'])
+
+        # falling behind
+        self.conn2.set(HEARTBEAT_KEY, self.server_now() - 7)
+        clock.get_clock().advance(5)
+        task = tq.add_task({'url': 'http://httpbin.org/get'}, countdown=100)
+        self.assertEqual(tq.get_task(task['id'])['id'], task['id'])
+        self.assertEqual([int(lag) for lag in self.backend.lags], [7])
+
+    def server_now(self):
+        seconds, microseconds = self.conn1.time()
+        return seconds + microseconds / 1e6
+
+    def test_unreachable(self):
+        self.backend.replicas = [redis.StrictRedis(port=1)]
+        self.assertEqual(self.backend.check_replicas(), [None])
+        self.assertEqual(self.tq.count_tasks(), 0)
+
+
+class ColdTierTestCase(TestCase):
+
+    def setUp(self):
+        self.conn0 = redis.StrictRedis()
+        self.conn0.delete('celery')
+        self.app = Celery(broker='redis://')
+        self.clock = clock.set_clock(clock.VirtualClock())
+        self.conn1 = redis.StrictRedis(db=1)
+        self.conn1.flushdb()
+        self.backend = RedisBackend(self.conn1, cold_horizon=3600)
+        self.tq = TaskQueue('test')
+        self.tq.bind_backend(self.backend)
+
+    def tearDown(self):
+        clock.set_clock(self.clock)
+        self.conn1.flushdb()
+        self.conn0.delete('celery')
+
+    def test_transparent(self):
+        tq = self.tq
+        hot = tq.add_task({'url': 'http://httpbin.org/get'}, countdown=60)
+        cold = tq.add_task({'url': 'http://httpbin.org/get'}, cname='cold',
+                           countdown=86400)
+        self.assertEqual(cold['status'], 'delayed')
+        self.assertFalse(self.conn1.exists(tq._TaskQueue__metakey(2)))
+        self.assertEqual(self.conn0.llen('celery'), 1)
+        self.assertEqual(tq.get_task(2), cold)
+        self.assertEqual(tq.get_task_by_uuid(cold['uuid']), cold)
+        self.assertEqual(tq.get_task_by_cname('cold'), cold)
+        self.assertEqual(tq.list_tasks(), [hot, cold])
+        self.assertEqual(tq.count_tasks(), 2)
+        self.assertEqual(tq.count_app_tasks(), 2)
+        self.assertRaises(TaskAlreadyExists, tq.add_task,
+                          {'url': 'http://httpbin.org/get'}, cname='cold',
+                          countdown=86400)
+        tq.delete_task_by_cname('cold')
+        self.assertRaises(TaskNotFound, tq.get_task, 2)
+        self.assertEqual(tq.count_app_tasks(), 1)
+        self.assertEqual(TaskQueue.promote_cold_tasks(self.backend), 0)
+        keys = set(key.decode('utf-8') for key in self.conn1.keys('AX:*'))
+        self.assertFalse('AX:COLD:{test:default}' in keys)
+        self.assertFalse('AX:DUE:{test:default}' in keys)
+
+    def test_promote(self):
+        tq = self.tq
+        tasks = [tq.add_task({'url': 'http://httpbin.org/get'},
+                             countdown=7200 + i) for i in range(3)]
+        self.assertEqual(self.conn0.llen('celery'), 0)
+        clock.get_clock().advance(3601)
+        self.assertEqual(TaskQueue.promote_cold_tasks(self.backend), 2)
+        self.assertEqual(TaskQueue.promote_cold_tasks(self.backend), 0)
+        self.assertTrue(self.conn1.exists(tq._TaskQueue__metakey(1)))
+        self.assertEqual(self.conn0.llen('celery'), 2)
+        task = tq.get_task(1)
+        self.assertEqual(task['countdown'], 3599.0)
+        task['countdown'] = tasks[0]['countdown']
+        self.assertEqual(task, tasks[0])
+        self.assertEqual([t['uuid'] for t in tq.list_tasks()],
+                         [t['uuid'] for t in tasks])
+        clock.get_clock().advance(2)
+        self.assertEqual(TaskQueue.promote_cold_tasks(self.backend), 1)
+        tq.delete_task(3)
+        self.assertEqual(tq.count_app_tasks(), 2)
+        self.assertEqual(self.conn1.zcard('AX:DUE:{test:default}'), 0)
+
+    def test_promote_unsent(self):
+        tq = self.tq
+        tasks = [tq.add_task({'url': 'http://httpbin.org/get'},
+                             countdown=7200) for i in range(2)]
+        clock.get_clock().advance(3601)
+        dispatch_task = TaskQueue._dispatch_task
+
+        def failing(tq, task, **kwargs):
+            if task.id == 2:
+                raise redis.RedisError('connection lost')
+            return dispatch_task(tq, task, **kwargs)
+
+        TaskQueue._dispatch_task = failing
+        try:
+            self.assertRaises(redis.RedisError, TaskQueue.promote_cold_tasks,
+                              self.backend)
+        finally:
+            TaskQueue._dispatch_task = dispatch_task
+        self.assertEqual(self.conn0.llen('celery'), 1)
+        # the second one is sent by the next promotion
+        self.assertEqual(TaskQueue.promote_cold_tasks(self.backend), 1)
+        self.assertEqual(TaskQueue.promote_cold_tasks(self.backend), 0)
+        self.assertEqual(self.conn0.llen('celery'), 2)
+        self.assertEqual(tq.get_task(2)['uuid'], tasks[1]['uuid'])
+        self.assertEqual(tq.get_task(2)['status'], 'delayed')
+
+
+class RedisKeysTestCase(TestCase):
+
+    def setUp(self):
+        self.conn1 = redis.StrictRedis(db=1)
+        self.conn1.flushdb()
+
+    def tearDown(self):
+        self.conn1.flushdb()
+
+    def test_hash_tags(self):
+        tq = TaskQueue('test', 'custom')
+        tq.bind_redis(self.conn1)
+        tq.add_task({'url': 'http://httpbin.org/get'}, cname='task1',
+                    schedule=schedules.schedule(60))
+        keys = set(key.decode('utf-8') for key in self.conn1.keys())
+        self.assertEqual(keys, set([
+            'AX:APPS', 'AX:QUEUES:{test}', 'AX:Q:{test:custom}',
+            'AX:META:{test:custom}:1', 'AX:CNAME:{test:custom}:task1',
+            'AX:SC:{test:custom}', 'AX:UUID:{test:custom}']))
+
+    def test_migrate_keys(self):
+        conn1 = self.conn1
+        conn1.hset('AX:INC', 'test:default', 3)
+        conn1.hset('AX:INC', 'test:other', 1)
+        conn1.hset('AX:BACKLOG', 'test', 3)
+        # tasks 2 and 3 of queue "default", task 1 of queue "other"
+        for name, idx in (('default', 2), ('default', 3), ('other', 1)):
+            _, fields = Task({'url': 'http://httpbin.org/get'}, id=idx,
+                             uuid='uuid{0}'.format(idx))._to_redis()
+            conn1.hmset('AX:META:test:{0}:{1}'.format(name, idx), fields)
+        conn1.zadd('AX:UUID:test:default', 2, 'uuid2')
+        conn1.zadd('AX:UUID:test:default', 3, 'uuid3')
+        conn1.set('AX:CNAME:test:default:task3', 3)
+        self.assertEqual(migrate_keys(conn1),
+                         [('test', 'default'), ('test', 'other')])
+        self.assertFalse(conn1.exists('AX:INC'))
+        self.assertFalse(conn1.exists('AX:BACKLOG'))
+        tq = TaskQueue('test')
+        tq.bind_redis(conn1)
+        self.assertEqual(tq.get_task_by_cname('task3')['id'], 3)
+        self.assertEqual(tq.get_task_by_uuid('uuid2')['id'], 2)
+        self.assertEqual(tq.count_tasks(), 2)
+        self.assertEqual(tq.count_app_tasks(), 3)
+        self.assertEqual(tq.add_task({'url': 'http://httpbin.org/get'})['id'],
+                         4)
+
+    def test_migrate_keys_sharded(self):
+        conn1, conn2 = self.conn1, redis.StrictRedis(db=2)
+        conn2.flushdb()
+        self.addCleanup(conn2.flushdb)
+        backend = ShardedRedisBackend([conn1, conn2])
+        names = ['q{0}'.format(i) for i in range(6)]
+        for name in names:
+            conn1.hset('AX:INC', 'test:' + name, 1)
+            _, fields = Task({'url': 'http://httpbin.org/get'}, id=1,
+                             uuid='uuid-' + name)._to_redis()
+            conn1.hmset('AX:META:test:{0}:1'.format(name), fields)
+            conn1.zadd('AX:UUID:test:' + name, 1, 'uuid-' + name)
+        self.assertEqual(len(migrate_keys(conn1, backend)), 6)
+        shards = set()
+        for name in names:
+            tq = TaskQueue('test', name)
+            tq.bind_backend(backend)
+            self.assertEqual(tq.get_task_by_uuid('uuid-' + name)['id'], 1)
+            self.assertEqual(tq.count_tasks(), 1)
+            shards.add(backend.shard(tq).redis.connection_pool
+                       .connection_kwargs['db'])
+        # spread over both servers
+        self.assertEqual(shards, set([1, 2]))
+        self.assertFalse(conn1.exists('AX:INC'))
+
+
+class MemoryBackendTestCase(BackendTests, TestCase):
+
+    def make_backend(self):
+        return MemoryBackend()
+
+    def test_dedupe_window(self):
+        tq = self.tq
+        tq.dedupe_window = 60
+        first = tq.add_task({'url': 'http://httpbin.org/get'},
+                            idempotency_key='once')
+        clock.get_clock().advance(59)
+        self.assertEqual(tq.add_task({'url': 'http://httpbin.org/get'},
+                                     idempotency_key='once'), first)
+        clock.get_clock().advance(1)
+        self.assertNotEqual(tq.add_task({'url': 'http://httpbin.org/get'},
+                                        idempotency_key='once')['id'],
+                            first['id'])
+        # the expired keys are purged by the next claims
+        tq.add_task({'url': 'http://httpbin.org/get'},
+                    idempotency_key='other')
+        clock.get_clock().advance(60)
+        tq.add_task({'url': 'http://httpbin.org/get'},
+                    idempotency_key='last')
+        self.assertEqual(list(self.backend._dedupes), [('test', 'default',
+                                                        'last')])
+
+    def test_concurrent_cname(self):
+        ids = []
+
+        def add():
+            ids.append(self.backend.add(self.tq, {'status': '"new"'},
+                                        cname='once'))
+
+        threads = [threading.Thread(target=add) for i in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sorted(ids, key=str), [1] + [None] * 9)
+        self.assertEqual(self.tq.count_app_tasks(), 1)
+
+
+class SqliteBackendTestCase(BackendTests, TestCase):
+
+    def make_backend(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        return SqliteBackend(os.path.join(directory, 'asynx.db'))
+
+    def test_durable(self):
+        tq = self.tq
+        tq.add_task({'url': 'http://httpbin.org/get'}, cname='task1',
+                    countdown=100)
+        reopened = TaskQueue('test')
+        reopened.bind_backend(SqliteBackend(self.backend.path))
+        self.assertEqual(reopened.get_task_by_cname('task1'),
+                         tq.get_task(1))
+
+    def test_batch(self):
+        tq = self.tq
+        with tq.batch():
+            for i in range(10):
+                tq.add_task({'url': 'http://httpbin.org/get'}, countdown=100)
+            # not sent before committed
+            self.assertEqual(self.conn0.llen('celery'), 0)
+        self.assertEqual(tq.count_tasks(), 10)
+        self.assertEqual(self.conn0.llen('celery'), 10)
+        uuid = tq.get_task(10)['uuid']
+        self.assertEqual(tq.get_task_by_uuid(uuid)['id'], 10)
+
+        def failed():
+            with tq.batch():
+                tq.add_task({'url': 'http://httpbin.org/get'})
+                raise ValueError
+        self.assertRaises(ValueError, failed)
+        self.assertEqual(tq.count_tasks(), 10)
+        self.assertEqual(self.conn0.llen('celery'), 10)
+
+    def test_recover(self):
+        tq = self.tq
+        tasks = [tq.add_task({'url': 'http://httpbin.org/get'},
+                             countdown=100) for i in range(2)]
+        tq.add_task({'url': 'http://httpbin.org/get'}, countdown=1000)
+        # the broker lost their messages
+        self.conn0.delete('celery')
+        self.assertEqual(TaskQueue.recover_tasks(self.backend, 60), 0)
+        clock.get_clock().advance(200)
+        self.assertEqual(TaskQueue.recover_tasks(self.backend, 60), 2)
+        self.assertEqual(self.conn0.llen('celery'), 2)
+        self.assertEqual(tq.get_task(1)['uuid'], tasks[0]['uuid'])
+        # claimed again once the grace is over, if still not run
+        self.assertEqual(TaskQueue.recover_tasks(self.backend, 60), 0)
+        tq._update_status(1, 'running', 'delayed')
+        clock.get_clock().advance(61)
+        self.assertEqual(TaskQueue.recover_tasks(self.backend, 60), 1)
+        self.assertEqual(TaskQueue.recover_tasks(RedisBackend(self.conn0)),
+                         0)
+
+    def test_recover_scheduled(self):
+        tq = self.tq
+        tq.add_task({'url': 'http://httpbin.org/get'}, cname='sched',
+                    schedule=schedules.schedule(600))
+        task = tq.get_task_by_cname('sched')
+        self.assertEqual(task['status'], 'scheduled')
+        # its message is lost, it was due in 600 seconds
+        self.conn0.delete('celery')
+        clock.get_clock().advance(600)
+        self.assertEqual(TaskQueue.recover_tasks(self.backend, 60), 0)
+        clock.get_clock().advance(61)
+        self.assertEqual(TaskQueue.recover_tasks(self.backend, 60), 1)
+        self.assertEqual(self.conn0.llen('celery'), 1)
+        # due again once its next message is sent
+        clock.get_clock().advance(61)
+        self.assertEqual(TaskQueue.recover_tasks(self.backend, 60), 0)
+
+    def test_dedupe_purge(self):
+        tq = self.tq
+        tq.dedupe_window = 60
+        for key in ('a', 'b'):
+            tq.add_task({'url': 'http://httpbin.org/get'},
+                        idempotency_key=key)
+        clock.get_clock().advance(60)
+        tq.add_task({'url': 'http://httpbin.org/get'}, idempotency_key='c')
+        rows = self.backend._conn().execute(
+            'SELECT key FROM ax_dedupes').fetchall()
+        self.assertEqual([row[0] for row in rows], ['c'])
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+
+from unittest import TestCase
+
+import redis
+from celery import Celery
+
+from asynx_core import clock
+from asynx_core.backends import RedisBackend
+from asynx_core.compression import (MARKER, compress_payload,
+                                    decompress_payload, is_compressed,
+                                    zstandard)
+from asynx_core.taskqueue import TaskQueue, Task
+from asynx_core._util import _loads
+
+
+class _Response(object):
+
+    url = 'http://httpbin.org/post'
+    status_code = 200
+    headers = {'Content-Type': 'application/json'}
+    content = b'{"items": [' + b', '.join([b'{"id": 1}'] * 500) + b']}'
+    history = []
+    reason = 'OK'
+
+
+class CompressionTestCase(TestCase):
+
+    def setUp(self):
+        self.conn1 = redis.StrictRedis(db=1)
+        self.conn1.flushdb()
+        self.app = Celery(broker='redis://')
+        self.clock = clock.set_clock(clock.VirtualClock())
+        self.tq = TaskQueue('test')
+        self.tq.compress_threshold = 1024
+        self.tq.bind_backend(RedisBackend(self.conn1))
+
+    def tearDown(self):
+        clock.set_clock(self.clock)
+        self.conn1.flushdb()
+        redis.StrictRedis().delete('celery')
+
+    def test_codecs(self):
+        payload = u'{"name": "caf\xe9"}' * 200
+        codecs = ['zlib'] if zstandard is None else ['zlib', 'zstd']
+        for codec in codecs:
+            compressed = compress_payload(payload, 1024, codec)
+            self.assertEqual(compressed[MARKER], codec)
+            self.assertEqual(decompress_payload(compressed), payload)
+        # zlib unless zstd is asked for
+        self.assertEqual(compress_payload(payload, 1024)[MARKER], 'zlib')
+        if zstandard is None:
+            self.assertRaises(RuntimeError, compress_payload, payload, 1024,
+                              'zstd')
+        # not compressed unless smaller
+        self.assertEqual(compress_payload('x', 0), 'x')
+        self.assertEqual(compress_payload(None, 0), None)
+
+    def test_transparent(self):
+        payload = '{"event": "paid", "lines": [' + \
+            ', '.join(['{"sku": "A-1", "qty": 1}'] * 100) + ']}'
+        request = {'method': 'POST', 'url': 'http://httpbin.org/post',
+                   'payload': payload}
+        task = self.tq.add_task(request, countdown=100)
+        self.assertEqual(task['request'], request)
+        stored = _loads(self.conn1.hget('AX:META:{test:default}:1',
+                                        'request'))
+        self.assertTrue(is_compressed(stored['payload']))
+        self.assertTrue(len(stored['payload']['data']) < len(payload) / 5)
+        self.assertEqual(self.tq.get_task(1), task)
+        self.assertEqual(_loads(self.tq.get_task_json(1))['request'],
+                         request)
+        # lazily, only when sent
+        self.assertTrue(is_compressed(
+            self.tq._get_task(1).request['payload']))
+        # small payloads are stored as they are
+        self.tq.add_task({'url': 'http://httpbin.org/post',
+                          'payload': '{}'}, countdown=100)
+        stored = _loads(self.conn1.hget('AX:META:{test:default}:2',
+                                        'request'))
+        self.assertEqual(stored['payload'], '{}')
+
+    def test_callback(self):
+        task = Task({'url': 'http://httpbin.org/get'}, uuid='uuid')
+        task.bind_taskqueue(self.tq)
+        task._dispatch_callback('http://httpbin.org/post', _Response())
+        stored = _loads(self.conn1.hget('AX:META:{test:default}:1',
+                                        'request'))
+        self.assertTrue(is_compressed(stored['payload']))
+        content = _loads(self.tq.get_task(1)['request']['payload'])
+        self.assertEqual(content['content'], _Response.content.decode())
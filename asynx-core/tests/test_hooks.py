@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import socket
+import tempfile
+from unittest import TestCase
+
+import redis
+from celery import Celery
+
+from asynx_core import hooks
+from asynx_core.taskqueue import TaskQueue, TaskAlreadyExists
+
+
+class Recorder(hooks.Hook):
+
+    def __init__(self):
+        self.events = []
+
+    def before(self, event):
+        self.events.append(('before', event.step, event.elapsed))
+
+    def after(self, event):
+        self.events.append(('after', event.step, event))
+
+
+class Broken(hooks.Hook):
+
+    def before(self, event):
+        raise ValueError('broken hook')
+
+
+class HooksTestCase(TestCase):
+
+    def setUp(self):
+        self.conn0 = redis.StrictRedis()
+        self.conn1 = redis.StrictRedis(db=1)
+        self.conn0.delete('celery')
+        self.conn1.flushdb()
+        self.app = Celery(broker='redis://')
+        self.tq = TaskQueue('test')
+        self.tq.bind_redis(self.conn1)
+
+    def tearDown(self):
+        hooks.clear()
+        self.conn0.delete('celery')
+        self.conn1.flushdb()
+
+    def test_hooked(self):
+        recorder = hooks.register(Recorder())
+        hooks.register(Broken())
+        task = self.tq.add_task({'url': 'http://httpbin.org/get'},
+                                cname='hooked')
+        self.assertEqual([(w, s) for w, s, _ in recorder.events], [
+            ('before', 'add_task'), ('before', 'dispatch_task'),
+            ('after', 'dispatch_task'), ('after', 'add_task')])
+        self.assertEqual(recorder.events[0][2], None)
+        event = recorder.events[2][2]
+        self.assertEqual(event.task.id, task['id'])
+        self.assertTrue(event.taskqueue is self.tq)
+        event = recorder.events[3][2]
+        self.assertEqual(event.task.id, task['id'])
+        self.assertEqual(event.result['cname'], '"hooked"')
+        self.assertTrue(event.elapsed >= 0)
+        del recorder.events[:]
+        self.assertRaises(TaskAlreadyExists, self.tq.add_task,
+                          {'url': 'http://httpbin.org/get'}, cname='hooked')
+        event = recorder.events[-1][2]
+        self.assertTrue(isinstance(event.exception, TaskAlreadyExists))
+        hooks.unregister(recorder)
+        del recorder.events[:]
+        self.tq.add_task({'url': 'http://httpbin.org/get'})
+        self.assertEqual(recorder.events, [])
+
+    def test_statsd_hook(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(('127.0.0.1', 0))
+        sock.settimeout(2)
+        hooks.register(hooks.StatsdHook(*sock.getsockname(),
+                                        steps=('add_task', )))
+        self.tq.add_task({'url': 'http://httpbin.org/get'})
+        packet = sock.recv(1024).decode('utf-8')
+        sock.close()
+        self.assertTrue(packet.startswith('asynx.test.default.add_task:'))
+        self.assertTrue(packet.endswith('|ms'))
+
+    def test_profile_hook(self):
+        directory = tempfile.mkdtemp()
+        try:
+            hooks.register(hooks.ProfileHook(2, directory, 'add_task'))
+            for i in range(5):
+                self.tq.add_task({'url': 'http://httpbin.org/get'})
+            profiles = sorted(os.listdir(directory))
+            self.assertEqual(len(profiles), 2)
+            self.assertTrue(profiles[0].startswith('test-default-'))
+        finally:
+            shutil.rmtree(directory)
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+
+import os
+from unittest import TestCase
+
+import redis
+from celery import Celery
+from celery.signals import worker_process_shutdown
+
+from asynx_core import clock
+from asynx_core.backends import RedisBackend
+from asynx_core.ids import SnowflakeIds, WorkerIdExhausted, LEASE_KEY
+from asynx_core.taskqueue import TaskQueue
+
+
+class SnowflakeIdsTestCase(TestCase):
+
+    def setUp(self):
+        self.conn1 = redis.StrictRedis(db=1)
+        self.conn1.flushdb()
+        self.app = Celery(broker='redis://')
+        self.clock = clock.set_clock(clock.VirtualClock(1420070400 + 86400))
+
+    def tearDown(self):
+        clock.set_clock(self.clock)
+        self.conn1.flushdb()
+        redis.StrictRedis().delete('celery')
+
+    def test_ordered(self):
+        ids = SnowflakeIds(worker_id=5)
+        allocated = []
+        for i in range(100):
+            # more than 32 ids in a millisecond borrow the next ones
+            allocated.append(ids.next_id())
+        clock.get_clock().advance(0.5)
+        allocated.append(ids.next_id())
+        self.assertEqual(allocated, sorted(set(allocated)))
+        self.assertTrue(allocated[-1] < 2 ** 53)
+        self.assertEqual(SnowflakeIds.timestamp_of(allocated[0]),
+                         1420070400 + 86400)
+        self.assertEqual(SnowflakeIds.timestamp_of(allocated[-1]),
+                         1420070400 + 86400.5)
+        self.assertEqual(set(map(SnowflakeIds.worker_of, allocated)),
+                         set([5]))
+
+    def test_lease(self):
+        ids1 = SnowflakeIds(self.conn1, ttl=30)
+        ids2 = SnowflakeIds(self.conn1, ttl=30)
+        ids1.next_id()
+        ids2.next_id()
+        self.assertNotEqual(ids1.worker_id, ids2.worker_id)
+        # renewed after ttl / 3
+        self.conn1.expire(LEASE_KEY.format(ids1.worker_id), 5)
+        clock.get_clock().advance(11)
+        ids1.next_id()
+        self.assertTrue(self.conn1.ttl(LEASE_KEY.format(ids1.worker_id)) > 5)
+        # a lost lease is replaced
+        worker_id = ids1.worker_id
+        self.conn1.set(LEASE_KEY.format(worker_id), 'taken')
+        clock.get_clock().advance(11)
+        ids1.next_id()
+        self.assertNotEqual(ids1.worker_id, worker_id)
+        ids1.release()
+        self.assertFalse(self.conn1.exists(LEASE_KEY.format(ids1.worker_id)))
+
+    def test_released_by_pool_process(self):
+        ids = SnowflakeIds(self.conn1)
+        pid = os.fork()
+        if pid == 0:
+            # a celery pool process, exiting without atexit
+            try:
+                ids.next_id()
+                worker_process_shutdown.send(sender=None, pid=os.getpid(),
+                                             exitcode=0)
+            finally:
+                os._exit(0)
+        os.waitpid(pid, 0)
+        self.assertEqual(self.conn1.keys('AX:WORKERID:*'), [])
+        # without the signal, the lease expires after the ttl
+        pid = os.fork()
+        if pid == 0:
+            try:
+                ids.next_id()
+            finally:
+                os._exit(0)
+        os.waitpid(pid, 0)
+        key, = self.conn1.keys('AX:WORKERID:*')
+        self.assertTrue(0 < self.conn1.ttl(key) <= 60)
+
+    def test_exhausted(self):
+        for worker_id in range(128):
+            self.conn1.set(LEASE_KEY.format(worker_id), 'taken')
+        self.assertRaises(WorkerIdExhausted,
+                          SnowflakeIds(self.conn1).next_id)
+
+    def test_taskqueue(self):
+        tq = TaskQueue('test')
+        tq.bind_backend(RedisBackend(self.conn1, SnowflakeIds(self.conn1)))
+        tasks = [tq.add_task({'url': 'http://httpbin.org/get'},
+                             countdown=100) for i in range(50)]
+        self.assertEqual(self.conn1.hget(*tq._TaskQueue__hincrkey()), None)
+        self.assertEqual([t['id'] for t in tq.list_tasks(limit=100)],
+                         sorted(t['id'] for t in tasks))
+        # exact as scores of the uuid index
+        for task in tasks[-3:]:
+            self.assertEqual(tq.get_task_by_uuid(task['uuid'])['id'],
+                             task['id'])
+        self.assertEqual(TaskQueue.count_all_tasks(self.conn1),
+                         [('test', 'default', 50)])
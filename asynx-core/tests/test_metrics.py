@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+
+from unittest import TestCase
+
+import redis
+from celery import Celery
+
+from asynx_core import metrics
+from asynx_core.metrics import Registry
+from asynx_core.taskqueue import TaskQueue
+
+
+class MetricsTestCase(TestCase):
+
+    def setUp(self):
+        self.conn0 = redis.StrictRedis()
+        self.conn1 = redis.StrictRedis(db=1)
+        self.conn0.delete('celery')
+        self.conn1.flushdb()
+        self.app = Celery(broker='redis://')
+
+    def tearDown(self):
+        metrics.registry._redis = None
+        self.conn0.delete('celery')
+        self.conn1.flushdb()
+
+    def test_registry(self):
+        registry = Registry(flush_interval=60)
+        registry.inc('asynx_redis_roundtrips_total', 2, (('op', 'a'), ))
+        self.assertFalse(registry._counters)
+        registry.bind_redis(self.conn1)
+        registry.inc('asynx_redis_roundtrips_total', 2, (('op', 'a'), ))
+        registry.inc('asynx_redis_roundtrips_total', 3, (('op', 'a'), ))
+        labels = (('app', 'test'), ('queue', 'default'),
+                  ('status', '2xx'))
+        for value in (0.003, 0.2, 0.2, 100):
+            registry.observe('asynx_dispatch_seconds', value, labels)
+        self.assertFalse(self.conn1.exists(registry.key))
+        registry.flush()
+        registry.inc('asynx_redis_roundtrips_total', 1, (('op', 'a'), ))
+        registry.flush()
+        lines = registry.render({'asynx_backlog_tasks': [
+            ((('app', 'test'), ('queue', 'default')), 7)]}).splitlines()
+        self.assertIn('# TYPE asynx_dispatch_seconds histogram', lines)
+        self.assertIn('asynx_redis_roundtrips_total{op="a"} 6', lines)
+        self.assertIn('asynx_backlog_tasks{app="test",queue="default"} 7',
+                      lines)
+        prefix = 'asynx_dispatch_seconds_bucket{app="test",' \
+                 'queue="default",status="2xx",'
+        buckets = [line for line in lines if line.startswith(prefix)]
+        # every configured bucket, empty ones included
+        self.assertEqual(len(buckets), len(metrics.LATENCY_BUCKETS) + 1)
+        self.assertEqual(buckets[0], prefix + 'le="0.001"} 0')
+        self.assertEqual(buckets[1], prefix + 'le="0.0025"} 0')
+        self.assertEqual(buckets[2], prefix + 'le="0.005"} 1')
+        self.assertEqual(buckets[3], prefix + 'le="0.01"} 1')
+        self.assertIn(prefix + 'le="0.25"} 3', buckets)
+        self.assertEqual(buckets[-2], prefix + 'le="60.0"} 3')
+        self.assertEqual(buckets[-1], prefix + 'le="+Inf"} 4')
+        self.assertIn('asynx_dispatch_seconds_count{app="test",'
+                      'queue="default",status="2xx"} 4', lines)
+        # _bucket, _sum then _count
+        self.assertEqual(lines.index(buckets[-1]) + 2, lines.index(
+            'asynx_dispatch_seconds_count{app="test",'
+            'queue="default",status="2xx"} 4'))
+
+    def test_measured(self):
+        conn1 = redis.StrictRedis(db=1)
+        registry = metrics.registry
+        registry.bind_redis(conn1)
+        tq = TaskQueue('test')
+        tq.bind_redis(conn1)
+        key = 'asynx_redis_roundtrips_total{op="add_task"}'
+        # opening connections, which costs extra round trips
+        tq.add_task({'url': 'http://httpbin.org/get'},
+                    cname='measured', countdown=100)
+        registry.flush()
+        before = float(registry.collect()[key])
+        tq.add_task({'url': 'http://httpbin.org/get'}, countdown=100)
+        registry.flush()
+        # hincrby, the inserting pipeline and the dispatching pipeline
+        self.assertEqual(float(registry.collect()[key]) - before, 3)
+        tq.get_task_by_cname_json('measured')
+        tq.delete_task_by_cname('measured')
+        registry.flush()
+        samples = registry.collect()
+        # the nested get_task_json is not counted again
+        self.assertEqual(
+            samples['asynx_operation_seconds_count{op="get_task"}'], '1')
+        self.assertEqual(
+            samples['asynx_redis_roundtrips_total{op="get_task"}'], '2')
+        self.assertIn('asynx_operation_seconds_bucket'
+                      '{op="delete_task",le="+Inf"}', samples)
+        self.assertEqual(TaskQueue.count_all_tasks(conn1),
+                         [('test', 'default', 1)])
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+
+from unittest import TestCase
+
+import redis
+from celery import schedules
+
+from asynx_core import clock
+from asynx_core.simulator import Simulator
+from asynx_core.taskqueue import Task
+
+
+class SimulatorTestCase(TestCase):
+
+    def setUp(self):
+        self.conn1 = redis.StrictRedis(db=1)
+        self.conn1.flushdb()
+
+    def tearDown(self):
+        self.conn1.flushdb()
+
+    def test_virtual_clock(self):
+        previous = clock.set_clock(clock.VirtualClock(1000000000))
+        try:
+            task = Task({'url': 'http://httpbin.org/get'}, countdown=30)
+            self.assertEqual(task.countdown, 30)
+            clock.get_clock().advance(10)
+            self.assertEqual(task.countdown, 20)
+        finally:
+            clock.set_clock(previous)
+        self.assertTrue(clock.get_clock() is previous)
+
+    def test_schedule_nowfun(self):
+        sched = schedules.schedule(30)
+        task = Task({'url': 'http://httpbin.org/get'}, schedule=sched)
+        self.assertTrue(task.schedule.nowfun is clock.utcnow)
+        # the caller's schedule is not changed
+        self.assertTrue(sched.nowfun is None)
+
+    def test_simulate(self):
+        # 2014-01-01 00:00:30 UTC
+        sim = Simulator(self.conn1, start=1388534430, latency=1)
+        sim.add_tasks(10, 'every 60 seconds')
+        sim.add_tasks(5, '*/10 * * * *')
+        sim.add_tasks(5, countdown=100)
+        report = sim.run(3600)
+        # a second late on every run, 59 interval runs fit in an hour
+        self.assertEqual(report['fires'], 10 * 59 + 5 * 6 + 5)
+        self.assertEqual(report['pending'], 15)
+        # interval runs are late by the latency of every previous run
+        self.assertEqual(report['drift']['max'], 59)
+        self.assertEqual(report['peak_fires_per_second'], 10)
+        self.assertTrue(report['roundtrips_per_fire'] > 0)
+        self.assertEqual(sim.taskqueue.count_tasks(), 15)
+        self.assertEqual(sim.clock.time(), 1388534430 + 3600)
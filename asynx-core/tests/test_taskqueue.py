@@ -1,7 +1,13 @@
 # -*- coding: utf-8 -*-
 
+import time
+import threading
 from unittest import TestCase
 from datetime import datetime, timedelta
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
 
 import redis
 import anyjson
@@ -13,6 +19,12 @@ from asynx_core.taskqueue import (TaskQueue, Task,
                                   TaskAlreadyExists,
                                   TaskCNameRequired)
 from asynx_core._util import user_agent, not_bytes, utcnow
+from asynx_core.metrics import Timeline
+
+
+class TimelineTaskQueue(TaskQueue):
+    slow_timelines = 2
+    recent_timelines = 3
 
 
 class TaskQueueTestCase(TestCase):
@@ -163,6 +175,39 @@ class TaskQueueTestCase(TestCase):
         self.assertEqual(task['cname'], None)
         self.assertRaises(TaskNotFound, tq.get_task, 6)
 
+    def test_get_task_json(self):
+        tq = TaskQueue('test')
+        tq.bind_redis(self.conn1)
+        task = anyjson.loads(tq.add_task_json(
+            {'method': 'GET', 'url': 'http://httpbin.org'},
+            cname='jsontask', countdown=42))
+        countdown = task.pop('countdown')
+        self.assertTrue(41 < countdown <= 42)
+        for task_json in (tq.get_task_json(1),
+                          tq.get_task_by_uuid_json(task['uuid']),
+                          tq.get_task_by_cname_json('jsontask')):
+            task_get = anyjson.loads(task_json)
+            self.assertTrue(41 < task_get.pop('countdown') <= countdown)
+            self.assertEqual(task_get, task)
+        task_dict = tq.get_task(1)
+        self.assertEqual(task['eta'], task_dict['eta'].isoformat())
+        self.assertEqual(task['request'], task_dict['request'])
+        self.assertRaises(TaskNotFound, tq.get_task_json, 2)
+        self.assertRaises(TaskNotFound, tq.get_task_by_uuid_json, 'notuuid')
+        self.assertRaises(TaskNotFound, tq.get_task_by_cname_json, 'notexist')
+
+    def test_list_tasks_json(self):
+        tq = self.test_iter_tasks()
+        tasks = tq.list_tasks_json(17, 83)
+        self.assertEqual(len(tasks), 83)
+        for i, task in zip(range(17, 100), tasks):
+            task = anyjson.loads(task)
+            self.assertEqual(task['cname'], 'task{0}'.format(i))
+            if i % 2:
+                self.assertTrue(0 < task['countdown'] <= 1)
+            else:
+                self.assertEqual(task['countdown'], None)
+
     def test_get_task_by_uuid(self):
         tq = TaskQueue('test')
         tq.bind_redis(self.conn1)
@@ -201,6 +246,25 @@ class TaskQueueTestCase(TestCase):
         self.assertFalse(conn1.exists(tq._TaskQueue__uuidkey()))
         self.assertEqual(conn1.hget(*tq._TaskQueue__hincrkey()), b'1')
 
+    def test_count_app_tasks(self):
+        conn1 = self.conn1
+        tq1 = TaskQueue('test')
+        tq1.bind_redis(conn1)
+        tq2 = TaskQueue('test', 'another')
+        tq2.bind_redis(conn1)
+        self.assertEqual(tq1.count_app_tasks(), 0)
+        tq1.add_task({'url': 'http://httpbin.org'})
+        tq1.add_task({'url': 'http://httpbin.org'})
+        tq2.add_task({'url': 'http://httpbin.org'})
+        self.assertEqual(tq1.count_app_tasks(), 3)
+        self.assertEqual(tq2.count_app_tasks(), 3)
+        tq1.delete_task(1)
+        self.assertRaises(TaskNotFound, tq1.delete_task, 1)
+        self.assertEqual(tq2.count_app_tasks(), 2)
+        # counted per queue
+        self.assertEqual(conn1.hget(*tq1._TaskQueue__backlogkey()), b'1')
+        self.assertEqual(conn1.hget(*tq2._TaskQueue__backlogkey()), b'1')
+
     def test_delete_task_by_uuid(self):
         conn1 = self.conn1
         tq = TaskQueue('test')
@@ -289,3 +353,50 @@ class TaskQueueTestCase(TestCase):
         self.assertEqual(pr['headers']['User-Agent'], user_agent())
         self.assertEqual(pr['data'], '{"a":"b"}')
         self.assertTrue('X-Asynx-Tasketa' in pr['headers'])
+
+    def test_timelines(self):
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                self.send_response(200)
+                self.send_header('Content-Length', '2')
+                self.end_headers()
+                self.wfile.write(b'ok')
+
+            def log_message(self, *args):
+                pass
+
+        server = HTTPServer(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        url = 'http://127.0.0.1:{0}/'.format(server.server_port)
+        conn1 = self.conn1
+        tq = TimelineTaskQueue('test')
+        tq.bind_redis(conn1)
+        try:
+            for i in range(4):
+                tq.add_task({'method': 'GET', 'url': url}, countdown=100)
+                task = tq._get_task(i + 1)
+                now = time.time()
+                task.dispatch(Timeline(enqueued=now - 10, due=now - i,
+                                       picked_up=now))
+                self.assertFalse(conn1.exists(tq._TaskQueue__metakey(i + 1)))
+        finally:
+            server.shutdown()
+            server.server_close()
+        timelines = tq.get_timelines()
+        self.assertEqual(timelines['samples'], 3)
+        slowest = timelines['slowest']
+        self.assertEqual([t['id'] for t in slowest], [4, 3])
+        self.assertEqual(slowest[0]['status_code'], 200)
+        self.assertEqual(slowest[0]['url'], url)
+        self.assertEqual(sorted(slowest[0]['marks']), [
+            'body_done', 'callbacks', 'deleted', 'due', 'enqueued',
+            'first_byte', 'picked_up', 'request_start', 'status_cas'])
+        self.assertTrue(slowest[0]['total'] >= 3)
+        self.assertEqual(sorted(timelines['percentiles']), [
+            'body', 'callbacks', 'fetch', 'finish', 'first_byte',
+            'prepare', 'queue', 'total'])
+        self.assertEqual(timelines['percentiles']['queue']['p99'], 3)
@@ -1,7 +1,8 @@
 from os import path
 from .taskqueue import TaskQueueClient
+from .buffered import BufferedTaskQueueClient
 
-__all__ = ['TaskQueueClient']
+__all__ = ['TaskQueueClient', 'BufferedTaskQueueClient']
 
 with open(path.join(path.dirname(__file__), 'version.txt')) as fp:
     __version__ = fp.read().strip()
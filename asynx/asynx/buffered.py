@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+
+import time
+import threading
+from collections import deque
+
+from .taskqueue import TaskQueueClient
+
+
+class TaskQueueTimeout(Exception):
+    pass
+
+
+class TaskQueueBufferFull(Exception):
+    pass
+
+
+class TaskFuture(object):
+    """the pending result of a task added by BufferedTaskQueueClient"""
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def done(self):
+        return self._event.is_set()
+
+    def _wait(self, timeout):
+        self._event.wait(timeout)
+        if not self._event.is_set():
+            raise TaskQueueTimeout('task is still pending after '
+                                   '{0} seconds'.format(timeout))
+
+    def result(self, timeout=None):
+        """waiting for and returning the task dict from asynxd
+
+        Raises the error of the insertion if it failed, or
+        TaskQueueTimeout if the task is still pending after `timeout`
+
+        """
+        self._wait(timeout)
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self, timeout=None):
+        self._wait(timeout)
+        return self._exception
+
+    def add_done_callback(self, fn):
+        """calling `fn(future)` once the task is sent or failed"""
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def _resolve(self, result=None, exception=None):
+        with self._lock:
+            self._result = result
+            self._exception = exception
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            fn(self)
+
+
+class BufferedTaskQueueClient(TaskQueueClient):
+
+    TimeoutError = TaskQueueTimeout
+    BufferFull = TaskQueueBufferFull
+
+    def __init__(self, base_url, appname,
+                 timeout=5.0, task_timeout=120.0,
+                 max_retries=3, max_retry_after=60.0,
+                 batch_size=100, linger=0.05,
+                 max_buffered=10000, max_block=60.0,
+                 compress_threshold=None):
+        """taskqueue client for asynxd which sends tasks in batches
+
+        Tasks passed to `add_task` are buffered in memory per taskqueue
+        and sent by a background thread through the bulk API, once a
+        taskqueue buffered `batch_size` tasks or its oldest task waited
+        for `linger` seconds, whichever comes first.
+
+        Parameters:
+            - base_url: string, base URL of asynxd's RESTful API
+            - appname:  string, application's name
+            - timeout:  float, timeout for requestions to asynxd
+            - task_timeout: float, timeout for task running
+            - max_retries: integer, times to retry a batch refused
+                        by asynxd's admission control (status 429)
+            - max_retry_after: float, maximum seconds to wait before
+                        a retry
+            - batch_size: integer, maximum tasks per bulk request,
+                          maximum 500
+            - linger:   float, maximum seconds a task waits in the
+                        buffer before being sent
+            - max_buffered: integer, maximum tasks buffered or in flight,
+                        `add_task` blocks when the buffer is full
+            - max_block: float, maximum seconds `add_task` blocks on
+                        a full buffer before raising TaskQueueBufferFull
+            - compress_threshold: integer, bulk requests of at least
+                        this many bytes are sent gzip-encoded, None never
+
+        Usage:
+            >>> tqc = BufferedTaskQueueClient('http://localhost:17969',
+            ...                               'test')
+            >>> future = tqc.add_task(url='http://httpbin.org/get')
+            >>> task = future.result()
+            >>> tqc.close()
+
+        """
+        super(BufferedTaskQueueClient, self).__init__(
+            base_url, appname, timeout, task_timeout,
+            max_retries, max_retry_after, compress_threshold)
+        self.batch_size = batch_size
+        self.linger = linger
+        self.max_buffered = max_buffered
+        self.max_block = max_block
+        self._cond = threading.Condition()
+        self._buffers = {}
+        self._incomplete = set()
+        self._flushing = 0
+        self._closed = False
+        self._sender = threading.Thread(target=self._run,
+                                        name='asynx-sender')
+        self._sender.daemon = True
+        self._sender.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def add_task(self, task=None, taskqueue='default', **kwargs):
+        """Buffers a task to be inserted into a taskqueue
+
+        Parameters:
+            same as TaskQueueClient.add_task
+
+        Returns:
+            a TaskFuture resolving to the dictionary of task
+
+        """
+        task = self._prepare_task(task, kwargs)
+        future = TaskFuture()
+        with self._cond:
+            if self._closed:
+                raise RuntimeError('client is closed')
+            deadline = time.time() + self.max_block
+            while len(self._incomplete) >= self.max_buffered:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise self.BufferFull(
+                        'buffer is still full after {0} seconds'
+                        .format(self.max_block))
+                self._cond.wait(remaining)
+            buf = self._buffers.setdefault(taskqueue, deque())
+            buf.append((task, future, time.time()))
+            self._incomplete.add(future)
+            if len(buf) == 1 or len(buf) >= self.batch_size:
+                self._cond.notify_all()
+        return future
+
+    def flush(self, timeout=None):
+        """Sends all buffered tasks and waits for their results
+
+        Parameters:
+            - timeout: float, maximum seconds to wait, default forever
+
+        """
+        with self._cond:
+            futures = list(self._incomplete)
+            self._flushing += 1
+            self._cond.notify_all()
+        try:
+            deadline = timeout is not None and time.time() + timeout
+            for future in futures:
+                if deadline:
+                    future._wait(max(deadline - time.time(), 0))
+                else:
+                    future._wait(None)
+        finally:
+            with self._cond:
+                self._flushing -= 1
+
+    def close(self, timeout=None):
+        """Sends all buffered tasks and stops the background thread"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._sender.join(timeout)
+
+    def _ready_batches(self, now):
+        """popping batches to be sent, and the seconds until the next
+        batch lingered enough (None if nothing is buffered)"""
+        batches = []
+        wait = None
+        force = self._flushing or self._closed
+        for taskqueue, buf in self._buffers.items():
+            while buf:
+                lingered = now - buf[0][2]
+                if not force and len(buf) < self.batch_size and \
+                        lingered < self.linger:
+                    remaining = self.linger - lingered
+                    if wait is None or remaining < wait:
+                        wait = remaining
+                    break
+                count = min(len(buf), self.batch_size)
+                batches.append(
+                    (taskqueue, [buf.popleft() for _ in range(count)]))
+        return batches, wait
+
+    def _run(self):
+        while True:
+            with self._cond:
+                batches, wait = self._ready_batches(time.time())
+                while not batches:
+                    if self._closed and not self._incomplete:
+                        return
+                    self._cond.wait(wait)
+                    batches, wait = self._ready_batches(time.time())
+            for taskqueue, records in batches:
+                self._send(taskqueue, records)
+
+    def _send(self, taskqueue, records):
+        try:
+            results = self.add_tasks([task for task, _, _ in records],
+                                     taskqueue)
+        except Exception as e:
+            results = [e] * len(records)
+        for (_, future, _), result in zip(records, results):
+            if isinstance(result, Exception):
+                future._resolve(exception=result)
+            else:
+                future._resolve(result=result)
+        with self._cond:
+            self._incomplete.difference_update(
+                [future for _, future, _ in records])
+            self._cond.notify_all()
@@ -1,5 +1,8 @@
 # -*- coding: utf-8 -*-
 
+import gzip
+import time
+from io import BytesIO
 from datetime import datetime
 try:
     from urlparse import urlparse, urlunparse
@@ -37,7 +40,9 @@ class TaskQueueClient(object):
     ServerError = TaskQueueServerError
 
     def __init__(self, base_url, appname,
-                 timeout=5.0, task_timeout=120.0):
+                 timeout=5.0, task_timeout=120.0,
+                 max_retries=3, max_retry_after=60.0,
+                 compress_threshold=None):
         """taskqueue client for asynxd
 
         Parameters:
@@ -45,12 +50,22 @@ class TaskQueueClient(object):
             - appname:  string, application's name
             - timeout:  float, timeout for requestions to asynxd
             - task_timeout: float, timeout for task running
+            - max_retries: integer, times to retry an insertion refused
+                        by asynxd's admission control (status 429)
+            - max_retry_after: float, maximum seconds to wait before
+                        a retry, insertions requiring longer waiting
+                        are not retried
+            - compress_threshold: integer, insertion bodies of at least
+                        this many bytes are sent gzip-encoded, None never
 
         """
         self._base_url = urlparse(base_url)
         self.appname = appname
         self.timeout = timeout
         self.task_timeout = task_timeout
+        self.max_retries = max_retries
+        self.max_retry_after = max_retry_after
+        self.compress_threshold = compress_threshold
 
     @classmethod
     def _handle_errors(cls, resp):
@@ -67,12 +82,63 @@ class TaskQueueClient(object):
             raise cls.ServerError(
                 'Response content is not in JSON format')
 
+    def _post(self, url, data):
+        """POSTing to asynxd, retrying after the seconds of
+        `Retry-After` if the request is refused with status 429"""
+        headers = {'Content-Type': 'application/json'}
+        if self.compress_threshold is not None and \
+                len(data) >= self.compress_threshold:
+            if not isinstance(data, bytes):
+                data = data.encode('utf-8')
+            body = BytesIO()
+            # GzipFile is not a context manager on python 2.6
+            fp = gzip.GzipFile(fileobj=body, mode='wb')
+            try:
+                fp.write(data)
+            finally:
+                fp.close()
+            data = body.getvalue()
+            headers['Content-Encoding'] = 'gzip'
+        retries = 0
+        while True:
+            resp = requests.post(url, data=data, headers=headers,
+                                 timeout=self.timeout)
+            if resp.status_code != 429 or retries >= self.max_retries:
+                return resp
+            try:
+                retry_after = float(resp.headers['Retry-After'])
+            except (KeyError, ValueError):
+                return resp
+            if retry_after > self.max_retry_after:
+                return resp
+            retries += 1
+            time.sleep(retry_after)
+
+    @staticmethod
+    def _read_headers(primary):
+        return {'X-Asynx-Consistency': 'primary'} if primary else {}
+
     def _rest_url(self, taskqueue, suffix=''):
         path = 'apps/{0}/taskqueues/{1}/tasks'.format(self.appname, taskqueue)
         path += suffix
         return urlunparse(self._base_url[:2] + (path, '', '', ''))
 
-    def list_tasks(self, taskqueue='default', offset=0, limit=50):
+    def _templates_url(self, taskqueue, name=None):
+        path = 'apps/{0}/taskqueues/{1}/templates'.format(self.appname,
+                                                          taskqueue)
+        if name is not None:
+            path += '/' + name
+        return urlunparse(self._base_url[:2] + (path, '', '', ''))
+
+    def _groups_url(self, taskqueue, group=None):
+        path = 'apps/{0}/taskqueues/{1}/groups'.format(self.appname,
+                                                       taskqueue)
+        if group is not None:
+            path += '/' + group
+        return urlunparse(self._base_url[:2] + (path, '', '', ''))
+
+    def list_tasks(self, taskqueue='default', offset=0, limit=50,
+                   primary=False):
         """Listing all non deleted tasks in a taskqueue
 
         GET http://asynx.host/apps/:appname/taskqueues/:taskqueue/tasks
@@ -83,6 +149,9 @@ class TaskQueueClient(object):
                          the list start, default 0
             - limit:     integer, the count of tasks to be listed,
                          default 50, maximum 200
+            - primary:   boolean, reading from the primary redis of
+                         asynxd instead of a replica, for seeing the
+                         tasks just inserted
 
         Returns:
             same as RESTful API
@@ -94,6 +163,7 @@ class TaskQueueClient(object):
         url = self._rest_url(taskqueue)
         resp = requests.get(url, params={'offset': offset,
                                          'limit': limit},
+                            headers=self._read_headers(primary),
                             timeout=self.timeout)
         self._handle_errors(resp)
         result = resp.json()
@@ -118,7 +188,9 @@ class TaskQueueClient(object):
              schedule=None,
              on_success=None,
              on_failure='__report__',
-             on_complete=None):
+             on_complete=None,
+             coalesce=False,
+             idempotency_key=None):
         """Create a dictionary with task structure
 
         With this method, you can create sub-task for `on_sccess`,
@@ -159,6 +231,14 @@ class TaskQueueClient(object):
                        but be called when failed, default `__report__`
             - on_complete: (optional) same as `on_success`,
                        but be called always. default `None`
+            - coalesce: (optional) boolean, for endpoints accepting
+                       batches, the task is sent with the other due
+                       coalesced tasks to the same endpoint in one
+                       request with a JSON array of their payloads
+            - idempotency_key: (optional) string, retrying the insertion
+                       with the same key returns the task inserted first
+                       instead of adding another one, within the dedupe
+                       window of asynxd
 
         Returns:
             dictionary with task structure
@@ -198,23 +278,88 @@ class TaskQueueClient(object):
             task['eta'] = eta
         if schedule is not None:
             task['schedule'] = schedule
+        if coalesce:
+            task['coalesce'] = True
+        if idempotency_key is not None:
+            task['idempotency_key'] = idempotency_key
         return task
 
-    def add_task(self, task=None, taskqueue='default', **kwargs):
-        """Inserts a task into a taskqueue
+    def template_task(self,
+                      template,
+                      url=None,
+                      method=None,
+                      headers=None,
+                      payload=None,
+                      timeout=None,
+                      cname=None,
+                      countdown=None,
+                      eta=None,
+                      schedule=None,
+                      **callbacks):
+        """Create a dictionary of a task referencing a request template
+
+        Only the given request arguments are sent, they override the
+        template's when the task runs, headers are merged.
 
-        POST http://asynx.host/apps/:appname/taskqueues/:taskqueue/tasks
+        Parameter:
+            - template: string, name of a template set by set_template()
+            - url, method, headers, timeout: (optional) overriding the
+                       template's
+            - payload: (optional) string, body of the request
+            - cname, countdown, eta, schedule: (optional) same as task()
+            - on_success, on_failure, on_complete: (optional) same as
+                       task(), the template's apply if not given
 
-        Parameters:
-            - task:      (optional) dictionary created by self.task()
-            - taskqueue: string, taskqueue's name, default 'default'
-            - kwargs:    (optional) parameters passed to self.task(),
-                         if `task` is None
+        Returns:
+            dictionary with task structure
+
+        """
+        request = {}
+        for key, val in (('url', url), ('method', method),
+                         ('headers', headers), ('payload', payload),
+                         ('timeout', timeout)):
+            if val is not None:
+                request[key] = val
+        task = {'template': template, 'request': request}
+        task.update(callbacks)
+        if cname:
+            task['cname'] = cname
+        if countdown is not None:
+            task['countdown'] = countdown
+        elif eta is not None:
+            if isinstance(eta, datetime):
+                eta = eta.isoformat()
+            task['eta'] = eta
+        if schedule is not None:
+            task['schedule'] = schedule
+        return task
+
+    def fanout_task(self, targets, **kwargs):
+        """Create a dictionary of a task sending one request to many URLs
+
+        The request is stored once with the targets, asynxd sends it to
+        them by chunks. The callbacks are called once every target is
+        sent, with the count of the succeeded and failed ones and the
+        result of each of them.
+
+        Parameter:
+            - targets: list of URLs, each one is requested once
+            - kwargs:  (optional) parameters passed to self.task(), but
+                       `url` and `schedule`
 
         Returns:
-            dictionary of task, same as RESTful API
+            dictionary with task structure
 
         """
+        targets = list(targets)
+        if not targets:
+            raise ValueError('a fan-out task must have targets')
+        task = self.task(targets[0], **kwargs)
+        del task['request']['url']
+        task['targets'] = targets
+        return task
+
+    def _prepare_task(self, task, kwargs):
         if task:
             if 'on_success' in kwargs:
                 task['on_success'] = kwargs['on_success']
@@ -222,18 +367,113 @@ class TaskQueueClient(object):
                 task['on_failure'] = kwargs['on_failure']
             if 'on_complete' in kwargs:
                 task['on_complete'] = kwargs['on_complete']
+        elif 'template' in kwargs:
+            task = self.template_task(**kwargs)
+        elif 'targets' in kwargs:
+            task = self.fanout_task(**kwargs)
         else:
             task = self.task(**kwargs)
-        task = anyjson.dumps(task)
+        return task
+
+    def add_task(self, task=None, taskqueue='default', **kwargs):
+        """Inserts a task into a taskqueue
+
+        POST http://asynx.host/apps/:appname/taskqueues/:taskqueue/tasks
+
+        Parameters:
+            - task:      (optional) dictionary created by self.task()
+            - taskqueue: string, taskqueue's name, default 'default'
+            - kwargs:    (optional) parameters passed to self.task(),
+                         if `task` is None, or to self.template_task()
+                         if they include `template`, or to
+                         self.fanout_task() if they include `targets`
+
+        Returns:
+            dictionary of task, same as RESTful API
+
+        """
+        task = anyjson.dumps(self._prepare_task(task, kwargs))
         url = self._rest_url(taskqueue)
-        resp = requests.post(url, data=task,
-                             headers={'Content-Type': 'application/json'},
-                             timeout=self.timeout)
+        resp = self._post(url, task)
         self._handle_errors(resp)
         return _task_convert(resp.json())
 
+    def add_tasks(self, tasks, taskqueue='default'):
+        """Inserts a batch of tasks into a taskqueue with one request
+
+        POST http://asynx.host/apps/:appname/taskqueues/:taskqueue/tasks/bulk
+
+        Parameters:
+            - tasks:     list of dictionaries created by self.task(),
+                         maximum 500
+            - taskqueue: string, taskqueue's name, default 'default'
+
+        Returns:
+            list in the same order as `tasks`, each item is either
+            a dictionary of the inserted task, or an instance of
+            `TaskQueueResponseError` if that task was rejected
+
+        """
+        data = anyjson.dumps({'tasks': tasks})
+        url = self._rest_url(taskqueue, '/bulk')
+        resp = self._post(url, data)
+        self._handle_errors(resp)
+        results = []
+        for item in resp.json()['items']:
+            if 'error_code' in item:
+                results.append(self.ResponseError(
+                    item['error_code'], item['error_desc'],
+                    item['error_detail'], url))
+            else:
+                results.append(_task_convert(item))
+        return results
+
+    def add_group(self, tasks, taskqueue='default', **callbacks):
+        """Inserts a group of tasks whose callbacks are called once all
+        of them are done
+
+        POST http://asynx.host/apps/:appname/taskqueues/:taskqueue/groups
+
+        Parameters:
+            - tasks:     list of dictionaries created by self.task(),
+                         maximum 500, they can not be scheduled
+            - taskqueue: string, taskqueue's name, default 'default'
+            - callbacks: (optional) on_success, on_failure and
+                         on_complete of the group, same as self.task()'s
+
+        Returns:
+            dictionary of the group id as "group" and the inserted
+            tasks as "tasks", same as RESTful API
+
+        """
+        group = dict(callbacks, tasks=tasks)
+        resp = self._post(self._groups_url(taskqueue), anyjson.dumps(group))
+        self._handle_errors(resp)
+        result = resp.json()
+        for task in result['tasks']:
+            _task_convert(task)
+        return result
+
+    def get_group(self, group, taskqueue='default', primary=False):
+        """Gets the progress of a group of tasks, not found once its
+        callbacks are called
+
+        GET http://asynx.host/apps/:appname/taskqueues/:taskqueue/ \
+            groups/:group
+
+        Returns:
+            dictionary of the group's total, left and results, same as
+            RESTful API
+
+        """
+        resp = requests.get(self._groups_url(taskqueue, group),
+                            headers=self._read_headers(primary),
+                            timeout=self.timeout)
+        self._handle_errors(resp)
+        return resp.json()
+
     def get_task(self, id=None, cname=None,
-                 uuid=None, taskqueue='default'):
+                 uuid=None, taskqueue='default', primary=False):
         """Gets identified task in a taskqueue
 
         GET http://asynx.host/apps/:appname/ \
@@ -244,6 +484,9 @@ class TaskQueueClient(object):
             - cname: (optional) string, task custom name
             - uuid: (optional) string, task uuid
             - taskqueue: string, taskqueue's name, default 'default'
+            - primary: boolean, reading from the primary redis of asynxd
+                       instead of a replica, for reading a task just
+                       inserted or updated
 
         Returns:
             dictionary of task, same as RESTful API
@@ -259,7 +502,7 @@ class TaskQueueClient(object):
         else:
             idf = '/uuid:{0}'.format(uuid)
         url = self._rest_url(taskqueue, idf)
-        resp = requests.get(url)
+        resp = requests.get(url, headers=self._read_headers(primary))
         self._handle_errors(resp)
         return _task_convert(resp.json())
 
@@ -291,3 +534,76 @@ class TaskQueueClient(object):
         url = self._rest_url(taskqueue, idf)
         resp = requests.delete(url)
         self._handle_errors(resp)
+
+    def set_template(self, name, template=None, taskqueue='default',
+                     **kwargs):
+        """Creates or updates a request template of a taskqueue
+
+        PUT http://asynx.host/apps/:appname/taskqueues/:taskqueue/ \
+            templates/:name
+
+        Parameters:
+            - name:      string, template's name
+            - template:  (optional) dictionary created by self.task(),
+                         only its request and callbacks are kept
+            - taskqueue: string, taskqueue's name, default 'default'
+            - kwargs:    (optional) parameters passed to self.task(),
+                         if `template` is None
+
+        Returns:
+            dictionary of template, same as RESTful API
+
+        """
+        task = self._prepare_task(template, kwargs)
+        template = {'request': task['request']}
+        for key in ('on_success', 'on_failure', 'on_complete'):
+            if task.get(key) is not None:
+                template[key] = task[key]
+        url = self._templates_url(taskqueue, name)
+        resp = requests.put(url, data=anyjson.dumps(template),
+                            headers={'Content-Type': 'application/json'},
+                            timeout=self.timeout)
+        self._handle_errors(resp)
+        return resp.json()
+
+    def get_template(self, name, taskqueue='default'):
+        """Gets a request template of a taskqueue
+
+        GET http://asynx.host/apps/:appname/taskqueues/:taskqueue/ \
+            templates/:name
+
+        Returns:
+            dictionary of template, same as RESTful API
+
+        """
+        resp = requests.get(self._templates_url(taskqueue, name),
+                            timeout=self.timeout)
+        self._handle_errors(resp)
+        return resp.json()
+
+    def list_templates(self, taskqueue='default'):
+        """Lists the request templates of a taskqueue
+
+        GET http://asynx.host/apps/:appname/taskqueues/:taskqueue/templates
+
+        Returns:
+            list of templates, ordered by name
+
+        """
+        resp = requests.get(self._templates_url(taskqueue),
+                            timeout=self.timeout)
+        self._handle_errors(resp)
+        return resp.json()['items']
+
+    def delete_template(self, name, taskqueue='default'):
+        """Deletes a request template of a taskqueue
+
+        DELETE http://asynx.host/apps/:appname/taskqueues/:taskqueue/ \
+               templates/:name
+
+        Returns: None
+
+        """
+        resp = requests.delete(self._templates_url(taskqueue, name),
+                               timeout=self.timeout)
+        self._handle_errors(resp)
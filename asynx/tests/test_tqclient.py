@@ -1,10 +1,16 @@
 # -*- coding: utf-8 -*-
 
+import time
+import threading
 from unittest import TestCase
 from datetime import datetime, timedelta
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
 
 from pytz import utc
-from asynx import TaskQueueClient
+from asynx import TaskQueueClient, BufferedTaskQueueClient
 
 
 class TQClientTestCase(TestCase):
@@ -57,3 +63,148 @@ class TQClientTestCase(TestCase):
         task = tqc.add_task(url='http://httpbin.org/get')
         self.assertEqual(tqc.delete_task(task['id']), None)
         self.assertRaises(tqc.ResponseError, tqc.get_task, task['id'])
+
+    def test_add_tasks(self):
+        tqc = TaskQueueClient('http://localhost:17969', 'test')
+        tasks = [tqc.task(url='http://httpbin.org/get'),
+                 tqc.task(url='http://httpbin.org/get',
+                          schedule='*/10 * * * *'),
+                 tqc.task(url='http://httpbin.org/post',
+                          method='POST', countdown=200)]
+        results = tqc.add_tasks(tasks)
+        self.assertEqual(results[0]['status'], 'new')
+        self.assertTrue(isinstance(results[1], tqc.ResponseError))
+        self.assertEqual(results[2]['status'], 'delayed')
+        self.assertEqual(results[2]['id'], results[0]['id'] + 1)
+
+    def test_buffered_client(self):
+        tqc = BufferedTaskQueueClient('http://localhost:17969', 'test',
+                                      batch_size=10, linger=0.2,
+                                      max_buffered=15, max_block=0.01)
+        futures = [tqc.add_task(url='http://httpbin.org/get')
+                   for i in range(15)]
+        # the buffer is full until the first batch is answered
+        self.assertRaises(tqc.BufferFull, tqc.add_task,
+                          url='http://httpbin.org/get')
+        futures[9].result(5)
+        bad = tqc.add_task(url='http://httpbin.org/get',
+                           schedule='*/10 * * * *',
+                           taskqueue='buffered')
+        tqc.flush()
+        ids = [f.result()['id'] for f in futures]
+        self.assertEqual(ids, list(range(ids[0], ids[0] + 15)))
+        self.assertTrue(isinstance(bad.exception(), tqc.ResponseError))
+        called = []
+        with tqc:
+            future = tqc.add_task(url='http://httpbin.org/get')
+            future.add_done_callback(called.append)
+        self.assertEqual(called, [future])
+        self.assertEqual(future.result()['id'], ids[-1] + 1)
+        self.assertRaises(RuntimeError, tqc.add_task,
+                          url='http://httpbin.org/get')
+
+    def test_compressed_insert(self):
+        tqc = TaskQueueClient('http://localhost:17969', 'test',
+                              compress_threshold=256)
+        payload = '{"lines": [' + ', '.join(['"line"'] * 200) + ']}'
+        task = tqc.add_task(url='http://httpbin.org/post', method='POST',
+                            data=payload, countdown=200)
+        self.assertEqual(task['request']['payload'], payload)
+        self.assertEqual(tqc.get_task(task['id'])['request']['payload'],
+                         payload)
+        tqc.delete_task(task['id'])
+
+    def test_templates(self):
+        tqc = TaskQueueClient('http://localhost:17969', 'test')
+        template = tqc.set_template('notify', url='http://httpbin.org/post',
+                                    method='POST', on_failure=None)
+        self.assertEqual(template['name'], 'notify')
+        self.assertEqual(tqc.get_template('notify')['version'],
+                         template['version'])
+        self.assertTrue('notify' in [t['name']
+                                     for t in tqc.list_templates()])
+        task = tqc.add_task(template='notify', payload='{"id": 1}',
+                            countdown=200)
+        self.assertEqual(task['template'], 'notify')
+        self.assertEqual(task['request'], {'payload': '{"id": 1}'})
+        tqc.delete_task(task['id'])
+        tqc.delete_template('notify')
+        self.assertRaises(TaskQueueClient.ResponseError,
+                          tqc.get_template, 'notify')
+
+    def test_fanout_task(self):
+        tqc = TaskQueueClient('http://localhost:17969', 'test')
+        targets = ['http://httpbin.org/post', 'http://httpbin.org/anything']
+        task = tqc.add_task(targets=targets, method='POST',
+                            data='{"event": 1}', countdown=200)
+        self.assertEqual(task['fanout'], 2)
+        self.assertFalse('url' in task['request'])
+        tqc.delete_task(task['id'])
+        self.assertRaises(ValueError, tqc.fanout_task, [])
+
+    def test_group(self):
+        tqc = TaskQueueClient('http://localhost:17969', 'test')
+        tasks = [tqc.task('http://httpbin.org/get', countdown=200),
+                 tqc.task('http://httpbin.org/post', method='POST',
+                          countdown=200)]
+        group = tqc.add_group(tasks, on_complete='http://httpbin.org/post')
+        self.assertEqual([task['group'] for task in group['tasks']],
+                         [group['group']] * 2)
+        self.assertEqual(tqc.get_group(group['group'])['left'], 2)
+        for task in group['tasks']:
+            tqc.delete_task(task['id'])
+        # its callbacks were called
+        self.assertRaises(TaskQueueClient.ResponseError,
+                          tqc.get_group, group['group'])
+
+    def test_idempotency_key(self):
+        tqc = TaskQueueClient('http://localhost:17969', 'test')
+        key = 'order-{0}'.format(time.time())
+        task = tqc.add_task(url='http://httpbin.org/post', method='POST',
+                            countdown=200, idempotency_key=key)
+        retried = tqc.add_task(url='http://httpbin.org/post', method='POST',
+                               countdown=200, idempotency_key=key)
+        self.assertEqual(retried['id'], task['id'])
+        tqc.delete_task(task['id'])
+
+    def test_retry_after(self):
+        statuses = [429, 429, 201]
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers['Content-Length']))
+                status = statuses.pop(0)
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                if status == 429:
+                    self.send_header('Retry-After', '0.1')
+                    body = ('{"error_code": 207204, "error_desc": "",'
+                            ' "error_detail": "", "request_uri": ""}')
+                else:
+                    body = '{"id": 1, "eta": null}'
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body.encode('utf-8'))
+
+            def log_message(self, *args):
+                pass
+
+        server = HTTPServer(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        try:
+            base_url = 'http://127.0.0.1:{0}'.format(server.server_port)
+            tqc = TaskQueueClient(base_url, 'test')
+            start = time.time()
+            self.assertEqual(tqc.add_task(url='http://httpbin.org')['id'], 1)
+            self.assertTrue(time.time() - start >= 0.2)
+            statuses[:] = [429, 429]
+            tqc = TaskQueueClient(base_url, 'test', max_retries=1)
+            self.assertRaises(tqc.ResponseError, tqc.add_task,
+                              url='http://httpbin.org')
+            self.assertEqual(statuses, [])
+        finally:
+            server.shutdown()
+            server.server_close()
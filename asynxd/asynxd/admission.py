@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+
+import math
+import time
+
+# Token buckets of every key are refilled and checked at once, tokens
+# are taken from all of them only if all of them have enough.
+#
+# KEYS: bucket hashes
+# ARGV: now, cost, then rate and burst of each bucket
+# Returns: seconds to wait before retrying, "0" if admitted
+TOKEN_BUCKET_SCRIPT = '''
+local now = tonumber(ARGV[1])
+local cost = tonumber(ARGV[2])
+local wait = 0
+local tokens = {}
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[i * 2 + 1])
+    local burst = tonumber(ARGV[i * 2 + 2])
+    local bucket = redis.call('HMGET', key, 'tokens', 'ts')
+    local avail = tonumber(bucket[1]) or burst
+    local elapsed = math.max(0, now - (tonumber(bucket[2]) or now))
+    avail = math.min(burst, avail + elapsed * rate)
+    if avail < cost then
+        wait = math.max(wait, (cost - avail) / rate)
+    end
+    tokens[i] = avail
+end
+if wait == 0 then
+    for i, key in ipairs(KEYS) do
+        local rate = tonumber(ARGV[i * 2 + 1])
+        local burst = tonumber(ARGV[i * 2 + 2])
+        redis.call('HMSET', key, 'tokens', tokens[i] - cost, 'ts', now)
+        redis.call('EXPIRE', key, math.ceil(burst / rate) + 1)
+    end
+end
+return tostring(wait)
+'''
+
+
+class AdmissionDenied(Exception):
+
+    def __init__(self, message, retry_after):
+        self.retry_after = retry_after
+        Exception.__init__(self, message)
+
+
+class Admission(object):
+
+    def __init__(self, app, redis):
+        """Admission control of task insertions
+
+        Limits are read from the app's config on every check:
+            - APP_MAX_BACKLOG, QUEUE_MAX_BACKLOG: maximum tasks
+              in an app or in a queue
+            - APP_RATE_LIMIT, QUEUE_RATE_LIMIT: maximum insertions
+              per second into an app or into a queue
+            - APP_RATE_BURST, QUEUE_RATE_BURST: maximum insertions
+              at once, default the rate limit (at least 1)
+            - ADMISSION_OVERRIDES: per app ("app") and per queue
+              ("app:queue") dicts overriding the limits above
+            - BACKLOG_RETRY_AFTER: seconds to retry after when
+              a backlog is full
+
+        A limit of 0 or None disables it.
+
+        """
+        self.app = app
+        self.redis = redis
+        self._token_bucket = redis.register_script(TOKEN_BUCKET_SCRIPT)
+
+    def limits(self, appname, queuename):
+        conf = self.app.config
+        limits = {}
+        for key in ('APP_MAX_BACKLOG', 'APP_RATE_LIMIT', 'APP_RATE_BURST',
+                    'QUEUE_MAX_BACKLOG', 'QUEUE_RATE_LIMIT',
+                    'QUEUE_RATE_BURST'):
+            limits[key] = conf.get(key)
+        overrides = conf.get('ADMISSION_OVERRIDES') or {}
+        limits.update(overrides.get(appname, {}))
+        limits.update(overrides.get(
+            '{0}:{1}'.format(appname, queuename), {}))
+        return limits
+
+    def check(self, tq, cost=1):
+        """checking if `cost` tasks can be inserted into a taskqueue
+
+        Raises AdmissionDenied if they can't
+
+        """
+        limits = self.limits(tq.appname, tq.queuename)
+        retry_after = self.app.config.get('BACKLOG_RETRY_AFTER', 30)
+        max_backlog = limits['QUEUE_MAX_BACKLOG']
+        if max_backlog and tq.count_tasks() + cost > max_backlog:
+            raise AdmissionDenied(
+                'taskqueue "{0}" is full ({1} tasks)'
+                .format(tq.queuename, max_backlog), retry_after)
+        max_backlog = limits['APP_MAX_BACKLOG']
+        if max_backlog and tq.count_app_tasks() + cost > max_backlog:
+            raise AdmissionDenied(
+                'app "{0}" is full ({1} tasks)'
+                .format(tq.appname, max_backlog), retry_after)
+        keys = []
+        args = [time.time(), cost]
+        for prefix, name in (
+                ('APP', tq.appname),
+                ('QUEUE', '{0}:{1}'.format(tq.appname, tq.queuename))):
+            rate = limits[prefix + '_RATE_LIMIT']
+            if not rate:
+                continue
+            burst = limits[prefix + '_RATE_BURST'] or max(rate, 1)
+            if cost > burst:
+                raise AdmissionDenied(
+                    'inserting {0} tasks at once exceeds the burst '
+                    'limit of {1}'.format(cost, burst), retry_after)
+            keys.append('AX:RATE:{0}:{1}'.format(prefix, name))
+            args.extend([rate, burst])
+        if not keys:
+            return
+        wait = float(self._token_bucket(keys=keys, args=args))
+        if wait > 0:
+            raise AdmissionDenied(
+                'too many insertions into taskqueue "{0}"'
+                .format(tq.queuename), int(math.ceil(wait)))
@@ -1,49 +1,86 @@
 # -*- coding: utf-8 -*-
 
-from datetime import datetime
+import hmac
+import zlib
 
 import pytz
-import anyjson
-from celery import schedules
 from werkzeug import MultiDict
 from voluptuous import MultipleInvalid
-from flask import Flask, request, jsonify, json
+from flask import Flask, request, has_request_context
+from celery.signals import worker_init, worker_process_init
 
-from asynx_core.taskqueue import (Task as _Task,
-                                  TaskQueue as _TaskQueue,
+from asynx_core.taskqueue import (TaskQueue as _TaskQueue,
                                   TaskAlreadyExists,
                                   TaskCNameRequired,
-                                  TaskNotFound)
+                                  TaskNotFound,
+                                  TemplateNotFound,
+                                  GroupNotFound)
 
 from . import forms, engines
+from .admission import Admission, AdmissionDenied
+from .profiling import Profiler
+from .tiering import ColdPromoter, TaskRecoverer
 
 app = Flask('asynxd')
 app.config.from_pyfile('application.cfg')
 redisconn = engines.make_redis(app)
+backend = engines.make_backend(app, redisconn)
 celeryapp = engines.make_celery(app)
-
-
-class AsynxJSONEncoder(json.JSONEncoder):
-
-    def default(self, obj):
-        if isinstance(obj, datetime):
-            return obj.isoformat()
-        elif isinstance(obj, schedules.schedule):
-            return _Task._schedule_to_string(obj)
-        return super(AsynxJSONEncoder, self).default(obj)
-
-app.json_encoder = AsynxJSONEncoder
+jsonlib = engines.make_json(app)
+metrics = engines.make_metrics(app, redisconn)
+engines.make_hooks(app)
+profiler = Profiler(redisconn, app.config['PROFILE_DIR'],
+                    app.config['PROFILE_POLL_INTERVAL'])
+admission = Admission(app, redisconn)
 
 
 class TaskQueue(_TaskQueue):
 
+    slow_timelines = app.config.get('TIMELINE_SLOWEST', 0)
+    recent_timelines = app.config.get('TIMELINE_RECENT', 0)
+    compress_threshold = app.config.get('COMPRESS_THRESHOLD') or None
+    compress_codec = app.config.get('COMPRESS_CODEC', 'zlib')
+    fanout_chunk = app.config.get('FANOUT_CHUNK', 100)
+    coalesce_linger = app.config.get('COALESCE_LINGER', 1.0)
+    coalesce_max = app.config.get('COALESCE_MAX_BATCH', 100)
+    dedupe_window = app.config.get('DEDUPE_WINDOW', 600.0)
+    dedupe_content = app.config.get('DEDUPE_CONTENT', False)
+
+    @property
+    def replica_reads(self):
+        # reading your own writes requires the primary
+        return bool(app.config.get('REDIS_REPLICAS')) and not (
+            has_request_context() and
+            request.headers.get('X-Asynx-Consistency') == 'primary')
+
     def __init__(self, appname, queuename='default'):
         localzone = None
         # support optional extension Flask-Babel
         if 'BABEL_DEFAULT_TIMEZONE' in app.config:
             localzone = pytz.timezone(app.config['BABEL_DEFAULT_TIMEZONE'])
         super(TaskQueue, self).__init__(appname, queuename, localzone)
-        self.bind_redis(redisconn)
+        self.bind_backend(backend)
+
+
+def _compare_digest(a, b):
+    """comparing two byte strings in a time independent of where they
+    differ, hmac.compare_digest is missing before python 2.7.7"""
+    if len(a) != len(b):
+        return False
+    result = 0
+    for x, y in zip(bytearray(a), bytearray(b)):
+        result |= x ^ y
+    return result == 0
+
+
+compare_digest = getattr(hmac, 'compare_digest', _compare_digest)
+
+
+promoter = ColdPromoter(TaskQueue, backend,
+                        app.config.get('COLD_PROMOTE_INTERVAL', 60))
+recoverer = TaskRecoverer(TaskQueue, backend,
+                          app.config.get('RECOVER_INTERVAL', 300),
+                          app.config.get('RECOVER_GRACE', 600))
 
 
 class JSONParseError(ValueError):
@@ -54,22 +91,43 @@ class IdentifierNotFound(Exception):
     pass
 
 
+class Forbidden(Exception):
+    pass
+
+
 error_mapping = {
     200100: (400, 'Parsing failure'),
     200101: (422, 'Validation failure'),
+    200102: (403, 'Forbidden'),
     207202: (404, 'Task not found'),
     207203: (409, 'Task already exists'),
+    207204: (429, 'Taskqueue saturated'),
+    207205: (404, 'Template not found'),
+    207206: (404, 'Group not found'),
     107250: (500, 'Internal server error'),
 }
 
 
-def _error_handler(error_code, error_detail):
+def _error_dict(error_code, error_detail):
     status, error_desc = error_mapping[error_code]
-    return jsonify(
-        request_uri=request.url,
-        error_code=error_code,
-        error_desc=error_desc,
-        error_detail=error_detail), status
+    return status, {
+        'error_code': error_code,
+        'error_desc': error_desc,
+        'error_detail': error_detail}
+
+
+def json_response(obj, status=200):
+    return raw_json_response(jsonlib.dumps(obj), status)
+
+
+def raw_json_response(data, status=200):
+    return data, status, {'Content-Type': 'application/json'}
+
+
+def _error_handler(error_code, error_detail):
+    status, error = _error_dict(error_code, error_detail)
+    error['request_uri'] = request.url
+    return json_response(error, status)
 
 
 @app.errorhandler(500)
@@ -92,6 +150,11 @@ def identifier_not_found(e):
     return _error_handler(207202, str(e))
 
 
+@app.errorhandler(Forbidden)
+def forbidden_handler(e):
+    return _error_handler(200102, str(e))
+
+
 @app.errorhandler(TaskCNameRequired)
 def task_cname_required_handler(e):
     return _error_handler(200101, str(e))
@@ -107,12 +170,46 @@ def task_already_exists_handler(e):
     return _error_handler(207203, str(e))
 
 
+@app.errorhandler(TemplateNotFound)
+def template_not_found_handler(e):
+    return _error_handler(207205, str(e))
+
+
+@app.errorhandler(GroupNotFound)
+def group_not_found_handler(e):
+    return _error_handler(207206, str(e))
+
+
+@app.errorhandler(AdmissionDenied)
+def admission_denied_handler(e):
+    data, status, headers = _error_handler(207204, str(e))
+    headers['Retry-After'] = str(e.retry_after)
+    return data, status, headers
+
+
+def _request_body():
+    """the body of the request, decompressed if gzip-encoded"""
+    data = request.get_data()
+    if request.headers.get('Content-Encoding', '').lower() != 'gzip':
+        return data
+    limit = app.config.get('MAX_DECOMPRESSED_BYTES', 16 * 1024 * 1024)
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    try:
+        data = decompressor.decompress(data, limit)
+    except zlib.error as e:
+        raise JSONParseError('invalid gzip body: {0}'.format(e))
+    if decompressor.unconsumed_tail:
+        raise JSONParseError('gzip body exceeds {0} bytes once '
+                             'decompressed'.format(limit))
+    return data
+
+
 def validate(schema, data=None, datatype=None):
     if data is None:
-        data = request.data
+        data = _request_body()
     if datatype == 'json':
         try:
-            data = anyjson.loads(data)
+            data = jsonlib.loads(data)
         except ValueError as e:
             raise JSONParseError(str(e))
     elif isinstance(data, MultiDict):
@@ -120,12 +217,150 @@ def validate(schema, data=None, datatype=None):
     return schema(data)
 
 
+@app.before_first_request
+def start_profiler():
+    profiler.start('asynxd')
+
+
+@worker_init.connect
+@worker_process_init.connect
+def start_worker_profiler(**kwargs):
+    profiler.start('celery')
+
+
+@worker_init.connect
+def start_cold_promoter(**kwargs):
+    # a single promoter per worker node, the tasks are sent from there
+    promoter.start()
+
+
+@worker_init.connect
+def start_recoverer(**kwargs):
+    recoverer.start()
+
+
 @app.route('/status', methods=['GET'])
 def status():
     redisconn.ping()
     return 'true', 200, {'Content-Type': 'application/json'}
 
 
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Exposes metrics of all asynxd and celery processes
+
+    Request
+    -------
+
+    ```
+    GET http://asynx.host/metrics
+    ```
+
+    Response
+    --------
+
+    Metrics in the Prometheus text format:
+
+    - asynx_operation_seconds: histogram, latency of taskqueue operations,
+      labelled by op (add_task, list_tasks, get_task, delete_task, dispatch)
+    - asynx_redis_roundtrips_total: counter, redis round trips of
+      taskqueue operations, labelled by op
+    - asynx_dispatch_seconds: histogram, latency of dispatched HTTP
+      requests, labelled by app, queue and status (2xx, ..., 5xx, error)
+    - asynx_dispatch_lag_seconds: histogram, actual start of tasks minus
+      their eta, or the time scheduled tasks were due
+    - asynx_deduplicated_total: counter, insertions returning the task
+      inserted first with the same idempotency key, labelled by app and
+      queue
+    - asynx_backlog_tasks: gauge, tasks in every taskqueue
+    - asynx_replica_lag_seconds: gauge, lag of every replica in
+      REDIS_REPLICAS, -1 if unknown
+
+    Every process flushes its metrics into redis each
+    METRICS_FLUSH_INTERVAL seconds. Only asynx_backlog_tasks is exposed
+    if METRICS_ENABLED is off.
+
+    """
+    metrics.flush()
+    backlog = [((('app', appname), ('queue', queuename)), count)
+               for appname, queuename, count
+               in TaskQueue.count_all_tasks(backend)]
+    gauges = {'asynx_backlog_tasks': backlog}
+    replicas = app.config.get('REDIS_REPLICAS')
+    if replicas and hasattr(backend, 'check_replicas'):
+        if isinstance(replicas[0], list):
+            # the replicas of each shard
+            replicas = [replica for addresses in replicas
+                        for replica in addresses]
+        lags = backend.check_replicas()
+        gauges['asynx_replica_lag_seconds'] = [
+            ((('replica', replica), ), -1 if lag is None else lag)
+            for replica, lag in zip(replicas, lags)]
+    return (metrics.render(gauges), 200,
+            {'Content-Type': 'text/plain; version=0.0.4'})
+
+
+@app.route('/debug/profile', methods=['POST'])
+def request_profile():
+    """Requests running processes to profile themselves
+
+    Request
+    -------
+
+    ```
+    POST http://asynx.host/debug/profile
+    X-Asynx-Debug-Token: :token
+    ```
+
+    Parameters:
+        - X-Asynx-Debug-Token: header, string, must equal the config
+                               DEBUG_TOKEN. Profiling is forbidden if
+                               DEBUG_TOKEN is not configured
+
+    Request body:
+        ```json
+        {
+            "kind": :kind,
+            "seconds": :seconds,
+            "target": :target
+        }
+        ```
+
+        - kind:    "cpu", sampling stacks of all threads, or "memory",
+                   the top allocations (tracemalloc, or object counts
+                   by type on python 2)
+        - seconds: integer, 1 to 600, default 30
+        - target:  "asynxd", "celery" or "all", default "all"
+
+    Response
+    --------
+
+    Status 202 with the request and the directory the profiles will be
+    written to, one file per process:
+
+    ```json
+    {
+        "id": :id,
+        "kind": :kind,
+        "seconds": :seconds,
+        "target": :target,
+        "directory": :directory
+    }
+    ```
+
+    Every process polls the request each PROFILE_POLL_INTERVAL seconds.
+    CPU profiles are collapsed stacks, readable by flamegraph.pl.
+
+    """
+    token = app.config.get('DEBUG_TOKEN')
+    given = request.headers.get('X-Asynx-Debug-Token', '')
+    if not token or not compare_digest(given.encode('utf-8'),
+                                       token.encode('utf-8')):
+        raise Forbidden('a valid X-Asynx-Debug-Token is required')
+    form = validate(forms.profile_form, datatype='json')
+    return json_response(profiler.request(**form), 202)
+
+
 @app.route('/apps/<appname>/taskqueues/<taskqueue>/tasks', methods=['GET'])
 def list_tasks(appname, taskqueue):
     """Lists all non deleted tasks in a taskqueue
@@ -146,6 +381,9 @@ def list_tasks(appname, taskqueue):
                      where the list start
         - limit:     query param, integer, the count of tasks
                      to be listed. maximum 200
+        - X-Asynx-Consistency: optional header, "primary" to read from
+                     the primary redis instead of a replica, for seeing
+                     the tasks just inserted
 
     Request body:
         Do not supply a request body with this method
@@ -173,8 +411,9 @@ def list_tasks(appname, taskqueue):
     offset, limit = form['offset'], form['limit']
     tq = TaskQueue(appname, taskqueue)
     total = tq.count_tasks()
-    items = tq.list_tasks(form['offset'], form['limit'])
-    return jsonify(items=items, total=total)
+    items = tq.list_tasks_json(offset, limit)
+    return raw_json_response(
+        '{{"items":[{0}],"total":{1}}}'.format(','.join(items), total))
 
 
 @app.route('/apps/<appname>/taskqueues/<taskqueue>/tasks', methods=['POST'])
@@ -213,6 +452,10 @@ def insert_task(appname, taskqueue):
             "countdown": :countdown,
             "eta": :eta,
             "schedule": :schedule,
+            "template": :template,
+            "targets": [:url],
+            "coalesce": :coalesce,
+            "idempotency_key": :idempotency_key,
             "on_success": on_success,
             "on_failure": on_failure,
             "on_complete": on_complete
@@ -234,6 +477,35 @@ def insert_task(appname, taskqueue):
                       trigger the task, can not be used with countdown
         - schedule:   schedule string, provide this if the task is
                       a scheduled task
+        - template:   string & optional, name of a request template of
+                      the taskqueue, the request then only holds the
+                      arguments overriding the template's, its headers
+                      are merged. The current version of the template is
+                      used when the task is dispatched
+        - targets:    list & optional, 1 to 100000 URLs the request is
+                      sent to instead of its url, each one once, by
+                      chunks of FANOUT_CHUNK. The callbacks are called
+                      once every target is sent, with a response whose
+                      content is {total, succeeded, failed, results},
+                      results maps each target to its status code or
+                      the error sending it. The status code is 200 if
+                      every target succeeded, else 500
+        - coalesce:   boolean & optional, for endpoints accepting batches.
+                      Once due, the task waits COALESCE_LINGER seconds
+                      for other coalesced tasks with the same method,
+                      url, headers and timeout, then up to
+                      COALESCE_MAX_BATCH of them are sent in one request
+                      whose body is a JSON array of their payloads. If the
+                      response is a JSON array as long, each task gets its
+                      element for its callbacks, and its "status" if any
+                      as status code; else each gets the whole response
+        - idempotency_key: string & optional, 1 to 256 chars. Inserting a
+                      task with the key of a task inserted in the last
+                      DEDUPE_WINDOW seconds returns that task, even if it
+                      is done, and inserts nothing. If DEDUPE_CONTENT is
+                      on, the tasks without a key are keyed by a hash of
+                      their content, but the scheduled ones and the ones
+                      of groups
         - on_success: success callback. Can be a URL and it will be called
                       with a POST request;
                       or None to do nothing;
@@ -262,7 +534,11 @@ def insert_task(appname, taskqueue):
             status: :status,
             on_success: :on_success,
             on_failure: :on_failure,
-            on_complete: :on_complete
+            on_complete: :on_complete,
+            template: :template,
+            fanout: :fanout,
+            coalesce: :coalesce,
+            group: :group
         }
     ```
 
@@ -274,12 +550,273 @@ def insert_task(appname, taskqueue):
         "new", enqueued and will be executed immediately
         "delayed", enqueued but will not be triggered until eta
     - last_run_at: datetime (isoformat)
+    - fanout: integer, count of targets of a fan-out task, else null
+    - group:  string, id of the group the task is in, else null
+
+    If the app or the taskqueue exceeds its admission limits, this method
+    returns status 429 with a `Retry-After` header in seconds.
 
     """
     task_dict = validate(forms.add_task_form, datatype='json')
     tq = TaskQueue(appname, taskqueue)
-    x = tq.add_task(**task_dict)
-    return jsonify(x), 201
+    admission.check(tq)
+    return raw_json_response(tq.add_task_json(**task_dict), 201)
+
+
+@app.route('/apps/<appname>/taskqueues/<taskqueue>/tasks/bulk',
+           methods=['POST'])
+def bulk_insert_tasks(appname, taskqueue):
+    """Inserts a batch of tasks into a taskqueue
+
+    Request
+    -------
+
+    ```
+    POST http://asynx.host/apps/:appname/taskqueues/:taskqueue/tasks/bulk
+    ```
+
+    Parameters:
+        - appname:   url param, string, the application name
+                     under which the queue lies
+        - taskqueue: url param, string, the name of the taskqueue
+                     to insert the tasks into
+
+    Request body:
+        Supply the tasks in JSON with the following structure:
+
+        ```json
+        {
+            "tasks": [
+                :task
+            ]
+        }
+        ```
+
+        - tasks: list, 1 to 500 tasks, each one has the same structure
+                 as the request body of `insert_task`
+
+    Response
+    --------
+
+    ```json
+    {
+        "items": [
+            :task_or_error
+        ]
+    }
+    ```
+
+    - items: list, in the same order as the submitted tasks. Each item is
+             either the inserted task resource same as `insert_task`, or
+             an error object if that task was rejected:
+             {error_code: :code, error_desc: :desc, error_detail: :detail}
+
+    A rejected task does not affect the other tasks in the batch. The
+    admission limits apply to the whole batch, same as `insert_task`.
+
+    """
+    form = validate(forms.bulk_tasks_form, datatype='json')
+    tq = TaskQueue(appname, taskqueue)
+    admission.check(tq, len(form['tasks']))
+    items = []
+    # one transaction on backends supporting it
+    with tq.batch():
+        for task_dict in form['tasks']:
+            try:
+                task_dict = forms.add_task_form(task_dict)
+                items.append(tq.add_task_json(**task_dict))
+            except (MultipleInvalid, TaskCNameRequired) as e:
+                items.append(jsonlib.dumps(_error_dict(200101, str(e))[1]))
+            except TaskAlreadyExists as e:
+                items.append(jsonlib.dumps(_error_dict(207203, str(e))[1]))
+            except TemplateNotFound as e:
+                items.append(jsonlib.dumps(_error_dict(207205, str(e))[1]))
+    return raw_json_response('{"items":[' + ','.join(items) + ']}')
+
+
+@app.route('/apps/<appname>/taskqueues/<taskqueue>/groups',
+           methods=['POST'])
+def insert_group(appname, taskqueue):
+    """Inserts a group of tasks into a taskqueue
+
+    Request
+    -------
+
+    ```
+    POST http://asynx.host/apps/:appname/taskqueues/:taskqueue/groups
+    ```
+
+    Parameters:
+        - appname:   url param, string, the application name
+                     under which the queue lies
+        - taskqueue: url param, string, the name of the taskqueue
+                     to insert the tasks into
+
+    Request body:
+        Supply the group in JSON with the following structure:
+
+        ```json
+        {
+            "tasks": [
+                :task
+            ],
+            "on_success": on_success,
+            "on_failure": on_failure,
+            "on_complete": on_complete
+        }
+        ```
+
+        - tasks:      list, 1 to 500 tasks, each one has the same
+                      structure as the request body of `insert_task`,
+                      they can not be scheduled. Every task keeps its own
+                      callbacks
+        - on_success: called once every task is done and succeeded, same
+                      as the callbacks of `insert_task`. The response
+                      passed has the content {total, succeeded, failed,
+                      results}, results maps each task id to its status
+                      code, the error sending it, or "cancelled" if it
+                      was deleted. The status code is 200 if every task
+                      succeeded, else 500
+        - on_failure: Same as `on_success`, once every task is done and
+                      any of them failed
+                      default: __report__
+        - on_complete: Same as `on_success`, once every task is done
+                       default: None
+
+    Response
+    --------
+
+    ```json
+    {
+        "group": :group,
+        "tasks": [
+            :task
+        ]
+    }
+    ```
+
+    - group: string, id of the group
+    - tasks: list, the inserted task resources same as `insert_task`
+
+    The tasks are inserted all or none: if one of them is rejected, the
+    error is returned same as `insert_task`. The admission limits apply
+    to the whole group, same as `bulk_insert_tasks`.
+
+    """
+    form = validate(forms.group_form, datatype='json')
+    tq = TaskQueue(appname, taskqueue)
+    admission.check(tq, len(form['tasks']))
+    return raw_json_response(tq.add_group_json(**form), 201)
+
+
+@app.route('/apps/<appname>/taskqueues/<taskqueue>/groups/<group>',
+           methods=['GET'])
+def get_group(appname, taskqueue, group):
+    """Gets the progress of a group of tasks
+
+    Request
+    -------
+
+    ```
+    GET http://asynx.host/apps/:appname/taskqueues/:taskqueue/groups/:group
+    ```
+
+    Parameters:
+        - appname:   url param, string, the application name
+                     under which the queue lies
+        - taskqueue: url param, string, the name of the taskqueue
+        - group:     url param, string, the id of the group
+
+    Request body:
+        Do not supply a request body with this method
+
+    Response
+    --------
+
+    ```json
+    {
+        "group": :group,
+        "total": :total,
+        "left": :left,
+        "results": {
+            :id: :result
+        }
+    }
+    ```
+
+    - total:   integer, count of tasks of the group
+    - left:    integer, count of tasks not done yet
+    - results: dict, the status code of each done task, the error
+               sending it, or "cancelled"
+
+    A group is deleted once its callbacks are called, it is then not
+    found.
+
+    """
+    tq = TaskQueue(appname, taskqueue)
+    return json_response(tq.get_group(group))
+
+
+@app.route('/apps/<appname>/taskqueues/<taskqueue>/timelines',
+           methods=['GET'])
+def get_timelines(appname, taskqueue):
+    """Gets the dispatch timelines kept for debugging a taskqueue
+
+    Request
+    -------
+
+    ```
+    GET http://asynx.host/apps/:appname/taskqueues/:taskqueue/timelines
+    ```
+
+    Parameters:
+        - appname:   url param, string, the application name
+                     under which the queue lies
+        - taskqueue: url param, string, the name of the taskqueue
+
+    Request body:
+        Do not supply a request body with this method
+
+    Response
+    --------
+
+    ```json
+    {
+        "slowest": [
+            {
+                "id": :id,
+                "uuid": :uuid,
+                "cname": :cname,
+                "url": :url,
+                "status_code": :status_code,
+                "error": :error,
+                "marks": {:mark: :timestamp},
+                "phases": {:phase: :seconds},
+                "total": :total
+            }
+        ],
+        "percentiles": {
+            :phase: {"p50": :seconds, "p95": :seconds, "p99": :seconds}
+        },
+        "samples": :samples
+    }
+    ```
+
+    - slowest: list, the TIMELINE_SLOWEST slowest dispatches, slowest
+               first. Marks are unix timestamps of: enqueued, due,
+               picked_up, status_cas, request_start, first_byte,
+               body_done, callbacks and deleted
+    - phases:  seconds of queue (due to picked_up), fetch (picked_up to
+               status_cas), prepare, first_byte (request_start to
+               first_byte, including DNS, connecting and TLS), body,
+               callbacks and finish (deleting or rescheduling)
+    - total:   seconds from due to the last mark
+    - percentiles: computed on the TIMELINE_RECENT recent dispatches
+    - samples: integer, count of the recent dispatches
+
+    """
+    tq = TaskQueue(appname, taskqueue)
+    return json_response(tq.get_timelines())
 
 
 @app.route('/apps/<appname>/taskqueues/<taskqueue>/tasks/<identifier>',
@@ -304,6 +841,8 @@ def get_task(appname, taskqueue, identifier):
                         - id, form: {integer} or id:{integer};
                         - uuid, form: uuid:{string}
                         - cname, form: cname:{string}
+        - X-Asynx-Consistency: optional header, "primary" to read from
+                      the primary redis instead of a replica
 
     Request body:
         Do not supply a request body with this method
@@ -320,12 +859,12 @@ def get_task(appname, taskqueue, identifier):
         raise IdentifierNotFound(str(e))
     tq = TaskQueue(appname, taskqueue)
     if kind == 'id':
-        task = tq.get_task(kind_id)
+        task = tq.get_task_json(kind_id)
     elif kind == 'uuid':
-        task = tq.get_task_by_uuid(kind_id)
+        task = tq.get_task_by_uuid_json(kind_id)
     elif kind == 'cname':
-        task = tq.get_task_by_cname(kind_id)
-    return jsonify(task)
+        task = tq.get_task_by_cname_json(kind_id)
+    return raw_json_response(task)
 
 
 @app.route('/apps/<appname>/taskqueues/<taskqueue>/tasks/<identifier>',
@@ -370,3 +909,170 @@ def delete_task(appname, taskqueue, identifier):
     elif kind == 'cname':
         tq.delete_task_by_cname(kind_id)
     return 'null', 200, {'Content-Type': 'application/json'}
+
+
+@app.route('/apps/<appname>/taskqueues/<taskqueue>/templates',
+           methods=['GET'])
+def list_templates(appname, taskqueue):
+    """Lists the request templates of a taskqueue
+
+    Request
+    -------
+
+    ```
+    GET http://asynx.host/apps/:appname/taskqueues/:taskqueue/templates
+    ```
+
+    Parameters:
+        - appname:   url param, string, the application name
+                     under which the queue lies
+        - taskqueue: url param, string, the name of the taskqueue
+
+    Request body:
+        Do not supply a request body with this method
+
+    Response
+    --------
+
+    ```json
+    {
+        "items": [
+            :template
+        ]
+    }
+    ```
+
+    - items: list, template resources same as `set_template`, ordered
+             by name
+
+    """
+    tq = TaskQueue(appname, taskqueue)
+    return json_response({'items': tq.list_templates()})
+
+
+@app.route('/apps/<appname>/taskqueues/<taskqueue>/templates/<name>',
+           methods=['PUT'])
+def set_template(appname, taskqueue, name):
+    """Creates or updates a request template of a taskqueue
+
+    Request
+    -------
+
+    ```
+    PUT http://asynx.host/apps/:appname/taskqueues/:taskqueue/templates/:name
+    ```
+
+    Parameters:
+        - appname:   url param, string, the application name
+                     under which the queue lies
+        - taskqueue: url param, string, the name of the taskqueue
+        - name:      url param, string, the name of the template
+
+    Request body:
+        Supply a template in JSON with the following structure:
+
+        ```json
+        {
+            "request": {
+                :request
+            },
+            "on_success": on_success,
+            "on_failure": on_failure,
+            "on_complete": on_complete
+        }
+        ```
+
+        - request:    request context same as `insert_task`
+        - on_success, on_failure, on_complete: optional callbacks same
+                      as `insert_task`, applied to the tasks keeping
+                      the default callbacks
+
+    Response
+    --------
+
+    ```json
+        {
+            name: :name,
+            version: :version,
+            request: {
+                :request
+            },
+            on_success: :on_success,
+            on_failure: :on_failure,
+            on_complete: :on_complete
+        }
+    ```
+
+    - version: integer, incremented by every update of the template.
+               Pending tasks referencing the template are dispatched
+               with its latest version
+
+    """
+    template = validate(forms.template_form, datatype='json')
+    tq = TaskQueue(appname, taskqueue)
+    return json_response(tq.set_template(name, **template))
+
+
+@app.route('/apps/<appname>/taskqueues/<taskqueue>/templates/<name>',
+           methods=['GET'])
+def get_template(appname, taskqueue, name):
+    """Gets a request template of a taskqueue
+
+    Request
+    -------
+
+    ```
+    GET http://asynx.host/apps/:appname/taskqueues/:taskqueue/templates/:name
+    ```
+
+    Parameters:
+        - appname:   url param, string, the application name
+                     under which the queue lies
+        - taskqueue: url param, string, the name of the taskqueue
+        - name:      url param, string, the name of the template
+
+    Request body:
+        Do not supply a request body with this method
+
+    Response
+    --------
+
+    Template resource same as `set_template`.
+
+    """
+    tq = TaskQueue(appname, taskqueue)
+    return json_response(tq.get_template(name))
+
+
+@app.route('/apps/<appname>/taskqueues/<taskqueue>/templates/<name>',
+           methods=['DELETE'])
+def delete_template(appname, taskqueue, name):
+    """Deletes a request template of a taskqueue
+
+    Request
+    -------
+
+    ```
+    DELETE \
+        http://asynx.host/apps/:appname/taskqueues/:taskqueue/templates/:name
+    ```
+
+    Parameters:
+        - appname:   url param, string, the application name
+                     under which the queue lies
+        - taskqueue: url param, string, the name of the taskqueue
+        - name:      url param, string, the name of the template
+
+    Request body:
+        Do not supply a request body with this method
+
+    Response
+    --------
+
+    If successful, this method returns null in JSON. The pending tasks
+    still referencing the template fail when they are dispatched.
+
+    """
+    tq = TaskQueue(appname, taskqueue)
+    tq.delete_template(name)
+    return 'null', 200, {'Content-Type': 'application/json'}
@@ -1,13 +1,90 @@
 # -*- coding: utf-8 -*-
 
-from celery import Celery
+import json
+from datetime import datetime
+
+from redis import StrictRedis
+from celery import Celery, schedules
 from flask.ext.redis import Redis
 
+from asynx_core.taskqueue import Task
+from asynx_core.metrics import registry
+from asynx_core.ids import SnowflakeIds
+from asynx_core.backends import (RedisBackend, ShardedRedisBackend,
+                                 SqliteBackend)
+from asynx_core import hooks
+
 
 def make_redis(app):
     return Redis(app)
 
 
+def _connections(app, addresses):
+    db = app.config.get('REDIS_DB', 0)
+    return [StrictRedis(host, int(port), db)
+            for host, port in (address.rsplit(':', 1)
+                               for address in addresses or ())]
+
+
+def make_backend(app, redis):
+    """the storage backend of tasks selected by STORAGE_BACKEND"""
+    name = app.config.get('STORAGE_BACKEND', 'redis')
+    if name == 'redis':
+        ids = None
+        if app.config.get('TASK_IDS', 'sequence') == 'snowflake':
+            ids = SnowflakeIds(redis)
+        cold_horizon = app.config.get('COLD_HORIZON') or None
+        compact = app.config.get('REDIS_COMPACT', False)
+        max_lag = app.config.get('REPLICA_MAX_LAG', 5.0)
+        replicas = app.config.get('REDIS_REPLICAS') or []
+        shards = app.config.get('REDIS_SHARDS')
+        if app.config.get('REDIS_SHARDING') and shards:
+            connections = [redis] + _connections(app, shards)
+            if replicas:
+                if len(replicas) != len(connections) or not all(
+                        isinstance(addresses, list)
+                        for addresses in replicas):
+                    raise ValueError(
+                        'with REDIS_SHARDING, REDIS_REPLICAS must be a '
+                        'list of the replicas of each server of '
+                        'REDIS_HOSTS')
+                replicas = [_connections(app, addresses)
+                            for addresses in replicas]
+            return ShardedRedisBackend(
+                connections, ids, replicas or None, max_lag=max_lag,
+                cold_horizon=cold_horizon, compact=compact)
+        return RedisBackend(
+            redis, ids, _connections(app, replicas), max_lag=max_lag,
+            cold_horizon=cold_horizon, compact=compact)
+    if name == 'sqlite':
+        return SqliteBackend(app.config['SQLITE_PATH'],
+                             app.config.get('SQLITE_SYNCHRONOUS', 'NORMAL'))
+    raise ValueError('unknown STORAGE_BACKEND "{0}"'.format(name))
+
+
+def make_metrics(app, redis):
+    """binding the metrics registry of asynx-core if METRICS_ENABLED"""
+    registry.flush_interval = app.config.get('METRICS_FLUSH_INTERVAL', 5.0)
+    if app.config.get('METRICS_ENABLED', True):
+        registry.bind_redis(redis)
+    return registry
+
+
+def make_hooks(app):
+    """registering the built-in hooks enabled in config"""
+    registered = []
+    address = app.config.get('HOOKS_STATSD_ADDRESS')
+    if address:
+        host, _, port = address.rpartition(':')
+        registered.append(hooks.register(hooks.StatsdHook(
+            host, int(port), app.config.get('HOOKS_STATSD_PREFIX', 'asynx'))))
+    every = app.config.get('HOOKS_PROFILE_EVERY')
+    if every:
+        registered.append(hooks.register(hooks.ProfileHook(
+            every, app.config['HOOKS_PROFILE_DIR'])))
+    return registered
+
+
 def make_celery(app):
     celery = Celery(app.import_name, broker=app.config['CELERY_BROKER_URL'])
     celery.conf.update(app.config)
@@ -21,3 +98,68 @@ def make_celery(app):
                 return TaskBase.__call__(self, *args, **kwargs)
     celery.Task = ContextTask
     return celery
+
+
+def json_default(obj):
+    if isinstance(obj, datetime):
+        return obj.isoformat()
+    elif isinstance(obj, schedules.schedule):
+        return Task._schedule_to_string(obj)
+    raise TypeError('{0!r} is not JSON serializable'.format(obj))
+
+
+class JSONEngine(object):
+    """JSON backend on a module compatible with the stdlib json"""
+
+    def __init__(self, module):
+        self.name = module.__name__
+        self._module = module
+
+    def dumps(self, obj):
+        return self._module.dumps(obj, default=json_default,
+                                  separators=(',', ':'))
+
+    def loads(self, data):
+        return self._module.loads(data)
+
+
+class OrjsonEngine(object):
+    """JSON backend on orjson, which encodes datetimes natively"""
+
+    name = 'orjson'
+
+    def __init__(self, module):
+        self._module = module
+
+    def dumps(self, obj):
+        return self._module.dumps(obj, default=json_default).decode('utf-8')
+
+    def loads(self, data):
+        return self._module.loads(data)
+
+
+def make_json(app):
+    """creating the JSON backend named by config JSON_BACKEND
+
+    Valid backends: "orjson", "simplejson", "json", or "auto"
+    to use the fastest one installed
+
+    """
+    backend = app.config.get('JSON_BACKEND', 'auto')
+    if backend in ('auto', 'orjson'):
+        try:
+            import orjson
+            return OrjsonEngine(orjson)
+        except ImportError:
+            if backend != 'auto':
+                raise
+    if backend in ('auto', 'simplejson'):
+        try:
+            import simplejson
+            return JSONEngine(simplejson)
+        except ImportError:
+            if backend != 'auto':
+                raise
+    if backend in ('auto', 'json'):
+        return JSONEngine(json)
+    raise ValueError('unknown JSON_BACKEND "{0}"'.format(backend))
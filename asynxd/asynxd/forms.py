@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 
+import re
 from uuid import UUID
 
 import voluptuous as v
@@ -7,6 +8,7 @@ from dateutil import parser
 from voluptuous import Schema, Required, All, Any, Coerce
 
 from asynx_core.taskqueue import Task
+from asynx_core._util import dict_items
 
 
 def NestedSchema(schema_name, msg=None):
@@ -43,15 +45,17 @@ def Schedule(val):
 
 try:
     String = Any(unicode, str, msg='expected string')
+    _string_types, _string_msg = (unicode, str), 'expected string'
 except NameError:
     String = str
+    _string_types, _string_msg = str, 'expected str'
 
 list_tasks_form = Schema({
     Required('offset', default=0): Coerce(int),
     Required('limit', default=50): All(Coerce(int), v.Range(min=0, max=200))
 })
 
-add_task_form = Schema({
+add_task_schema = Schema({
     Required('request'): {
         Required('method', default='GET'): v.Upper,
         Required('url'): Http,
@@ -64,8 +68,317 @@ add_task_form = Schema({
     'countdown': Any(All(Coerce(float), v.Range(.0)), None),
     'eta': Any(Coerce(DateTime), None),
     'schedule': Any(Coerce(Schedule), None),
+    'template': Any(String, None),
+    'targets': Any(All([Http], v.Length(min=1, max=100000)), None),
+    'coalesce': Any(bool, None),
+    'idempotency_key': Any(All(String, v.Length(min=1, max=256)), None),
     Any('on_success', 'on_failure', 'on_complete'):
-    Any('__report__', Http, NestedSchema('add_task_form'), None)
+    Any('__report__', Http, NestedSchema('add_task_schema'), None)
+})
+
+
+# A precompiled equivalent of add_task_schema. Voluptuous walks the
+# schema generically and recompiles the whole task schema for every
+# nested callback, the functions below validate a task directly while
+# raising the same errors in the same order. Tasks naming a template or
+# fanning out are only validated here, their request is a partial
+# override of the template's, and targets replace its url.
+
+_required = object()
+_suffix = ' for dictionary value'
+_http_pattern = re.compile('(?i)^https?://')
+
+
+def _invalid_at(key, e):
+    path = [key] + e.path
+    if e.path:
+        return v.Invalid(e.msg, path, e.error_message)
+    return v.Invalid(e.msg + _suffix, path, e.msg)
+
+
+def _mapping(data, fields, required):
+    if not isinstance(data, dict):
+        raise v.Invalid('expected a dictionary')
+    out = type(data)()
+    errors = []
+    for key, val in dict_items(data):
+        validator = fields.get(key)
+        if validator is None:
+            errors.append(v.Invalid('extra keys not allowed', [key]))
+            continue
+        try:
+            out[key] = validator(val)
+        except v.MultipleInvalid as e:
+            errors.extend([_invalid_at(key, err) for err in e.errors])
+        except v.Invalid as e:
+            errors.append(_invalid_at(key, e))
+    for key, default in dict_items(required):
+        if key in data:
+            continue
+        if default is _required:
+            errors.append(v.Invalid('required key not provided', [key]))
+        else:
+            out[key] = default
+    if errors:
+        raise v.MultipleInvalid(errors)
+    return out
+
+
+def _nullable(validator):
+
+    def f(val):
+        try:
+            return validator(val)
+        except v.Invalid:
+            if val is None:
+                return val
+            raise
+    return f
+
+
+def _string(val):
+    if not isinstance(val, _string_types):
+        raise v.Invalid(_string_msg)
+    return val
+
+
+def _float(val):
+    try:
+        return float(val)
+    except (ValueError, TypeError):
+        raise v.Invalid('expected float')
+
+
+def _countdown(val):
+    val = _float(val)
+    if val < .0:
+        raise v.Invalid('value must be at least 0.0')
+    return val
+
+
+def _bool(val):
+    if not isinstance(val, bool):
+        raise v.Invalid('expected bool')
+    return val
+
+
+def _upper(val):
+    try:
+        return v.Upper(val)
+    except ValueError:
+        raise v.Invalid('not a valid value')
+
+
+def _http(val):
+    try:
+        match = _http_pattern.match(val)
+    except TypeError:
+        raise v.Invalid('expected string or buffer')
+    if not match:
+        raise v.Invalid('does not match regular expression')
+    return val
+
+
+def _headers(val):
+    if not isinstance(val, dict):
+        raise v.Invalid('expected a dictionary')
+    out = type(val)()
+    errors = []
+    for key, header in dict_items(val):
+        if not isinstance(key, _string_types):
+            errors.append(v.Invalid('extra keys not allowed', [key]))
+        elif not isinstance(header, _string_types):
+            errors.append(v.Invalid(_string_msg + _suffix, [key],
+                                    _string_msg))
+        else:
+            out[key] = header
+    if errors:
+        raise v.MultipleInvalid(errors)
+    return out
+
+
+def _targets(val):
+    if not isinstance(val, list):
+        raise v.Invalid('expected a list')
+    if not 1 <= len(val) <= 100000:
+        raise v.Invalid('length of value must be between 1 and 100000')
+    for i, target in enumerate(val):
+        try:
+            _http(target)
+        except v.Invalid as e:
+            raise v.Invalid(e.msg, [i])
+    return val
+
+
+def _idempotency_key(val):
+    _string(val)
+    if len(val) < 1:
+        raise v.Invalid('length of value must be at least 1')
+    if len(val) > 256:
+        raise v.Invalid('length of value must be at most 256')
+    return val
+
+
+def _callback(val):
+    if val == '__report__':
+        return val
+    try:
+        return _http(val)
+    except v.Invalid:
+        pass
+    if isinstance(val, dict):
+        try:
+            return _task(val)
+        except v.MultipleInvalid as e:
+            # only the first error of a subtask is reported
+            err = e.errors[0]
+            raise v.Invalid(err.msg, err.path, err.error_message)
+    if val is None:
+        return val
+    raise v.Invalid('not a valid value')
+
+
+_request_fields = {
+    'method': _upper,
+    'url': _http,
+    'headers': _headers,
+    'payload': _nullable(_string),
+    'timeout': _nullable(_float),
+    'allow_redirects': _nullable(_bool)
+}
+_request_required = {'method': 'GET', 'url': _required}
+
+
+def _request(val):
+    return _mapping(val, _request_fields, _request_required)
+
+
+def _request_overrides(val):
+    return _mapping(val, _request_fields, {})
+
+_task_fields = {
+    'request': _request,
+    'cname': _nullable(_string),
+    'countdown': _nullable(_countdown),
+    'eta': _nullable(DateTime),
+    'schedule': _nullable(Schedule),
+    'template': _nullable(_string),
+    'targets': _nullable(_targets),
+    'coalesce': _nullable(_bool),
+    'idempotency_key': _nullable(_idempotency_key),
+    'on_success': _callback,
+    'on_failure': _callback,
+    'on_complete': _callback
+}
+_task_required = {'request': _required}
+
+
+_template_task_fields = dict(_task_fields, request=_request_overrides)
+
+
+def _task(val):
+    if isinstance(val, dict) and (val.get('template') is not None or
+                                  val.get('targets') is not None):
+        task = _mapping(val, _template_task_fields, {})
+        if task.get('targets') and task.get('schedule'):
+            raise v.MultipleInvalid([v.Invalid(
+                'fan-out task can not be scheduled', ['schedule'])])
+        request = task.setdefault('request', {})
+        if task.get('template') is None:
+            request.setdefault('method', 'GET')
+    else:
+        task = _mapping(val, _task_fields, _task_required)
+    if task.get('coalesce') and (task.get('schedule') or
+                                 task.get('targets')):
+        raise v.MultipleInvalid([v.Invalid(
+            'scheduled or fan-out task can not be coalesced', ['coalesce'])])
+    return task
+
+
+_template_fields = {
+    'request': _request,
+    'on_success': _callback,
+    'on_failure': _callback,
+    'on_complete': _callback
+}
+
+
+def add_task_form(data):
+    """Validates a task, same as add_task_schema but precompiled"""
+    try:
+        return _task(data)
+    except v.MultipleInvalid:
+        raise
+    except v.Invalid as e:
+        raise v.MultipleInvalid([e])
+
+
+def template_form(data):
+    """Validates a request template, a request and default callbacks"""
+    try:
+        return _mapping(data, _template_fields, _task_required)
+    except v.MultipleInvalid:
+        raise
+    except v.Invalid as e:
+        raise v.MultipleInvalid([e])
+
+
+def _tasks(val):
+    if not isinstance(val, list):
+        raise v.Invalid('expected a list')
+    if not 1 <= len(val) <= 500:
+        raise v.Invalid('length of value must be between 1 and 500')
+    tasks, errors = [], []
+    for i, task in enumerate(val):
+        try:
+            task = _task(task)
+        except v.MultipleInvalid as e:
+            errors.extend([v.Invalid(err.msg, [i] + err.path,
+                                     err.error_message) for err in e.errors])
+            continue
+        except v.Invalid as e:
+            errors.append(v.Invalid(e.msg, [i] + e.path, e.error_message))
+            continue
+        if task.get('schedule'):
+            errors.append(v.Invalid('task of a group can not be scheduled',
+                                    [i, 'schedule']))
+        if task.get('idempotency_key'):
+            errors.append(v.Invalid('task of a group can not have an '
+                                    'idempotency key',
+                                    [i, 'idempotency_key']))
+        tasks.append(task)
+    if errors:
+        raise v.MultipleInvalid(errors)
+    return tasks
+
+
+_group_fields = {
+    'tasks': _tasks,
+    'on_success': _callback,
+    'on_failure': _callback,
+    'on_complete': _callback
+}
+
+
+def group_form(data):
+    """Validates a group of tasks and the callbacks of the group"""
+    try:
+        return _mapping(data, _group_fields, {'tasks': _required})
+    except v.MultipleInvalid:
+        raise
+    except v.Invalid as e:
+        raise v.MultipleInvalid([e])
+
+
+bulk_tasks_form = Schema({
+    Required('tasks'): All([dict], v.Length(min=1, max=500))
+})
+
+profile_form = Schema({
+    Required('kind'): v.Any('cpu', 'memory'),
+    Required('seconds', default=30): All(Coerce(int),
+                                         v.Range(min=1, max=600)),
+    Required('target', default='all'): v.Any('asynxd', 'celery', 'all')
 })
 
 identifier_form = Schema(
@@ -0,0 +1,298 @@
+# -*- coding: utf-8 -*-
+
+import time
+import random
+import threading
+try:
+    from urlparse import urlparse, parse_qs
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from urllib.parse import urlparse, parse_qs
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+
+from asynx_core.metrics import percentiles
+
+# kinds of tasks a load can be mixed of
+KINDS = ('immediate', 'delayed', 'scheduled', 'chained')
+
+
+def parse_mix(text):
+    """parsing a task mix like "immediate=7,delayed=2,chained=1"
+
+    Doctest:
+        >>> sorted(parse_mix('immediate=3,delayed=1').items())
+        [('delayed', 1.0), ('immediate', 3.0)]
+        >>> parse_mix('immediate')
+        {'immediate': 1.0}
+        >>> parse_mix('unknown=1')
+        Traceback (most recent call last):
+            ...
+        ValueError: unknown kind of task "unknown"
+
+    """
+    mix = {}
+    for part in text.split(','):
+        kind, _, weight = part.strip().partition('=')
+        if kind not in KINDS:
+            raise ValueError('unknown kind of task "{0}"'.format(kind))
+        mix[kind] = float(weight or 1)
+    return mix
+
+
+class _SinkHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def _receive(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            self.rfile.read(length)
+        self.server.sink.record(parse_qs(urlparse(self.path).query))
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    do_GET = do_POST = do_PUT = do_DELETE = do_HEAD = _receive
+
+    def log_message(self, *args):
+        pass
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class Sink(object):
+
+    def __init__(self, host='127.0.0.1', port=0):
+        """a local HTTP server receiving the requests of tasks
+
+        Tasks of the load carry in their query string their kind, their
+        sequence number ("task") and, unless scheduled, when they are due
+        ("due", unix timestamp), so the lag between the due time and the
+        arrival of the request can be measured and the tasks still
+        outstanding can be told.
+
+        Parameters:
+            - host: string, address to bind
+            - port: integer, port to bind, default any free port
+
+        """
+        self.server = _ThreadingHTTPServer((host, port), _SinkHandler)
+        self.server.sink = self
+        self.lock = threading.Lock()
+        self.arrivals = []
+        self.lags = []
+        self.kinds = {}
+        self.runs = set()
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return 'http://{0}:{1}/'.format(host, port)
+
+    def record(self, query):
+        now = time.time()
+        kind = query.get('kind', ['-'])[0]
+        with self.lock:
+            self.arrivals.append(now)
+            self.kinds[kind] = self.kinds.get(kind, 0) + 1
+            if 'task' in query:
+                self.runs.add((kind, query['task'][0]))
+            if 'due' in query:
+                self.lags.append(now - float(query['due'][0]))
+
+    def start(self):
+        thread = threading.Thread(target=self.server.serve_forever,
+                                  name='asynx-sink')
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class LoadGenerator(object):
+
+    def __init__(self, client, sink, mix=None, rate=0, concurrency=4,
+                 countdown=(1, 5), schedule_interval=5):
+        """inserting tasks into asynxd through a TaskQueueClient
+
+        Parameters:
+            - client: asynx.TaskQueueClient
+            - sink: Sink, where the tasks send their requests
+            - mix: dict, kind of task to weight, default all immediate
+            - rate: float, target inserts per second, 0 inserts as fast
+                    as `concurrency` allows
+            - concurrency: integer, threads inserting concurrently
+            - countdown: tuple, range of countdown of delayed tasks
+            - schedule_interval: integer, seconds between runs of
+                                 scheduled tasks
+
+        """
+        self.client = client
+        self.sink = sink
+        self.mix = mix or {'immediate': 1.0}
+        self.rate = rate
+        self.concurrency = concurrency
+        self.countdown = countdown
+        self.schedule_interval = schedule_interval
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.errors = 0
+        self.expected = set()
+        self.cnames = []
+        self._sent = 0
+        self._kinds = sorted(self.mix.items())
+
+    def _choose(self):
+        total = sum(weight for _, weight in self._kinds)
+        point = random.uniform(0, total)
+        for kind, weight in self._kinds:
+            point -= weight
+            if point <= 0:
+                break
+        return kind
+
+    def _sink_url(self, kind, seq, due=None):
+        url = '{0}?kind={1}&task={2}'.format(self.sink.url, kind, seq)
+        if due is not None:
+            url += '&due={0:.6f}'.format(due)
+        return url
+
+    def _insert(self, seq):
+        kind = self._choose()
+        now = time.time()
+        kwargs = {}
+        expected = [(kind, str(seq))]
+        if kind == 'immediate':
+            url = self._sink_url(kind, seq, now)
+        elif kind == 'delayed':
+            countdown = random.uniform(*self.countdown)
+            kwargs['countdown'] = countdown
+            url = self._sink_url(kind, seq, now + countdown)
+        elif kind == 'scheduled':
+            # runs are not due at a known time, only counted, and only
+            # the first one is waited for
+            url = self._sink_url(kind, seq)
+            kwargs['cname'] = 'asynx-bench-{0}-{1:.0f}'.format(seq, now)
+            kwargs['schedule'] = 'every {0} seconds'.format(
+                self.schedule_interval)
+        else:
+            # the callback is due when its parent was
+            url = self._sink_url('immediate', seq, now)
+            kwargs['on_success'] = self.client.task(
+                url=self._sink_url(kind, seq, now), method='POST')
+            expected.append(('immediate', str(seq)))
+        start = time.time()
+        try:
+            self.client.add_task(url=url, **kwargs)
+        except Exception:
+            with self.lock:
+                self.errors += 1
+            return
+        elapsed = time.time() - start
+        with self.lock:
+            self.latencies.append(elapsed)
+            self.expected.update(expected)
+            if 'cname' in kwargs:
+                self.cnames.append(kwargs['cname'])
+
+    def _worker(self, start, deadline):
+        while True:
+            with self.lock:
+                seq = self._sent
+                self._sent += 1
+            if self.rate:
+                at = start + seq / float(self.rate)
+                if at >= deadline:
+                    return
+                delay = at - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            elif time.time() >= deadline:
+                return
+            self._insert(seq)
+
+    def outstanding(self):
+        """the number of inserted tasks whose request did not arrive yet,
+        callbacks of chained tasks and first runs of scheduled ones
+        included"""
+        with self.lock:
+            expected = set(self.expected)
+        with self.sink.lock:
+            return len(expected - self.sink.runs)
+
+    def run(self, duration, drain=30):
+        """generating load for `duration` seconds, then waiting at most
+        `drain` seconds until no task is outstanding
+
+        Returns:
+            dict of the report
+
+        """
+        start = time.time()
+        deadline = start + duration
+        threads = [threading.Thread(target=self._worker,
+                                    args=(start, deadline))
+                   for i in range(self.concurrency)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+        inserted = time.time()
+        drain_deadline = inserted + drain
+        while self.outstanding() and time.time() < drain_deadline:
+            time.sleep(0.1)
+        for cname in self.cnames:
+            try:
+                self.client.delete_task(cname=cname)
+            except Exception:
+                pass
+        return self.report(start, inserted)
+
+    def report(self, start, inserted):
+        with self.sink.lock:
+            arrivals = list(self.sink.arrivals)
+            lags = list(self.sink.lags)
+            kinds = dict(self.sink.kinds)
+        pending = self.outstanding()
+        completed = len(arrivals)
+        seconds = (max(arrivals) - start) if arrivals else 0
+        return {
+            'inserted': len(self.latencies),
+            'insert_errors': self.errors,
+            'insert_rate': len(self.latencies) / (inserted - start),
+            'insert_latency': percentiles(self.latencies),
+            'completed': completed,
+            'completed_by_kind': kinds,
+            'pending': pending,
+            'completion_rate': completed / seconds if seconds else 0.0,
+            'dispatch_lag': percentiles(lags)}
+
+
+def format_report(report):
+    """formatting a report of `LoadGenerator.run` as lines"""
+
+    def ms(values):
+        return ' '.join('{0}={1:.1f}ms'.format(key, values[key] * 1000)
+                        for key in sorted(values)) or '-'
+
+    return [
+        'inserted:        {0} ({1} errors), {2:.1f}/s'.format(
+            report['inserted'], report['insert_errors'],
+            report['insert_rate']),
+        'insert latency:  {0}'.format(ms(report['insert_latency'])),
+        'completed:       {0} ({1} pending), {2:.1f}/s'.format(
+            report['completed'], report['pending'],
+            report['completion_rate']),
+        'by kind:         {0}'.format(' '.join(
+            '{0}={1}'.format(kind, count)
+            for kind, count in sorted(report['completed_by_kind'].items()))
+            or '-'),
+        'dispatch lag:    {0}'.format(ms(report['dispatch_lag']))]
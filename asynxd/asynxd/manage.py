@@ -209,6 +209,150 @@ def reload():
     say_ok()
 
 
+@manager.option('-k', '--kind', dest='kind', default='cpu',
+                help='cpu or memory')
+@manager.option('-s', '--seconds', dest='seconds', type=int, default=30)
+@manager.option('-t', '--target', dest='target', default='all',
+                help='asynxd, celery or all')
+def profile(kind, seconds, target):
+    """Profiling running asynxd and celery processes"""
+    from . import forms
+    from .apis import profiler
+    form = forms.profile_form(
+        {'kind': kind, 'seconds': seconds, 'target': target})
+    req = profiler.request(**form)
+    print('Profiling {0} processes for {1} seconds, the profiles will be '
+          'written to "{2}"'.format(req['target'], req['seconds'],
+                                    req['directory']))
+    say_ok()
+
+
+def _servers():
+    """the redis servers storing tasks, with their addresses, every
+    shard if sharding"""
+    from asynx_core.backends import ShardedRedisBackend
+    from .apis import redisconn, backend
+    if not isinstance(backend, ShardedRedisBackend):
+        return [(None, redisconn)]
+    servers = []
+    for shard in backend.shards:
+        kwargs = shard.redis.connection_pool.connection_kwargs
+        servers.append(('{0}:{1}/{2}'.format(
+            kwargs.get('host'), kwargs.get('port'), kwargs.get('db')),
+            shard.redis))
+    return servers
+
+
+def _print_server(address):
+    if address is not None:
+        print('Server {0}:'.format(address))
+
+
+@manager.command
+def migrate_keys():
+    """Moving tasks stored in the key layout without hash tags, with
+    asynxd and celery stopped"""
+    from asynx_core.backends import (migrate_keys as migrate,
+                                     ShardedRedisBackend)
+    from .apis import backend
+    if not isinstance(backend, ShardedRedisBackend):
+        backend = None
+    for address, connection in _servers():
+        _print_server(address)
+        # each queue is moved to the server of its shard
+        for appname, queuename in migrate(connection, backend):
+            print('Migrated {0}:{1}'.format(appname, queuename))
+    say_ok()
+
+
+def _print_memory(connection):
+    from asynx_core.backends import memory_report as report
+    report = report(connection)
+    for name in ('full', 'compact'):
+        sampled = report[name]
+        if not sampled['sampled']:
+            continue
+        print('{0} encoding: {1:.0f} bytes per task, {2} sampled ({3})'
+              .format(name, sampled['bytes_per_task'], sampled['sampled'],
+                      ', '.join('{0} {1}'.format(encoding, count)
+                                for encoding, count
+                                in sorted(sampled['encodings'].items()))))
+    if report['cold']['tasks']:
+        print('cold tier: {0:.0f} bytes per task, {1} tasks'.format(
+            report['cold']['bytes_per_task'], report['cold']['tasks']))
+
+
+@manager.command
+def memory_report():
+    """Sampling the redis memory used per task"""
+    for address, connection in _servers():
+        _print_server(address)
+        _print_memory(connection)
+
+
+@manager.option('--expand', dest='expand', action='store_true',
+                default=False, help='moving back to the full encoding')
+def compact_keys(expand):
+    """Moving tasks to the compact encoding, with asynxd and celery
+    stopped, set ASYNX_REDIS_COMPACT=true before restarting them"""
+    from asynx_core.backends import compact_keys as migrate
+    for address, connection in _servers():
+        _print_server(address)
+        print('Before:')
+        _print_memory(connection)
+        for appname, queuename, moved in migrate(connection, not expand):
+            print('Moved {0} tasks of {1}:{2}'.format(moved, appname,
+                                                      queuename))
+        print('After:')
+        _print_memory(connection)
+    say_ok()
+
+
+@manager.option('-u', '--url', dest='url', default=None,
+                help='base URL of asynxd, default http://BIND')
+@manager.option('-a', '--app', dest='appname', default='asynx-bench')
+@manager.option('-m', '--mix', dest='mix', default='immediate',
+                help='weighted kinds of tasks, for example '
+                '"immediate=7,delayed=2,scheduled=0.1,chained=1"')
+@manager.option('-r', '--rate', dest='rate', type=float, default=0,
+                help='target inserts per second, 0 for unlimited')
+@manager.option('-c', '--concurrency', dest='concurrency', type=int,
+                default=4, help='threads inserting concurrently')
+@manager.option('-d', '--duration', dest='duration', type=float,
+                default=30, help='seconds of inserting')
+@manager.option('--drain', dest='drain', type=float, default=30,
+                help='maximum seconds waiting for tasks to complete')
+@manager.option('--sink', dest='sink', default='127.0.0.1:0',
+                help='address of the local sink receiving the tasks')
+def bench(url, appname, mix, rate, concurrency, duration, drain, sink):
+    """Load testing a running asynxd and its celery workers"""
+    try:
+        from asynx import TaskQueueClient
+    except ImportError:
+        print('the asynx client is required: pip install asynx',
+              file=sys.stderr)
+        return 1
+    from .loadgen import Sink, LoadGenerator, parse_mix, format_report
+    if url is None:
+        host, port = app.config['BIND'].rsplit(':', 1)
+        if host in ('0.0.0.0', ''):
+            host = '127.0.0.1'
+        url = 'http://{0}:{1}'.format(host, port)
+    host, port = sink.rsplit(':', 1)
+    sink = Sink(host, int(port)).start()
+    generator = LoadGenerator(TaskQueueClient(url, appname), sink,
+                              mix=parse_mix(mix), rate=rate,
+                              concurrency=concurrency)
+    print('Loading {0} for {1} seconds, sink at {2}'.format(
+        url, duration, sink.url))
+    try:
+        report = generator.run(duration, drain)
+    finally:
+        sink.stop()
+    for line in format_report(report):
+        print(line)
+
+
 def main():
     manager.run()
 
@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+
+import gc
+import os
+import sys
+import time
+import socket
+import threading
+from uuid import uuid4
+from collections import defaultdict
+
+import anyjson
+
+from asynx_core._util import not_bytes
+
+try:
+    import tracemalloc
+except ImportError:
+    # python 2, counting objects by type instead
+    tracemalloc = None
+
+CONTROL_KEY = 'AX:PROFILE'
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    return '{0}:{1}'.format(os.path.basename(code.co_filename), code.co_name)
+
+
+def sample_stacks(seconds, interval=0.005):
+    """sampling the stacks of all other threads for `seconds`
+
+    Returns:
+        a dict mapping collapsed stacks ("root;...;leaf") to sample counts
+
+    """
+    counts = defaultdict(int)
+    me = threading.current_thread().ident
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(_frame_name(frame))
+                frame = frame.f_back
+            stack.reverse()
+            counts[';'.join(stack)] += 1
+        time.sleep(interval)
+    return counts
+
+
+def top_allocations(seconds, limit=50):
+    """tracing allocations for `seconds`, or counting objects by type
+    before and after if tracemalloc is not available
+
+    Returns:
+        a list of lines
+
+    """
+    if tracemalloc is None:
+        before = _count_objects()
+        time.sleep(seconds)
+        after = _count_objects()
+        rows = sorted(after.items(), key=lambda i: i[1], reverse=True)
+        lines = ['# objects by type (count, growth in {0}s)'.format(seconds)]
+        for name, count in rows[:limit]:
+            lines.append('{0:>10} {1:>+10} {2}'.format(
+                count, count - before.get(name, 0), name))
+        return lines
+    started = not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start(25)
+    try:
+        before = tracemalloc.take_snapshot()
+        time.sleep(seconds)
+        after = tracemalloc.take_snapshot()
+    finally:
+        if started:
+            tracemalloc.stop()
+    lines = ['# top allocations (size, growth in {0}s)'.format(seconds)]
+    for stat in after.compare_to(before, 'lineno')[:limit]:
+        lines.append(str(stat))
+    return lines
+
+
+def _count_objects():
+    counts = defaultdict(int)
+    for obj in gc.get_objects():
+        counts[type(obj).__name__] += 1
+    return counts
+
+
+class Profiler(object):
+
+    def __init__(self, redis, directory, poll_interval=2.0):
+        """On-demand profiling of running processes
+
+        Every process calling `start` polls the control key in redis from
+        a daemon thread, and profiles itself once a request targeting its
+        role is set by `request`.
+
+        Parameters:
+            - redis: redis connection
+            - directory: string, where the profiles are written
+            - poll_interval: float, seconds between polls,
+                             0 disables polling
+
+        """
+        self.redis = redis
+        self.directory = directory
+        self.poll_interval = poll_interval
+        self.role = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._handled = None
+
+    def request(self, kind, seconds, target='all'):
+        """requesting processes to profile themselves
+
+        Parameters:
+            - kind: string, "cpu" or "memory"
+            - seconds: integer, how long to profile
+            - target: string, "asynxd", "celery" or "all"
+
+        Returns:
+            dict of the request
+
+        """
+        req = {'id': uuid4().hex, 'kind': kind,
+               'seconds': seconds, 'target': target,
+               'directory': self.directory}
+        # expiring once every process had a chance to see it
+        self.redis.set(CONTROL_KEY, anyjson.dumps(req),
+                       ex=int(self.poll_interval * 2 + 1))
+        return req
+
+    def start(self, role):
+        """starting the polling thread of this process
+
+        Parameters:
+            - role: string, "asynxd" or "celery"
+
+        """
+        with self._lock:
+            if not self.poll_interval or self._pid == os.getpid():
+                return
+            # the thread didn't survive forking, or never started
+            self._pid = os.getpid()
+            self.role = role
+            # requests set before the process started are ignored
+            self._handled = self._current_id()
+        thread = threading.Thread(target=self._poll, name='asynx-profiler')
+        thread.daemon = True
+        thread.start()
+
+    def _current_id(self):
+        try:
+            req = self.redis.get(CONTROL_KEY)
+        except Exception:
+            return None
+        return req and anyjson.loads(not_bytes(req))['id']
+
+    def _poll(self):
+        while True:
+            time.sleep(self.poll_interval)
+            try:
+                req = self.redis.get(CONTROL_KEY)
+            except Exception:
+                continue
+            if not req:
+                continue
+            req = anyjson.loads(not_bytes(req))
+            if req['id'] == self._handled or \
+                    req['target'] not in ('all', self.role):
+                continue
+            self._handled = req['id']
+            try:
+                self.run(req['kind'], req['seconds'])
+            except Exception:
+                pass  # never let profiling kill the process
+
+    def run(self, kind, seconds):
+        """profiling this process, blocking for `seconds`
+
+        Returns:
+            the path of the profile written, collapsed stacks for "cpu"
+            which can be rendered by flamegraph.pl, or the top
+            allocations for "memory"
+
+        """
+        try:
+            os.makedirs(self.directory)
+        except OSError:
+            pass
+        filename = '{0}-{1}-{2}-{3}-{4}.{5}'.format(
+            kind, self.role or 'process', socket.gethostname(), os.getpid(),
+            time.strftime('%Y%m%d%H%M%S'),
+            'folded' if kind == 'cpu' else 'txt')
+        path = os.path.join(self.directory, filename)
+        if kind == 'cpu':
+            counts = sample_stacks(seconds)
+            lines = ['{0} {1}'.format(stack, count)
+                     for stack, count in sorted(counts.items())]
+        else:
+            lines = top_allocations(seconds)
+        with open(path, 'w') as fp:
+            fp.write('\n'.join(lines) + '\n')
+        return path
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class ColdPromoter(object):
+
+    def __init__(self, taskqueue_class, backend, interval=60.0,
+                 limit=1000):
+        """Promoting cold tasks as they come within the cold horizon
+
+        Every process calling `start` runs a daemon thread moving the
+        cold tasks due within the horizon of the backend into the hot
+        tier and sending them to celery. A task stays due until its
+        message is sent, a promoter dying in between leaves it to the
+        next promotion, sent again with the same uuid.
+
+        Parameters:
+            - taskqueue_class: TaskQueue class the promoted tasks are
+                               dispatched from
+            - backend: storage backend with a cold horizon
+            - interval: float, seconds between promotions,
+                        0 disables the thread
+            - limit: integer, maximum tasks promoted at once
+
+        """
+        self.taskqueue_class = taskqueue_class
+        self.backend = backend
+        self.interval = interval
+        self.limit = limit
+        self._pid = None
+        self._lock = threading.Lock()
+
+    thread_name = 'asynx-promoter'
+
+    def enabled(self):
+        return bool(self.interval and self.backend.cold_horizon)
+
+    def start(self):
+        """starting the promoting thread of this process"""
+        with self._lock:
+            if not self.enabled() or self._pid == os.getpid():
+                return
+            # the thread didn't survive forking, or never started
+            self._pid = os.getpid()
+        thread = threading.Thread(target=self._loop, name=self.thread_name)
+        thread.daemon = True
+        thread.start()
+
+    def _loop(self):
+        while True:
+            time.sleep(self.interval)
+            self._run()
+
+    def _run(self):
+        try:
+            self.run()
+        except Exception:
+            logger.exception('%s failed', self.thread_name)
+
+    def run(self):
+        """promoting every cold task due within the horizon
+
+        Returns:
+            integer, count of promoted tasks
+
+        """
+        total = 0
+        while True:
+            count = self.taskqueue_class.promote_cold_tasks(
+                self.backend, self.limit)
+            total += count
+            if count < self.limit:
+                return total
+
+
+class TaskRecoverer(ColdPromoter):
+
+    thread_name = 'asynx-recoverer'
+
+    def __init__(self, taskqueue_class, backend, interval=300.0,
+                 grace=600.0, limit=1000):
+        """Sending again the messages of tasks a durable backend outlived
+
+        The stored new, delayed and scheduled tasks due more than `grace`
+        seconds ago are sent again when the thread starts, then every
+        `interval` seconds, in case their messages were lost with the
+        broker.
+
+        Parameters:
+            - taskqueue_class: TaskQueue class the tasks are dispatched from
+            - backend: storage backend, only a durable one is recovered
+            - interval: float, seconds between recoveries,
+                        0 disables the thread
+            - grace: float, seconds a task may wait in the broker
+            - limit: integer, maximum tasks recovered at once
+
+        """
+        super(TaskRecoverer, self).__init__(taskqueue_class, backend,
+                                            interval, limit)
+        self.grace = grace
+
+    def enabled(self):
+        return bool(self.interval and self.backend.durable)
+
+    def _loop(self):
+        # the tasks left by the previous run of the node first
+        self._run()
+        super(TaskRecoverer, self)._loop()
+
+    def run(self):
+        """recovering every stale task
+
+        Returns:
+            integer, count of recovered tasks
+
+        """
+        total = 0
+        while True:
+            count = self.taskqueue_class.recover_tasks(
+                self.backend, self.grace, self.limit)
+            total += count
+            if count < self.limit:
+                return total
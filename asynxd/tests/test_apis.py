@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
 
+import gzip
+from io import BytesIO
 from datetime import datetime
 from unittest import TestCase
 
@@ -15,6 +17,7 @@ from asynxd import apis
 class ApisTestCase(TestCase):
 
     def setUp(self):
+        apis.metrics.flush()
         apis.redisconn.flushdb()
         self.conn1 = redis.StrictRedis(db=1)
         self.conn1.delete('celery')
@@ -30,6 +33,72 @@ class ApisTestCase(TestCase):
         self.conn1.delete('celery')
         apis.redisconn.flushdb()
 
+    def test_replica_reads(self):
+        tq = apis.TaskQueue('test')
+        self.assertFalse(tq.replica_reads)
+        self.app.config['REDIS_REPLICAS'] = ['127.0.0.1:6380']
+        try:
+            self.assertTrue(tq.replica_reads)
+            with self.app.test_request_context(
+                    headers={'X-Asynx-Consistency': 'primary'}):
+                self.assertFalse(tq.replica_reads)
+        finally:
+            self.app.config['REDIS_REPLICAS'] = []
+
+    def test_metrics(self):
+        rv = self.client.post(
+            '/apps/test/taskqueues/default/tasks',
+            data=anyjson.dumps({'request': {'url': 'http://httpbin.org/get'},
+                                'countdown': 100}))
+        self.assertEqual(rv.status_code, 201)
+        rv = self.client.get('/metrics')
+        self.assertEqual(rv.status_code, 200)
+        self.assertTrue(rv.headers['Content-Type'].startswith('text/plain'))
+        lines = rv.data.decode('utf-8').splitlines()
+        self.assertIn('# TYPE asynx_operation_seconds histogram', lines)
+        self.assertIn('asynx_operation_seconds_count{op="add_task"} 1', lines)
+        self.assertIn('asynx_backlog_tasks{app="test",queue="default"} 1',
+                      lines)
+
+    def test_get_timelines(self):
+        rv = self.client.get('/apps/test/taskqueues/default/timelines')
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(anyjson.loads(rv.data),
+                         {'slowest': [], 'percentiles': {}, 'samples': 0})
+
+    def test_request_profile(self):
+        data = anyjson.dumps({'kind': 'cpu', 'seconds': 5})
+        rv = self.client.post('/debug/profile', data=data)
+        self.assertEqual(rv.status_code, 403)
+        self.app.config['DEBUG_TOKEN'] = 'secret'
+        try:
+            rv = self.client.post('/debug/profile', data=data,
+                                  headers={'X-Asynx-Debug-Token': 'wrong'})
+            self.assertEqual(rv.status_code, 403)
+            self.assertEqual(anyjson.loads(rv.data)['error_code'], 200102)
+            headers = {'X-Asynx-Debug-Token': 'secret'}
+            rv = self.client.post('/debug/profile', headers=headers,
+                                  data=anyjson.dumps({'kind': 'disk'}))
+            self.assertEqual(rv.status_code, 422)
+            rv = self.client.post('/debug/profile', data=data,
+                                  headers=headers)
+            self.assertEqual(rv.status_code, 202)
+            req = anyjson.loads(rv.data)
+            self.assertEqual((req['kind'], req['seconds'], req['target']),
+                             ('cpu', 5, 'all'))
+            self.assertEqual(req['directory'],
+                             self.app.config['PROFILE_DIR'])
+            self.assertTrue(apis.redisconn.exists('AX:PROFILE'))
+        finally:
+            self.app.config['DEBUG_TOKEN'] = ''
+
+    def test_compare_digest(self):
+        # the fallback of pythons without hmac.compare_digest
+        self.assertTrue(apis._compare_digest(b'secret', b'secret'))
+        self.assertFalse(apis._compare_digest(b'secret', b'secreT'))
+        self.assertFalse(apis._compare_digest(b'secret', b'secrets'))
+        self.assertFalse(apis._compare_digest(b'', b'secret'))
+
     def test_list_tasks(self):
         with self.app.app_context():
             tq = apis.TaskQueue('test')
@@ -130,6 +199,226 @@ class ApisTestCase(TestCase):
         self.assertEqual(task['eta'], eta_expect)
         self.assertTrue(isinstance(task['countdown'], float))
 
+    def test_gzip_insert(self):
+        payload = anyjson.dumps({'lines': ['line {0}'.format(i)
+                                           for i in range(500)]})
+        task_dict = {'request': {'url': 'http://httpbin.org/post',
+                                 'method': 'POST', 'payload': payload},
+                     'countdown': 100}
+        body = BytesIO()
+        with gzip.GzipFile(fileobj=body, mode='wb') as fp:
+            fp.write(anyjson.dumps(task_dict).encode('utf-8'))
+        url = '/apps/test/taskqueues/default/tasks'
+        # opted in, off by default
+        self.assertEqual(apis.TaskQueue.compress_threshold, None)
+        apis.TaskQueue.compress_threshold = 1024
+        try:
+            rv = self.client.post(url, data=body.getvalue(),
+                                  headers={'Content-Encoding': 'gzip'})
+        finally:
+            apis.TaskQueue.compress_threshold = None
+        self.assertEqual(rv.status_code, 201)
+        task = anyjson.loads(rv.data)
+        self.assertEqual(task['request']['payload'], payload)
+        # stored compressed past COMPRESS_THRESHOLD
+        stored = apis.redisconn.hget('AX:META:{test:default}:1', 'request')
+        self.assertTrue(b'$compressed' in stored)
+        rv = self.client.get(url + '/1')
+        self.assertEqual(anyjson.loads(rv.data)['request']['payload'],
+                         payload)
+        rv = self.client.post(url, data=b'not gzip',
+                              headers={'Content-Encoding': 'gzip'})
+        self.assertEqual(anyjson.loads(rv.data)['error_code'], 200100)
+
+    def test_templates(self):
+        url = '/apps/test/taskqueues/default/templates'
+        rv = self.client.get(url + '/webhook')
+        self.assertEqual(rv.status_code, 404)
+        self.assertEqual(anyjson.loads(rv.data)['error_code'], 207205)
+        rv = self.client.put(url + '/webhook', data=anyjson.dumps(
+            {'request': {'method': 'post'}}))
+        self.assertEqual(rv.status_code, 422)
+        template = {'request': {'url': 'http://httpbin.org/post',
+                                'method': 'POST',
+                                'headers': {'Authorization': 'token'}},
+                    'on_failure': None}
+        rv = self.client.put(url + '/webhook',
+                             data=anyjson.dumps(template))
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(anyjson.loads(rv.data)['version'], 1)
+        rv = self.client.put(url + '/webhook',
+                             data=anyjson.dumps(template))
+        self.assertEqual(anyjson.loads(rv.data)['version'], 2)
+        rv = self.client.get(url)
+        items = anyjson.loads(rv.data)['items']
+        self.assertEqual([(t['name'], t['version']) for t in items],
+                         [('webhook', 2)])
+        self.assertEqual(items[0]['request'], template['request'])
+        # tasks only store their overrides
+        tasks_url = '/apps/test/taskqueues/default/tasks'
+        rv = self.client.post(tasks_url, data=anyjson.dumps(
+            {'template': 'webhook', 'request': {'payload': '{"id": 1}'},
+             'countdown': 100}))
+        self.assertEqual(rv.status_code, 201)
+        task = anyjson.loads(rv.data)
+        self.assertEqual(task['template'], 'webhook')
+        self.assertEqual(task['request'], {'payload': '{"id": 1}'})
+        rv = self.client.post(tasks_url, data=anyjson.dumps(
+            {'template': 'unknown', 'request': {}}))
+        self.assertEqual(rv.status_code, 404)
+        rv = self.client.post(tasks_url, data=anyjson.dumps(
+            {'template': 'webhook', 'request': {'url': 'ftp://a/'}}))
+        self.assertEqual(rv.status_code, 422)
+        rv = self.client.delete(url + '/webhook')
+        self.assertEqual(rv.status_code, 200)
+        rv = self.client.delete(url + '/webhook')
+        self.assertEqual(rv.status_code, 404)
+
+    def test_fanout(self):
+        url = '/apps/test/taskqueues/default/tasks'
+        targets = ['http://httpbin.org/post', 'https://httpbin.org/post',
+                   'http://httpbin.org/post']
+        rv = self.client.post(url, data=anyjson.dumps(
+            {'request': {'method': 'POST', 'payload': '{"event": 1}'},
+             'targets': targets, 'countdown': 100}))
+        self.assertEqual(rv.status_code, 201)
+        task = anyjson.loads(rv.data)
+        self.assertEqual(task['fanout'], 2)
+        self.assertFalse('url' in task['request'])
+        rv = self.client.get(url + '/{0}'.format(task['id']))
+        self.assertEqual(anyjson.loads(rv.data)['fanout'], 2)
+        for data in ({'request': {}, 'targets': []},
+                     {'request': {}, 'targets': ['ftp://a/']},
+                     {'request': {}, 'targets': targets, 'cname': 'fan',
+                      'schedule': 'every 30 seconds'}):
+            rv = self.client.post(url, data=anyjson.dumps(data))
+            self.assertEqual(rv.status_code, 422)
+
+    def test_coalesce(self):
+        url = '/apps/test/taskqueues/default/tasks'
+        rv = self.client.post(url, data=anyjson.dumps(
+            {'request': {'method': 'POST', 'url': 'http://httpbin.org/post',
+                         'payload': '{"event": 1}'},
+             'coalesce': True, 'countdown': 100}))
+        self.assertEqual(rv.status_code, 201)
+        self.assertTrue(anyjson.loads(rv.data)['coalesce'])
+        self.assertEqual(apis.TaskQueue('test').coalesce_linger,
+                         apis.app.config['COALESCE_LINGER'])
+
+    def test_idempotency_key(self):
+        url = '/apps/test/taskqueues/default/tasks'
+        data = {'request': {'method': 'POST', 'url': 'http://httpbin.org/post',
+                            'payload': '{"order": 42}'},
+                'countdown': 100, 'idempotency_key': 'order-42'}
+        rv = self.client.post(url, data=anyjson.dumps(data))
+        self.assertEqual(rv.status_code, 201)
+        task = anyjson.loads(rv.data)
+        rv = self.client.post(url, data=anyjson.dumps(data))
+        retried = anyjson.loads(rv.data)
+        self.assertEqual((retried['id'], retried['uuid']),
+                         (task['id'], task['uuid']))
+        rv = self.client.get(url)
+        self.assertEqual(anyjson.loads(rv.data)['total'], 1)
+        data['idempotency_key'] = 'x' * 257
+        rv = self.client.post(url, data=anyjson.dumps(data))
+        self.assertEqual(rv.status_code, 422)
+        self.assertEqual(apis.TaskQueue('test').dedupe_window,
+                         apis.app.config['DEDUPE_WINDOW'])
+
+    def test_groups(self):
+        url = '/apps/test/taskqueues/default/groups'
+        rv = self.client.post(url, data=anyjson.dumps(
+            {'tasks': [{'request': {'url': 'http://httpbin.org/get'},
+                        'countdown': 100},
+                       {'request': {'url': 'http://httpbin.org/post',
+                                    'method': 'POST'}, 'countdown': 100}],
+             'on_complete': 'http://httpbin.org/post'}))
+        self.assertEqual(rv.status_code, 201)
+        group = anyjson.loads(rv.data)
+        self.assertEqual([task['group'] for task in group['tasks']],
+                         [group['group']] * 2)
+        rv = self.client.get(url + '/' + group['group'])
+        self.assertEqual(anyjson.loads(rv.data),
+                         {'group': group['group'], 'total': 2, 'left': 2,
+                          'results': {}})
+        rv = self.client.delete('/apps/test/taskqueues/default/tasks/{0}'
+                                .format(group['tasks'][0]['id']))
+        rv = self.client.get(url + '/' + group['group'])
+        self.assertEqual(anyjson.loads(rv.data)['left'], 1)
+        rv = self.client.get(url + '/unknown')
+        self.assertEqual(rv.status_code, 404)
+        self.assertEqual(anyjson.loads(rv.data)['error_code'], 207206)
+        for data in ({'tasks': []},
+                     {'tasks': [{'request': {'url': 'ftp://a/'}}]},
+                     {'tasks': [{'request': {'url': 'http://a/'},
+                                 'cname': 'grouped',
+                                 'schedule': 'every 30 seconds'}]}):
+            rv = self.client.post(url, data=anyjson.dumps(data))
+            self.assertEqual(rv.status_code, 422)
+
+    def test_bulk_insert_tasks(self):
+        rv = self.client.post(
+            '/apps/test/taskqueues/default/tasks/bulk',
+            data=anyjson.dumps({'tasks': []}))
+        self.assertEqual(rv.status_code, 422)
+        tasks = [
+            {'request': {'url': 'http://httpbin.org/get'},
+             'cname': 'bulktask'},
+            {'request': {'url': 'ftp://httpbin.org/get'}},
+            {'request': {'url': 'http://httpbin.org/post',
+                         'method': 'POST'},
+             'cname': 'bulktask'},
+            {'request': {'url': 'http://httpbin.org/get'},
+             'countdown': 10}
+        ]
+        rv = self.client.post(
+            '/apps/test/taskqueues/default/tasks/bulk',
+            data=anyjson.dumps({'tasks': tasks}))
+        self.assertEqual(rv.status_code, 200)
+        items = anyjson.loads(rv.data)['items']
+        self.assertEqual(len(items), 4)
+        self.assertEqual(items[0]['id'], 1)
+        self.assertEqual(items[0]['cname'], 'bulktask')
+        self.assertEqual(items[1]['error_code'], 200101)
+        self.assertEqual(items[2]['error_code'], 207203)
+        self.assertEqual(items[3]['id'], 2)
+        self.assertEqual(items[3]['status'], 'delayed')
+        with self.app.app_context():
+            self.assertEqual(apis.TaskQueue('test').count_tasks(), 2)
+
+    def test_admission(self):
+        url = '/apps/test/taskqueues/default/tasks'
+        task = anyjson.dumps({'request': {'url': 'http://httpbin.org/get'}})
+        saved = dict((key, self.app.config[key]) for key in (
+            'QUEUE_MAX_BACKLOG', 'ADMISSION_OVERRIDES', 'BACKLOG_RETRY_AFTER'))
+        self.app.config.update({
+            'QUEUE_MAX_BACKLOG': 3,
+            'ADMISSION_OVERRIDES': {'test:limited': {'QUEUE_RATE_LIMIT': 0.1,
+                                                     'QUEUE_RATE_BURST': 2}},
+            'BACKLOG_RETRY_AFTER': 12})
+        try:
+            for i in range(3):
+                rv = self.client.post(url, data=task)
+                self.assertEqual(rv.status_code, 201)
+            rv = self.client.post(url, data=task)
+            self.assertEqual(rv.status_code, 429)
+            self.assertEqual(rv.headers['Retry-After'], '12')
+            self.assertEqual(anyjson.loads(rv.data)['error_code'], 207204)
+            rv = self.client.post(
+                url + '/bulk', data=anyjson.dumps({'tasks': [{
+                    'request': {'url': 'http://httpbin.org/get'}}]}))
+            self.assertEqual(rv.status_code, 429)
+
+            url = '/apps/test/taskqueues/limited/tasks'
+            for i in range(2):
+                rv = self.client.post(url, data=task)
+                self.assertEqual(rv.status_code, 201)
+            rv = self.client.post(url, data=task)
+            self.assertEqual(rv.status_code, 429)
+            self.assertTrue(0 < int(rv.headers['Retry-After']) <= 10)
+        finally:
+            self.app.config.update(saved)
+
     def test_get_task(self):
         with self.app.app_context():
             tq = apis.TaskQueue('test')
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+
+import json
+import shutil
+import os.path
+import tempfile
+from datetime import datetime
+from unittest import TestCase
+
+import redis
+from pytz import utc
+from flask import Flask
+from celery import schedules
+
+from asynx_core import backends
+from asynxd import engines
+
+
+class EnginesTestCase(TestCase):
+
+    def make_json(self, backend):
+        app = Flask('test')
+        app.config['JSON_BACKEND'] = backend
+        return engines.make_json(app)
+
+    def test_make_json(self):
+        self.assertTrue(self.make_json('auto').name in
+                        ('orjson', 'simplejson', 'json'))
+        jsonlib = self.make_json('json')
+        self.assertEqual(jsonlib.name, 'json')
+        self.assertRaises(ValueError, self.make_json, 'unknown')
+        self.assertRaises(ValueError, jsonlib.loads, '{"a":')
+
+    def test_json_dumps(self):
+        jsonlib = self.make_json('auto')
+        obj = {'eta': utc.localize(datetime(2014, 3, 14, 15, 9, 26, 535898)),
+               'schedule': schedules.crontab('*/10', '1,2-10'),
+               'every': schedules.schedule(30)}
+        self.assertEqual(json.loads(jsonlib.dumps(obj)), {
+            'eta': '2014-03-14T15:09:26.535898+00:00',
+            'schedule': '*/10 1,2-10 * * *',
+            'every': 'every 30.0 seconds'})
+        self.assertRaises(TypeError, jsonlib.dumps, {'a': object()})
+
+    def make_backend(self, **config):
+        app = Flask('test')
+        app.config.update(config)
+        return engines.make_backend(app, redis.StrictRedis())
+
+    def test_make_backend(self):
+        backend = self.make_backend()
+        self.assertTrue(isinstance(backend, backends.RedisBackend))
+        self.assertEqual((backend.ids, backend.replicas), (None, []))
+        backend = self.make_backend(TASK_IDS='snowflake',
+                                    REDIS_REPLICAS=['127.0.0.1:6380'],
+                                    REPLICA_MAX_LAG=1.5)
+        self.assertTrue(backend.ids is not None)
+        self.assertEqual(backend.replicas[0].connection_pool
+                         .connection_kwargs['port'], 6380)
+        self.assertEqual(backend.max_lag, 1.5)
+        self.assertEqual(backend.cold_horizon, None)
+        self.assertFalse(backend.compact)
+        backend = self.make_backend(REDIS_SHARDING=True,
+                                    REDIS_SHARDS=['127.0.0.1:6380'],
+                                    COLD_HORIZON=86400.0, REDIS_COMPACT=True)
+        self.assertEqual(len(backend.shards), 2)
+        self.assertEqual(backend.cold_horizon, 86400.0)
+        self.assertTrue(backend.shards[1].compact)
+        backend = self.make_backend(REDIS_SHARDING=True,
+                                    REDIS_SHARDS=['127.0.0.1:6380'],
+                                    REDIS_REPLICAS=[[], ['127.0.0.1:6381']],
+                                    REPLICA_MAX_LAG=1.5)
+        self.assertEqual(backend.shards[0].replicas, [])
+        self.assertEqual(backend.shards[1].replicas[0].connection_pool
+                         .connection_kwargs['port'], 6381)
+        self.assertEqual(backend.shards[1].max_lag, 1.5)
+        # a flat list can't tell the server of each replica
+        self.assertRaises(ValueError, self.make_backend, REDIS_SHARDING=True,
+                          REDIS_SHARDS=['127.0.0.1:6380'],
+                          REDIS_REPLICAS=['127.0.0.1:6381'])
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        backend = self.make_backend(
+            STORAGE_BACKEND='sqlite',
+            SQLITE_PATH=os.path.join(directory, 'asynx.db'))
+        self.assertTrue(isinstance(backend, backends.SqliteBackend))
+        self.assertRaises(ValueError, self.make_backend,
+                          STORAGE_BACKEND='unknown')
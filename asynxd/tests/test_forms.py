@@ -76,3 +76,141 @@ class FormsTestCase(TestCase):
         expect['eta'] = pytz.timezone('Asia/Shanghai').localize(
             datetime(2014, 3, 14, 15, 9, 26, 535898))
         self.assertEqual(_form(data), expect)
+
+    def test_template_task_form(self):
+        _form = forms.add_task_form
+
+        data = {'template': 'webhook'}
+        self.assertEqual(_form(data), {'template': 'webhook',
+                                       'request': {}})
+
+        data['request'] = {'payload': '{}', 'headers': {'X-Id': '1'}}
+        self.assertEqual(_form(data)['request'], data['request'])
+
+        data['request']['url'] = 'ftp://example.com'
+        self.assertRaises(MultipleInvalid, _form, data)
+
+        template = {'request': {'method': 'post'}}
+        self.assertRaises(MultipleInvalid, forms.template_form, template)
+        template['request']['url'] = 'http://httpbin.org/post'
+        self.assertEqual(forms.template_form(template)['request'],
+                         {'method': 'POST',
+                          'url': 'http://httpbin.org/post'})
+
+    def test_fanout_task_form(self):
+        _form = forms.add_task_form
+
+        data = {'targets': ['http://httpbin.org/post']}
+        self.assertEqual(_form(data), {'targets': data['targets'],
+                                       'request': {'method': 'GET'}})
+
+        data['targets'].append('ftp://example.com')
+        self.assertRaises(MultipleInvalid, _form, data)
+
+        data['targets'].pop()
+        data.update(cname='fan', schedule='every 30 seconds')
+        self.assertRaises(MultipleInvalid, _form, data)
+
+    def test_coalesce_task_form(self):
+        _form = forms.add_task_form
+
+        data = {'request': {'url': 'http://httpbin.org/post'},
+                'coalesce': True}
+        self.assertEqual(_form(data)['coalesce'], True)
+
+        data['coalesce'] = 'yes'
+        self.assertRaises(MultipleInvalid, _form, data)
+
+        data.update(coalesce=True, cname='coalesced',
+                    schedule='every 30 seconds')
+        self.assertRaises(MultipleInvalid, _form, data)
+
+    def test_idempotency_key_form(self):
+        data = {'request': {'url': 'http://httpbin.org/post'},
+                'idempotency_key': 'order-42'}
+        self.assertEqual(forms.add_task_form(data)['idempotency_key'],
+                         'order-42')
+        self.assertEqual(forms.add_task_schema(data)['idempotency_key'],
+                         'order-42')
+        for key in ('', 'x' * 257, 42):
+            data['idempotency_key'] = key
+            self.assertRaises(MultipleInvalid, forms.add_task_form, data)
+            self.assertRaises(MultipleInvalid, forms.add_task_schema, data)
+
+    def test_group_form(self):
+        _form = forms.group_form
+
+        data = {'tasks': [{'request': {'url': 'http://httpbin.org/get'}},
+                          {'request': {'url': 'http://httpbin.org/post',
+                                       'method': 'post'}}],
+                'on_success': 'http://httpbin.org/post'}
+        group = _form(data)
+        self.assertEqual(group['tasks'][1]['request']['method'], 'POST')
+        self.assertEqual(group['on_success'], 'http://httpbin.org/post')
+
+        data['tasks'].append({'request': {'url': 'ftp://example.com'}})
+        try:
+            _form(data)
+        except MultipleInvalid as e:
+            self.assertEqual(e.errors[0].path,
+                             ['tasks', 2, 'request', 'url'])
+        else:
+            self.fail('an invalid task passed')
+
+        data['tasks'][2] = {'request': {'url': 'http://httpbin.org/get'},
+                            'cname': 'grouped',
+                            'schedule': 'every 30 seconds'}
+        self.assertRaises(MultipleInvalid, _form, data)
+        data['tasks'][2] = {'request': {'url': 'http://httpbin.org/get'},
+                            'idempotency_key': 'o-42'}
+        try:
+            _form(data)
+        except MultipleInvalid as e:
+            self.assertEqual(e.errors[0].path,
+                             ['tasks', 2, 'idempotency_key'])
+        else:
+            self.fail('a task with an idempotency key passed')
+        self.assertRaises(MultipleInvalid, _form, {'tasks': []})
+        self.assertRaises(MultipleInvalid, _form, {})
+
+    def test_add_task_form_equivalence(self):
+
+        def validate(form, data):
+            try:
+                return form(data)
+            except MultipleInvalid as e:
+                return [str(err) for err in e.errors]
+
+        chained = {'request': {'url': 'http://httpbin.org/get'}}
+        for i in range(5):
+            chained = {'request': {'url': 'http://httpbin.org/post',
+                                   'method': 'post'},
+                       'on_complete': chained}
+        cases = [
+            None, [], {}, {'request': None}, {'request': {}},
+            {'request': {'url': 'ftp://example.com'}},
+            {'request': {'url': 42, 'extra': 1}, 'bogus': 1},
+            {'request': {'url': 'http://httpbin.org', 'method': 'post',
+                         'headers': {'X-A': 'b', 123: 'c', 'X-C': 1},
+                         'payload': 1, 'timeout': 'a',
+                         'allow_redirects': 'yes'}},
+            {'request': {'url': 'http://httpbin.org', 'headers': 'a',
+                         'payload': None, 'timeout': '1.5',
+                         'allow_redirects': False}},
+            {'request': {'url': 'http://httpbin.org'}, 'cname': 1,
+             'countdown': -1, 'eta': 'noon', 'schedule': 'never'},
+            {'request': {'url': 'http://httpbin.org'}, 'cname': 'a',
+             'countdown': '42', 'eta': '2014-03-14 15:09:26.535898Z',
+             'schedule': 'every 30 seconds'},
+            {'request': {'url': 'http://httpbin.org'},
+             'on_success': 'ftp://example.com', 'on_failure': 42,
+             'on_complete': {}},
+            {'request': {'url': 'http://httpbin.org'},
+             'on_success': {'request': {'url': 'ftp://example.com'}},
+             'on_complete': {'request': {'url': 'http://httpbin.org'},
+                             'on_failure': {'countdown': -1}}},
+            chained
+        ]
+        for data in cases:
+            self.assertEqual(validate(forms.add_task_form, data),
+                             validate(forms.add_task_schema, data))
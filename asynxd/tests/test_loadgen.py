@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+
+import time
+import threading
+from unittest import TestCase
+
+import requests
+
+from asynxd.loadgen import Sink, LoadGenerator, format_report
+
+
+class InlineClient(object):
+    """dispatching tasks at once in another thread, as asynxd would"""
+
+    def __init__(self):
+        self.deleted = []
+
+    def task(self, url, method='GET', **kwargs):
+        return {'request': {'url': url, 'method': method}}
+
+    def add_task(self, url, countdown=None, on_success=None, **kwargs):
+
+        def dispatch():
+            if countdown:
+                time.sleep(countdown)
+            requests.get(url)
+            if on_success is not None:
+                requests.post(on_success['request']['url'])
+        threading.Thread(target=dispatch).start()
+        return {'id': 1}
+
+    def delete_task(self, cname):
+        self.deleted.append(cname)
+
+
+class LoadGeneratorTestCase(TestCase):
+
+    def setUp(self):
+        self.sink = Sink().start()
+
+    def tearDown(self):
+        self.sink.stop()
+
+    def test_run(self):
+        client = InlineClient()
+        generator = LoadGenerator(
+            client, self.sink, rate=50, concurrency=2, countdown=(0.2, 0.5),
+            mix={'immediate': 1, 'delayed': 1, 'chained': 1,
+                 'scheduled': 1})
+        report = generator.run(0.4, drain=5)
+        self.assertEqual(report['insert_errors'], 0)
+        self.assertEqual(report['inserted'], 20)
+        self.assertEqual(report['pending'], 0)
+        self.assertEqual(sorted(client.deleted), sorted(generator.cnames))
+        kinds = report['completed_by_kind']
+        self.assertEqual(kinds.get('chained', 0) +
+                         kinds.get('scheduled', 0) +
+                         kinds.get('delayed', 0) +
+                         kinds.get('immediate', 0), report['completed'])
+        self.assertEqual(report['completed'],
+                         20 + kinds.get('chained', 0))
+        self.assertTrue(report['dispatch_lag']['p99'] >= 0)
+        self.assertEqual(len(format_report(report)), 5)
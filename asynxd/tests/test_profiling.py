@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import shutil
+import tempfile
+import threading
+from unittest import TestCase
+
+import redis
+
+from asynxd.profiling import Profiler, CONTROL_KEY
+
+
+def busy_loop(seconds):
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+        sum(range(100))
+
+
+class ProfilingTestCase(TestCase):
+
+    def setUp(self):
+        self.conn1 = redis.StrictRedis(db=1)
+        self.conn1.flushdb()
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.conn1.flushdb()
+        shutil.rmtree(self.directory)
+
+    def test_run(self):
+        profiler = Profiler(self.conn1, self.directory)
+        thread = threading.Thread(target=busy_loop, args=(0.5, ))
+        thread.start()
+        path = profiler.run('cpu', 0.3)
+        thread.join()
+        self.assertTrue(os.path.basename(path).startswith('cpu-process-'))
+        with open(path) as fp:
+            stacks = fp.read().splitlines()
+        self.assertTrue(any('test_profiling.py:busy_loop' in line
+                            for line in stacks))
+        stack, count = stacks[0].rsplit(' ', 1)
+        self.assertTrue(int(count) > 0)
+        path = profiler.run('memory', 0.1)
+        with open(path) as fp:
+            self.assertTrue(fp.readline().startswith('#'))
+
+    def test_polling(self):
+        profiler = Profiler(self.conn1, self.directory, poll_interval=0.05)
+        # set before the process started, ignored
+        profiler.request('cpu', 1)
+        profiler.start('celery')
+        profiler.request('memory', 1, 'asynxd')
+        time.sleep(0.2)
+        self.assertEqual(os.listdir(self.directory), [])
+        req = profiler.request('memory', 1, 'celery')
+        self.assertEqual(req['directory'], self.directory)
+        self.assertTrue(self.conn1.ttl(CONTROL_KEY) > 0)
+        deadline = time.time() + 5
+        while not os.listdir(self.directory) and time.time() < deadline:
+            time.sleep(0.1)
+        profiles = os.listdir(self.directory)
+        self.assertEqual(len(profiles), 1)
+        self.assertTrue(profiles[0].startswith('memory-celery-'))
@@ -0,0 +1,56 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Benchmark of task validation in asynxd
+
+Compares the precompiled `forms.add_task_form` with the voluptuous
+`forms.add_task_schema` on a flat task and on chained tasks.
+
+Usage:
+    $ python benchmarks/bench_forms.py [number]
+
+"""
+from __future__ import print_function
+
+import sys
+import timeit
+
+from asynxd import forms
+
+
+def chained_task(depth):
+    task = {'request': {'url': 'http://httpbin.org/get'}}
+    for i in range(depth):
+        task = {
+            'request': {'method': 'post',
+                        'url': 'http://httpbin.org/post',
+                        'headers': {'Content-Type': 'application/json'},
+                        'payload': '{"asynx": "awesome!"}',
+                        'timeout': 30},
+            'cname': 'task{0}'.format(i),
+            'countdown': 42,
+            'on_success': task,
+            'on_failure': '__report__'}
+    return task
+
+
+def bench(number):
+    results = []
+    for depth in (0, 1, 3, 5):
+        task = chained_task(depth)
+        assert forms.add_task_form(task) == forms.add_task_schema(task)
+        for name in ('add_task_schema', 'add_task_form'):
+            validator = getattr(forms, name)
+            seconds = min(timeit.repeat(lambda: validator(task),
+                                        number=number, repeat=3))
+            results.append((depth, name, number / seconds))
+    return results
+
+
+def main():
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    print('{0:>5}  {1:<16} {2:>12}'.format('depth', 'validator', 'ops/s'))
+    for depth, name, ops in bench(number):
+        print('{0:>5}  {1:<16} {2:>12.0f}'.format(depth, name, ops))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,337 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Benchmark suite of asynx-core and asynxd
+
+Runs against a local redis-server and a local stub HTTP server, and
+stores the results as JSON so they can be compared across commits.
+
+The redis database is FLUSHED, use a dedicated one (default db 15), or
+let the suite spawn a throwaway redis-server with --redis-server.
+
+Benchmarks:
+    - add_task: inserts per second, plain, with cname, countdown and
+      schedule
+    - iter_tasks: tasks per second iterated by iter_tasks and
+      iter_tasks_json, at every scale of --scales
+    - dispatch: request_task end-to-end dispatches per second, against
+      the stub HTTP server
+    - rest: latency percentiles of inserting and listing tasks through
+      the Flask test client of asynxd
+
+Usage:
+    $ python benchmarks/bench_suite.py -o results.json
+    $ python benchmarks/bench_suite.py --scales 10000,100000,1000000 \\
+          --redis-server /usr/bin/redis-server -o results.json
+    $ python benchmarks/bench_suite.py -o new.json --compare results.json
+
+"""
+from __future__ import print_function
+
+import os
+import json
+import time
+import socket
+import platform
+import tempfile
+import threading
+import subprocess
+from optparse import OptionParser
+from timeit import default_timer
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+
+import redis
+from celery import Celery, schedules
+
+from asynx_core.metrics import percentiles
+from asynx_core.taskqueue import TaskQueue, Task, request_task
+
+
+class StubHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def _reply(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            self.rfile.read(length)
+        self.send_response(200)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'ok')
+
+    do_GET = do_POST = do_PUT = do_DELETE = _reply
+
+    def log_message(self, *args):
+        pass
+
+
+class StubServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def start_stub_server():
+    server = StubServer(('127.0.0.1', 0), StubHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server, 'http://127.0.0.1:{0}/'.format(server.server_port)
+
+
+def spawn_redis(binary):
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    workdir = tempfile.mkdtemp()
+    proc = subprocess.Popen(
+        [binary, '--port', str(port), '--bind', '127.0.0.1',
+         '--save', '', '--appendonly', 'no', '--dir', workdir],
+        stdout=open(os.devnull, 'w'))
+    conn = redis.StrictRedis(port=port)
+    for i in range(50):
+        try:
+            conn.ping()
+            break
+        except redis.ConnectionError:
+            time.sleep(0.1)
+    return proc, 'redis://127.0.0.1:{0}/15'.format(port)
+
+
+def latencies(samples):
+    # exact nearest-rank percentiles of the sorted samples, not the
+    # bucket interpolation histogram_quantile does over /metrics
+    return dict(('{0}_ms'.format(point), value * 1000)
+                for point, value in percentiles(samples).items())
+
+
+def ops(count, seconds):
+    return round(count / seconds, 1)
+
+
+class BenchTaskQueue(TaskQueue):
+
+    # tasks are pickled to celery with their class, so it's defined at
+    # module level and bound to the redis given by the command line
+    connection = None
+
+    def __init__(self, appname, queuename='default'):
+        super(BenchTaskQueue, self).__init__(appname, queuename)
+        self.bind_redis(self.connection)
+
+
+def bench_add_task(conn, url, number):
+    tq_class = BenchTaskQueue
+    variants = [
+        ('plain', lambda i: {}),
+        ('cname', lambda i: {'cname': 'task{0}'.format(i)}),
+        ('countdown', lambda i: {'countdown': 3600}),
+        ('schedule', lambda i: {'cname': 'sched{0}'.format(i),
+                                'schedule': schedules.crontab()}),
+    ]
+    results = {}
+    for name, kwargs in variants:
+        conn.flushdb()
+        tq = tq_class('bench')
+        args = [kwargs(i) for i in range(number)]
+        start = default_timer()
+        for kw in args:
+            tq.add_task({'method': 'GET', 'url': url}, **kw)
+        results[name] = {'ops': ops(number, default_timer() - start)}
+    conn.flushdb()
+    return results
+
+
+def populate(conn, tq, url, count, chunk=1000):
+    """writing tasks straight into redis, add_task is too slow for
+    millions of tasks and it's not what is measured here"""
+    metakey = tq._TaskQueue__metakey
+    uuidkey = tq._TaskQueue__uuidkey()
+    for offset in range(0, count, chunk):
+        with conn.pipeline(transaction=False) as pipe:
+            for idx in range(offset + 1, min(offset + chunk, count) + 1):
+                task = Task({'method': 'GET', 'url': url}, id=idx,
+                            uuid='{0:032x}'.format(idx), status='delayed',
+                            countdown=3600)
+                _, task_dict = task._to_redis()
+                pipe.hmset(metakey(idx), task_dict)
+                pipe.zadd(uuidkey, idx, task.uuid)
+            pipe.execute()
+
+
+def bench_iter_tasks(conn, url, scales):
+    tq_class = BenchTaskQueue
+    results = {}
+    for scale in scales:
+        conn.flushdb()
+        tq = tq_class('bench')
+        populate(conn, tq, url, scale)
+        result = {}
+        for name in ('iter_tasks', 'iter_tasks_json'):
+            start = default_timer()
+            count = 0
+            for task in getattr(tq, name)(per_pipeline=100):
+                count += 1
+            assert count == scale
+            result[name] = {'tasks_per_s': ops(count,
+                                               default_timer() - start)}
+        results[str(scale)] = result
+    conn.flushdb()
+    return results
+
+
+def bench_dispatch(conn, url, number):
+    tq_class = BenchTaskQueue
+    conn.flushdb()
+    tq = tq_class('bench')
+    ids = [tq.add_task({'method': 'GET', 'url': url},
+                       countdown=3600)['id'] for i in range(number)]
+    start = default_timer()
+    for task_id in ids:
+        request_task(tq_class, 'bench', 'default', task_id)
+    seconds = default_timer() - start
+    assert tq.count_tasks() == 0
+    conn.flushdb()
+    return {'ops': ops(number, seconds)}
+
+
+def bench_rest(url, number):
+    from asynxd import apis
+    apis.redisconn.flushdb()
+    client = apis.app.test_client()
+    path = '/apps/bench/taskqueues/default/tasks'
+    body = json.dumps({'request': {'url': url}, 'countdown': 3600})
+    samples = []
+    for i in range(number):
+        start = default_timer()
+        rv = client.post(path, data=body)
+        samples.append(default_timer() - start)
+        assert rv.status_code == 201, rv.data
+    results = {'insert': latencies(samples)}
+    for limit in (50, 200):
+        samples = []
+        for i in range(max(number // 10, 10)):
+            start = default_timer()
+            rv = client.get('{0}?limit={1}'.format(path, limit))
+            samples.append(default_timer() - start)
+            assert rv.status_code == 200, rv.data
+        results['list{0}'.format(limit)] = latencies(samples)
+    apis.redisconn.flushdb()
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def flatten(results, prefix=''):
+    flat = {}
+    for key, val in results.items():
+        if isinstance(val, dict):
+            flat.update(flatten(val, prefix + key + '.'))
+        else:
+            flat[prefix + key] = val
+    return flat
+
+
+def compare(new, old):
+    """printing every metric of the new results against the old ones"""
+    new, old = flatten(new['results']), flatten(old['results'])
+    print('{0:<44} {1:>12} {2:>12} {3:>8}'.format(
+        'metric', 'old', 'new', 'change'))
+    for key in sorted(new):
+        if key not in old or not old[key]:
+            continue
+        change = (new[key] - old[key]) / float(old[key]) * 100
+        print('{0:<44} {1:>12.2f} {2:>12.2f} {3:>+7.1f}%'.format(
+            key, old[key], new[key], change))
+
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--redis-url', default='redis://localhost:6379/15',
+                      help='redis to run against, the db is FLUSHED')
+    parser.add_option('--redis-server', default=None,
+                      help='spawns a throwaway redis-server binary')
+    parser.add_option('--broker-db', type='int', default=14,
+                      help='db of the celery broker, on the same redis')
+    parser.add_option('--scales', default='10000,100000',
+                      help='task counts of the iter_tasks benchmark')
+    parser.add_option('-n', '--number', type='int', default=2000,
+                      help='operations per benchmark')
+    parser.add_option('-b', '--bench', default='add_task,iter_tasks,'
+                      'dispatch,rest', help='benchmarks to run')
+    parser.add_option('-o', '--output', default=None,
+                      help='writes results as JSON')
+    parser.add_option('--compare', default=None,
+                      help='results JSON to compare with')
+    options, args = parser.parse_args()
+
+    proc = None
+    redis_url = options.redis_url
+    if options.redis_server:
+        proc, redis_url = spawn_redis(options.redis_server)
+    conn = redis.StrictRedis.from_url(redis_url)
+    BenchTaskQueue.connection = conn
+    redis_version = conn.info().get('redis_version')
+    conn_kwargs = conn.connection_pool.connection_kwargs
+    # asynxd reads its redis from environment, see application.cfg
+    os.environ['ASYNX_REDIS_HOST'] = conn_kwargs.get('host', 'localhost')
+    os.environ['ASYNX_REDIS_PORT'] = str(conn_kwargs.get('port', 6379))
+    os.environ['ASYNX_REDIS_DB'] = str(conn_kwargs.get('db', 0))
+    # the broker can't live in the flushed db
+    broker_url = 'redis://{0}:{1}/{2}'.format(
+        conn_kwargs.get('host', 'localhost'), conn_kwargs.get('port', 6379),
+        options.broker_db)
+    os.environ['ASYNX_CELERY_BROKER_URL'] = broker_url
+    Celery(broker=broker_url).set_current()
+    server, url = start_stub_server()
+    benches = options.bench.split(',')
+    results = {}
+    try:
+        if 'add_task' in benches:
+            results['add_task'] = bench_add_task(conn, url, options.number)
+        if 'iter_tasks' in benches:
+            scales = [int(s) for s in options.scales.split(',')]
+            results['iter_tasks'] = bench_iter_tasks(conn, url, scales)
+        if 'dispatch' in benches:
+            results['dispatch'] = bench_dispatch(conn, url, options.number)
+        if 'rest' in benches:
+            results['rest'] = bench_rest(url, options.number)
+    finally:
+        server.shutdown()
+        # undispatched messages of the benchmarks
+        redis.StrictRedis.from_url(broker_url).delete('celery')
+        if proc is not None:
+            proc.terminate()
+            proc.wait()
+    report = {
+        'commit': git_commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'redis': redis_version,
+        'number': options.number,
+        'results': results}
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as fp:
+            fp.write(text + '\n')
+    else:
+        print(text)
+    if options.compare:
+        with open(options.compare) as fp:
+            compare(report, json.load(fp))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Simulating scheduled and delayed tasks on a virtual clock
+
+Tasks are stored in redis as asynxd does, the celery messages are kept
+in memory and run when the virtual clock reaches them, without sending
+HTTP requests. Reports the drift of runs from when they should happen,
+peak runs per second and the redis round trips they cost.
+
+The redis database is FLUSHED, use a dedicated one (default db 15), or
+run without redis on the in-memory backend with --memory.
+
+Usage:
+    $ python benchmarks/simulate_scheduler.py --tasks 100000 \\
+          --schedule "every 3600 seconds" --spread 3600 --days 7
+    $ python benchmarks/simulate_scheduler.py --tasks 1000000 \\
+          --schedule "0 * * * *" --latency 0.2 --jitter 1 -o week.json
+
+"""
+from __future__ import print_function
+
+import json
+from optparse import OptionParser
+from timeit import default_timer
+
+import redis
+
+from asynx_core.backends import MemoryBackend
+from asynx_core.simulator import Simulator
+
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--redis-url', default='redis://localhost:6379/15',
+                      help='redis to run against, the db is FLUSHED')
+    parser.add_option('--memory', action='store_true', default=False,
+                      help='stores tasks in memory instead of redis')
+    parser.add_option('-n', '--tasks', type='int', default=10000)
+    parser.add_option('-s', '--schedule', default='every 3600 seconds',
+                      help='"every N seconds" or a crontab "m h dom mon '
+                      'dow", empty for delayed tasks')
+    parser.add_option('--countdown', type='float', default=3600,
+                      help='maximum countdown of delayed tasks')
+    parser.add_option('--spread', type='float', default=0,
+                      help='seconds the insertions are spread over')
+    parser.add_option('-d', '--days', type='float', default=7)
+    parser.add_option('--latency', type='float', default=0.0,
+                      help='seconds a worker takes to pick up a task')
+    parser.add_option('--jitter', type='float', default=0.0,
+                      help='maximum random seconds added to latency')
+    parser.add_option('--seed', type='int', default=0)
+    parser.add_option('-o', '--output', default=None,
+                      help='writes the report as JSON')
+    options, args = parser.parse_args()
+
+    if options.memory:
+        storage = MemoryBackend()
+    else:
+        storage = redis.StrictRedis.from_url(options.redis_url)
+        storage.flushdb()
+    sim = Simulator(storage, latency=options.latency, jitter=options.jitter,
+                    seed=options.seed)
+    start = default_timer()
+    if options.schedule:
+        sim.add_tasks(options.tasks, schedule=options.schedule,
+                      spread=options.spread)
+    else:
+        sim.add_tasks(options.tasks, countdown=(0, options.countdown),
+                      spread=options.spread)
+    inserting = default_timer() - start
+    try:
+        report = sim.run(options.days * 86400)
+    finally:
+        if not options.memory:
+            storage.flushdb()
+    report['insert_seconds'] = inserting
+    report['options'] = options.__dict__
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as fp:
+            fp.write(text + '\n')
+    else:
+        print(text)
+
+if __name__ == '__main__':
+    main()